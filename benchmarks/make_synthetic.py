@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+#
+# Makes small synthetic datasets that are laid out like Slakh: track directories with a
+# `metadata.yaml`, `all_src.mid`, per-stem MIDI files, stems, and a mix. The audio is a
+# simple rendering of the MIDI notes, so it is not meant for listening, only for testing
+# and benchmarking the scripts in this repository without downloading Slakh.
+# See the README about how to use.
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import soundfile as sf
+import yaml
+import mido
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from splits.resplit_slakh import orig_split  # noqa: E402
+
+
+DRUMS_PROGRAM = 128
+_INST_VALUES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'midi_inst_values', 'general_midi_inst_0based.json')
+_TICKS_PER_BEAT = 480
+_TEMPO = 500000  # 120 bpm
+
+
+def _random_notes(rng, seconds, is_drum):
+    """
+    :return: (list) (start_seconds, end_seconds, pitch, velocity) of random eighth notes.
+    """
+    notes = []
+    for start in np.arange(0, seconds - 0.25, 0.25):
+        if rng.rand() < 0.6:
+            pitch = int(rng.choice([36, 38, 42, 46])) if is_drum else int(rng.randint(36, 84))
+            notes.append((float(start), float(start) + 0.25, pitch, int(rng.randint(60, 120))))
+    return notes
+
+
+def _midi_track(notes, program, is_drum, name):
+    channel = 9 if is_drum else 0
+    to_ticks = _TICKS_PER_BEAT * 1e6 / _TEMPO
+    events = []
+    for start, end, pitch, velocity in notes:
+        events.append((int(round(start * to_ticks)), 1, mido.Message('note_on', channel=channel,
+                                                                     note=pitch, velocity=velocity)))
+        events.append((int(round(end * to_ticks)), 0, mido.Message('note_off', channel=channel,
+                                                                    note=pitch, velocity=0)))
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage('track_name', name=name, time=0))
+    if not is_drum:
+        track.append(mido.Message('program_change', channel=channel, program=program, time=0))
+    tick = 0
+    for event_tick, _, msg in events:
+        track.append(msg.copy(time=event_tick - tick))
+        tick = event_tick
+    return track
+
+
+def _render(notes, seconds, sr, is_drum):
+    """
+    Renders notes as decaying sine tones (or noise bursts, for drums).
+    """
+    audio = np.zeros(int(seconds * sr), dtype=np.float32)
+    for start, end, pitch, velocity in notes:
+        first, last = int(start * sr), min(int(end * sr), len(audio))
+        t = np.arange(last - first, dtype=np.float32) / sr
+        envelope = np.exp(-8 * t) * velocity / 127
+        if is_drum:
+            tone = np.random.RandomState(pitch).randn(len(t)).astype(np.float32) * 0.5
+        else:
+            tone = np.sin(2 * np.pi * 440 * 2 ** ((pitch - 69) / 12) * t)
+        audio[first:last] += (0.3 * envelope * tone).astype(np.float32)
+    return audio
+
+
+def make_track(track_dir, n_stems=6, seconds=10., sr=44100, ext='.wav', seed=0):
+    """
+    Makes one synthetic track directory.
+    :param track_dir: (str) directory to make, e.g., '/tmp/synthetic/Track00001'.
+    :param n_stems: (int) number of stems. The first stem is always drums.
+    :param seconds: (float) length of the audio.
+    :param sr: (int) sample rate of the audio.
+    :param ext: (str) '.wav' or '.flac'.
+    :param seed: (int) seed of the random notes and instruments.
+    """
+    with open(_INST_VALUES) as f:
+        inst_values = json.load(f)
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(track_dir, 'stems'), exist_ok=True)
+    os.makedirs(os.path.join(track_dir, 'MIDI'), exist_ok=True)
+
+    programs = [DRUMS_PROGRAM] + [int(p) for p in rng.randint(0, 128, size=n_stems - 1)]
+    all_src = mido.MidiFile(ticks_per_beat=_TICKS_PER_BEAT)
+    tempo_track = mido.MidiTrack()
+    tempo_track.append(mido.MetaMessage('set_tempo', tempo=_TEMPO, time=0))
+    all_src.tracks.append(tempo_track)
+
+    stems_metadata = {}
+    stems = []
+    for i, program in enumerate(programs):
+        stem_id = f'S{i:02d}'
+        is_drum = program == DRUMS_PROGRAM
+        notes = _random_notes(rng, seconds, is_drum)
+
+        midi_track = _midi_track(notes, program % 128, is_drum, stem_id)
+        all_src.tracks.append(midi_track)
+        stem_midi = mido.MidiFile(ticks_per_beat=_TICKS_PER_BEAT)
+        stem_midi.tracks.extend([tempo_track, midi_track])
+        stem_midi.save(os.path.join(track_dir, 'MIDI', stem_id + '.mid'))
+
+        stems.append(_render(notes, seconds, sr, is_drum))
+        stems_metadata[stem_id] = {
+            'audio_rendered': True,
+            'inst_class': inst_values[str(program)]['class'],
+            'integrated_loudness': -13.0,
+            'is_drum': is_drum,
+            'midi_program_name': inst_values[str(program)]['name'],
+            'midi_saved': True,
+            'plugin_name': f'synthetic_{program}.nkm',
+            'program_num': program,
+        }
+    all_src.save(os.path.join(track_dir, 'all_src.mid'))
+
+    # Scale the stems so that the mix peaks at -1 dBFS, like Slakh
+    stems = np.stack(stems)
+    peak = np.abs(stems.sum(axis=0)).max()
+    overall_gain = float(10 ** (-1. / 20) / peak) if peak > 0 else 1.
+    stems *= overall_gain
+    for stem_id, stem in zip(stems_metadata, stems):
+        sf.write(os.path.join(track_dir, 'stems', stem_id + ext), stem, sr, subtype='PCM_16')
+    sf.write(os.path.join(track_dir, 'mix' + ext), stems.sum(axis=0), sr, subtype='PCM_16')
+
+    metadata = {
+        'UUID': f'{seed:032x}',
+        'audio_dir': 'stems',
+        'midi_dir': 'MIDI',
+        'normalization_factor': -13.0,
+        'normalized': True,
+        'overall_gain': overall_gain,
+        'stems': stems_metadata,
+        'target_peak': -1.0,
+    }
+    with open(os.path.join(track_dir, 'metadata.yaml'), 'w') as f:
+        yaml.safe_dump(metadata, f, default_flow_style=False)
+
+
+def make_synthetic_slakh(output_dir, n_tracks=8, n_stems=6, seconds=10., sr=44100, ext='.wav',
+                         splits=False, seed=0):
+    """
+    Makes a synthetic dataset laid out like Slakh.
+    :param output_dir: (str) base directory of the dataset.
+    :param n_tracks: (int) number of tracks, named Track00001, Track00002, ...
+    :param n_stems: (int) number of stems per track.
+    :param seconds: (float) length of each track.
+    :param sr: (int) sample rate.
+    :param ext: (str) '.wav' or '.flac'.
+    :param splits: (bool) put the tracks in train/validation/test subdirectories (by the
+        track ids of Slakh2100-orig), instead of directly in `output_dir`.
+    :param seed: (int) seed of the random notes and instruments.
+    :return: (list) paths of the track directories.
+    """
+    track_dirs = []
+    for i in range(1, n_tracks + 1):
+        track_id = f'Track{i:05d}'
+        parent = os.path.join(output_dir, orig_split(track_id)) if splits else output_dir
+        track_dir = os.path.join(parent, track_id)
+        make_track(track_dir, n_stems, seconds, sr, ext, seed=seed * 100003 + i)
+        track_dirs.append(track_dir)
+    return track_dirs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output-dir', '-o', type=str, required=True,
+                        help='Base directory of the synthetic dataset.')
+    parser.add_argument('--num-tracks', '-n', type=int, default=8, help='Number of tracks.')
+    parser.add_argument('--num-stems', type=int, default=6, help='Number of stems per track.')
+    parser.add_argument('--seconds', type=float, default=10., help='Length of each track.')
+    parser.add_argument('--sample-rate', '-r', type=int, default=44100, help='Sample rate.')
+    parser.add_argument('--format', '-f', type=str, choices=['wav', 'flac'], default='wav',
+                        help='Audio format.')
+    parser.add_argument('--splits', action='store_true',
+                        help='Put tracks in train/validation/test subdirectories.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    make_synthetic_slakh(args.output_dir, args.num_tracks, args.num_stems, args.seconds,
+                         args.sample_rate, '.' + args.format, args.splits, args.seed)
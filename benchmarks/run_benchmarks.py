@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the scripts in this repository on synthetic Slakh-like datasets (see
+# `make_synthetic.py`) at several worker counts. Each run happens in a fresh process, and
+# the wall time, throughput, and peak memory of the run are reported as json, so results
+# can be compared across commits and machines.
+# See the README about how to use.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.make_synthetic import make_synthetic_slakh  # noqa: E402
+# The scripts being benchmarked are imported here, not in the run functions, so that
+# import time is not part of the measured time of a run.
+from conversion.flac_converter import to_flac, to_packed, to_wav  # noqa: E402
+from pianoroll.pianoroll import compute_all_piano_rolls  # noqa: E402
+from pipeline.preprocess import preprocess  # noqa: E402
+from resampling.resample import slakh_resample  # noqa: E402
+from splits.resplit_slakh import apply_splits, reset  # noqa: E402
+from submixes.submixes import Submixes  # noqa: E402
+
+
+_SUBMIX_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'submixes', 'example_submixes', 'band.yaml')
+
+
+def _to_wav(data_dirs, work_dir, n_workers):
+    to_wav(data_dirs['flac'], os.path.join(work_dir, 'out'), n_threads=n_workers)
+
+
+def _to_flac(data_dirs, work_dir, n_workers):
+    to_flac(data_dirs['wav'], os.path.join(work_dir, 'out'), n_threads=n_workers)
+
+
+def _pack(data_dirs, work_dir, n_workers):
+    to_packed(data_dirs['flac'], os.path.join(work_dir, 'out'), n_threads=n_workers)
+
+
+def _resample(data_dirs, work_dir, n_workers):
+    slakh_resample(data_dirs['wav'], 16000, os.path.join(work_dir, 'out'), n_threads=n_workers)
+
+
+def _setup_submixes(data_dirs, work_dir):
+    # Submixes (and piano rolls) are written into the track directories, so work on a copy
+    shutil.copytree(data_dirs['wav'], os.path.join(work_dir, 'wav'))
+
+
+def _submixes(data_dirs, work_dir, n_workers):
+    Submixes(os.path.join(work_dir, 'wav'), _SUBMIX_FILE).do_all_submixes(n_workers)
+
+
+def _pipeline(data_dirs, work_dir, n_workers):
+    preprocess(data_dirs['flac'], os.path.join(work_dir, 'out'), 16000, [_SUBMIX_FILE],
+               n_workers=n_workers)
+
+
+def _pianoroll(data_dirs, work_dir, n_workers):
+    compute_all_piano_rolls(os.path.join(work_dir, 'wav'), n_workers=n_workers)
+
+
+def _setup_resplit(data_dirs, work_dir):
+    base_dir = os.path.join(work_dir, 'splits')
+    shutil.copytree(data_dirs['splits'], base_dir)
+    # Synthetic track ids all fall in train, so spread the tracks over every split first,
+    # so that moves between every pair of splits are timed
+    splits = ['train', 'validation', 'test']
+    track_ids = sorted(os.listdir(os.path.join(base_dir, 'train')))
+    for i, track_id in enumerate(track_ids):
+        if splits[i % 3] != 'train':
+            os.makedirs(os.path.join(base_dir, splits[i % 3]), exist_ok=True)
+            os.rename(os.path.join(base_dir, 'train', track_id),
+                      os.path.join(base_dir, splits[i % 3], track_id))
+
+    # Move most tracks to another split, and omit every fifth one
+    split_data = {}
+    for i, track_id in enumerate(track_ids):
+        source = splits[i % 3]
+        if i % 5 == 4:
+            split_data[track_id] = {'action': 'omit', 'source_split': source}
+        else:
+            split_data[track_id] = {'action': 'move', 'source_split': source,
+                                    'destination_split': splits[(i + 1 + (i // 3) % 2) % 3]}
+    with open(os.path.join(work_dir, 'split.json'), 'w') as f:
+        json.dump(split_data, f)
+
+
+def _resplit(data_dirs, work_dir, n_workers):
+    apply_splits(os.path.join(work_dir, 'splits'), os.path.join(work_dir, 'split.json'))
+    reset(os.path.join(work_dir, 'splits'))
+
+
+# name -> (run function, setup function or None, whether the run uses workers, needs ffmpeg)
+BENCHMARKS = {
+    'to_wav': (_to_wav, None, True, True),
+    'to_flac': (_to_flac, None, True, True),
+    'pack': (_pack, None, True, False),
+    'resample': (_resample, None, True, False),
+    'submixes': (_submixes, _setup_submixes, True, False),
+    'pipeline': (_pipeline, None, True, False),
+    'pianoroll': (_pianoroll, _setup_submixes, True, False),
+    'resplit': (_resplit, _setup_resplit, False, False),
+}
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def _run_case(name, data_dirs, work_dir, n_workers, quiet, start_method, conn):
+    """
+    Runs one benchmark in a fresh process and sends its measurements through `conn`.
+    """
+    # A spawned process starts its own pools by spawning too, which re-imports every module
+    # in each worker. Start them the way the scripts do when run on their own instead.
+    multiprocessing.set_start_method(start_method, force=True)
+    if quiet:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+
+    run, setup, _, _ = BENCHMARKS[name]
+    if setup is not None:
+        setup(data_dirs, work_dir)
+    start = time.perf_counter()
+    run(data_dirs, work_dir, n_workers)
+    seconds = time.perf_counter() - start
+
+    # Worker processes have exited by now, so they count as children
+    conn.send({
+        'seconds': seconds,
+        'peak_rss_mb': _max_rss_mb(resource.RUSAGE_SELF),
+        'peak_rss_children_mb': _max_rss_mb(resource.RUSAGE_CHILDREN),
+    })
+    conn.close()
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(benchmarks=None, worker_counts=(1, 2, 4), n_tracks=8, n_stems=6, seconds=10.,
+                   data_dir=None, quiet=True):
+    """
+    Makes synthetic datasets and runs benchmarks on them.
+    :param benchmarks: (list) names of the benchmarks to run (see `BENCHMARKS`). If `None`,
+        runs all of them.
+    :param worker_counts: (list) numbers of workers to run each benchmark with.
+    :param n_tracks: (int) number of tracks in the synthetic datasets.
+    :param n_stems: (int) number of stems per track.
+    :param seconds: (float) length of each track.
+    :param data_dir: (str) directory to make the synthetic datasets and outputs in. If `None`,
+        uses a temporary directory that is removed afterwards.
+    :param quiet: (bool) hide the output of the scripts being benchmarked.
+    :return: (dict) the configuration and one result per benchmark and worker count.
+    """
+    benchmarks = list(BENCHMARKS) if benchmarks is None else benchmarks
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {'n_tracks': n_tracks, 'n_stems': n_stems, 'seconds': seconds,
+                   'worker_counts': list(worker_counts)},
+        'results': [],
+    }
+    audio_seconds = n_tracks * (n_stems + 1) * seconds  # stems plus the mix
+
+    base_dir = data_dir if data_dir is not None else tempfile.mkdtemp(prefix='slakh_bench_')
+    data_dirs = {name: os.path.join(base_dir, 'data', name) for name in ('wav', 'flac', 'splits')}
+    try:
+        for name, ext, splits in [('wav', '.wav', False), ('flac', '.flac', False),
+                                  ('splits', '.wav', True)]:
+            if not os.path.isdir(data_dirs[name]):
+                make_synthetic_slakh(data_dirs[name], n_tracks, n_stems, seconds, ext=ext,
+                                     splits=splits)
+
+        start_method = multiprocessing.get_start_method()
+        context = multiprocessing.get_context('spawn')
+        for name in benchmarks:
+            _, _, uses_workers, needs_ffmpeg = BENCHMARKS[name]
+            for n_workers in (worker_counts if uses_workers else [1]):
+                result = {'benchmark': name, 'workers': n_workers}
+                if needs_ffmpeg and not has_ffmpeg:
+                    result['skipped'] = 'ffmpeg not found'
+                    report['results'].append(result)
+                    break
+
+                work_dir = os.path.join(base_dir, 'work', f'{name}-{n_workers}')
+                shutil.rmtree(work_dir, ignore_errors=True)
+                os.makedirs(work_dir)
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=_run_case,
+                                          args=(name, data_dirs, work_dir, n_workers, quiet,
+                                                start_method, sender))
+                process.start()
+                sender.close()
+                try:
+                    measurements = receiver.recv()
+                except EOFError:
+                    measurements = None
+                process.join()
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+                if measurements is None:
+                    result['failed'] = f'exit code {process.exitcode}'
+                else:
+                    result.update(measurements)
+                    result['tracks_per_second'] = n_tracks / max(result['seconds'], 1e-9)
+                    result['audio_seconds_per_second'] = audio_seconds / max(result['seconds'], 1e-9)
+                report['results'].append(result)
+                print(_format_result(result), file=sys.stderr)
+    finally:
+        if data_dir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return report
+
+
+def _format_result(result):
+    label = f'{result["benchmark"]:>10} x{result["workers"]:<3}'
+    if 'skipped' in result or 'failed' in result:
+        return f'{label} {result.get("skipped") or result.get("failed")}'
+    return (f'{label} {result["seconds"]:8.2f}s {result["tracks_per_second"]:8.2f} tracks/s '
+            f'{result["audio_seconds_per_second"]:9.1f} audio s/s '
+            f'{max(result["peak_rss_mb"], result["peak_rss_children_mb"]):8.1f} MB peak RSS')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', '-b', type=str, nargs='+', choices=list(BENCHMARKS),
+                        default=None, help='Benchmarks to run. Defaults to all of them.')
+    parser.add_argument('--workers', '-w', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of workers to run each benchmark with.')
+    parser.add_argument('--num-tracks', '-n', type=int, default=8,
+                        help='Number of tracks in the synthetic datasets.')
+    parser.add_argument('--num-stems', type=int, default=6, help='Number of stems per track.')
+    parser.add_argument('--seconds', type=float, default=10., help='Length of each track.')
+    parser.add_argument('--data-dir', '-d', type=str, default=None,
+                        help='Directory to keep the synthetic datasets in, so that they can be '
+                             'reused. Defaults to a temporary directory.')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='Path of the json file to write the results to. Defaults to stdout.')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Show the output of the scripts being benchmarked.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, args.workers, args.num_tracks, args.num_stems,
+                             args.seconds, args.data_dir, quiet=not args.verbose)
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
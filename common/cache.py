@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Thread-safe LRU cache of numpy arrays with a budget in bytes, used to keep decoded
+# audio in memory between requests.
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache of numpy arrays that holds at most `max_bytes` bytes.
+    If several threads ask for the same missing key at once through `get_or_load()`,
+    only one of them loads it and the others wait for the result.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes (int): maximum total size of the cached arrays, in bytes. Arrays
+            bigger than this are returned but never cached.
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        """
+        :return: the cached array for `key`, or `None` if it is not cached.
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Caches `value` under `key`, evicting the least recently used arrays to make room.
+        """
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        if key in self._items:
+            self.n_bytes -= self._items.pop(key).nbytes
+        while self._items and self.n_bytes + value.nbytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+        self._items[key] = value
+        self.n_bytes += value.nbytes
+
+    def get_or_load(self, key, load_func):
+        """
+        Gets the array for `key`, calling `load_func()` to make it (and caching the result)
+        if it is not cached yet.
+        :param key: hashable key.
+        :param load_func: function with no arguments that returns the array for `key`.
+        :return: (np.ndarray) the array for `key`.
+        """
+        while True:
+            with self._lock:
+                value = self._items.get(key)
+                if value is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Someone else is loading this key. Wait for them, then look again.
+            event.wait()
+
+        try:
+            value = load_func()
+            with self._lock:
+                self._put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.n_bytes = 0
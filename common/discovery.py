@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# Finds the track directories of Slakh, shared by every script in this repository. The
+# base directory and its split subdirectories (if any) are each listed once with
+# `os.scandir`, without looking inside the tracks, which understands both the original
+# flat layout (`base_dir/TrackXXXXX`) and split layouts (`base_dir/train/TrackXXXXX`, ...).
+#
+# Listing thousands of directories is slow on network file systems, so the result is
+# cached in a small json file per base directory. The cache records the modification
+# time of every directory that was listed, and is only used while none of them has
+# changed (adding, removing, or moving a track changes the modification time of the
+# directory it was in).
+
+import os
+import re
+import json
+import time
+import hashlib
+from collections import namedtuple
+
+from common.manifest import atomic_output
+
+
+SPLITS = ('train', 'validation', 'test', 'omitted')
+CACHE_DIR_ENV = 'SLAKH_UTILS_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'slakh-utils')
+_CACHE_VERSION = 1
+# Directories modified this recently might still change within the same mtime tick,
+# so listings of them are not cached.
+_RACY_SECONDS = 2.
+_TRACK_NUMBER = re.compile(r'^Track(\d+)$')
+
+
+class TrackDir(namedtuple('TrackDir', ['track_id', 'split', 'path'])):
+    """
+    A track directory: its id (e.g., 'Track00001'), the split directory it is in (or `None`
+    for the flat layout), and its path.
+    """
+    __slots__ = ()
+
+    @property
+    def relative_path(self):
+        """
+        :return: (str) path of the track relative to the base directory, e.g., 'train/Track00001'.
+        """
+        return os.path.join(self.split, self.track_id) if self.split else self.track_id
+
+
+def track_number(track_id):
+    """
+    :return: (int) the number of a track id, e.g., 1 for 'Track00001', or `None` if the
+        id is not numbered.
+    """
+    match = _TRACK_NUMBER.match(str(track_id))
+    return int(match.group(1)) if match else None
+
+
+def _as_track_number(value):
+    if value is None or isinstance(value, int):
+        return value
+    number = track_number(value)
+    if number is None:
+        number = int(value)  # A number given as a string, e.g., from a command line
+    return number
+
+
+def _cache_path(base_dir, cache_dir):
+    key = hashlib.md5(os.path.abspath(base_dir).encode()).hexdigest()
+    return os.path.join(cache_dir, f'tracks-{key}.json')
+
+
+def _mtimes(base_dir, splits):
+    """
+    :return: (dict) modification time (in ns) of the base directory and the given split
+        directories, keyed by their names ('' for the base directory).
+    """
+    mtimes = {'': os.stat(base_dir).st_mtime_ns}
+    for split in splits:
+        mtimes[split] = os.stat(os.path.join(base_dir, split)).st_mtime_ns
+    return mtimes
+
+
+def _scan(base_dir):
+    """
+    Lists the base directory and its split directories. The modification time of each
+    directory is taken before listing it, so that changes made while listing show up as
+    a changed modification time afterwards.
+    :return: (list, list, dict) (track id, split) pairs, the split directories found, and
+        the modification times of the directories listed (see `_mtimes()`).
+    """
+    tracks, splits = [], []
+    mtimes = {'': os.stat(base_dir).st_mtime_ns}
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('Track') and entry.is_dir():
+                tracks.append((entry.name, None))
+            elif entry.name in SPLITS and entry.is_dir():
+                splits.append(entry.name)
+
+    for split in sorted(splits):
+        split_dir = os.path.join(base_dir, split)
+        mtimes[split] = os.stat(split_dir).st_mtime_ns
+        with os.scandir(split_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('Track') and entry.is_dir():
+                    tracks.append((entry.name, split))
+    return tracks, sorted(splits), mtimes
+
+
+def _load_cache(path, base_dir):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get('version') != _CACHE_VERSION or \
+                cache.get('base_dir') != os.path.abspath(base_dir):
+            return None
+        if _mtimes(base_dir, cache['splits']) != cache['mtimes']:
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return [tuple(t) for t in cache['tracks']]
+
+
+def _save_cache(path, base_dir, tracks, splits, mtimes):
+    if max(mtimes.values()) / 1e9 > time.time() - _RACY_SECONDS:
+        return
+    cache = {'version': _CACHE_VERSION, 'base_dir': os.path.abspath(base_dir), 'splits': splits,
+             'mtimes': mtimes, 'tracks': tracks}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_output(path) as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f)
+    except OSError:
+        pass  # The cache is only an optimization
+
+
+def scan_tracks(base_dir, use_cache=True, cache_dir=None):
+    """
+    Finds every track directory in `base_dir` and its split subdirectories.
+    :param base_dir (str): base directory of Slakh.
+    :param use_cache (bool): reuse the previous listing of `base_dir` if no directory in it
+        has changed since, and save the listing for next time.
+    :param cache_dir (str): directory to keep listings in. Defaults to the environment
+        variable `SLAKH_UTILS_CACHE_DIR`, or `~/.cache/slakh-utils`.
+    :return: (list) `TrackDir`s sorted by track id, then split.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR
+    cache_path = _cache_path(base_dir, cache_dir)
+
+    tracks = _load_cache(cache_path, base_dir) if use_cache else None
+    if tracks is None:
+        tracks, splits, mtimes = _scan(base_dir)
+        if use_cache and _mtimes(base_dir, splits) == mtimes:
+            _save_cache(cache_path, base_dir, tracks, splits, mtimes)
+
+    return [TrackDir(track_id, split, os.path.join(base_dir, split or '', track_id))
+            for track_id, split in sorted(tracks, key=lambda t: (t[0], t[1] or ''))]
+
+
+def select_tracks(tracks, start=None, end=None, splits=None, track_ids=None):
+    """
+    Selects tracks by id range, split, and/or an explicit list of ids. Every given
+    criterion must match.
+    :param tracks (list): `TrackDir`s, see `scan_tracks()`.
+    :param start (int or str): lowest track id to select, as a number (e.g., 1) or an
+        id (e.g., 'Track00001'), inclusive.
+    :param end (int or str): highest track id to select, inclusive.
+    :param splits (str or list): split(s) to select, e.g., 'train'. Use `None` in the list
+        to select tracks of the flat layout.
+    :param track_ids (list): ids of the tracks to select.
+    :return: (list) the selected `TrackDir`s, in the same order.
+    """
+    start, end = _as_track_number(start), _as_track_number(end)
+    if isinstance(splits, str):
+        splits = [splits]
+    track_ids = set(track_ids) if track_ids is not None else None
+
+    selected = []
+    for track in tracks:
+        if start is not None or end is not None:
+            number = track_number(track.track_id)
+            if number is None or (start is not None and number < start) or \
+                    (end is not None and number > end):
+                continue
+        if splits is not None and track.split not in splits:
+            continue
+        if track_ids is not None and track.track_id not in track_ids:
+            continue
+        selected.append(track)
+    return selected
+
+
+def find_tracks(base_dir, start=None, end=None, splits=None, track_ids=None, require_file=None,
+                use_cache=True, cache_dir=None):
+    """
+    Finds and selects track directories, see `scan_tracks()` and `select_tracks()`.
+    :param require_file (str): only keep tracks that contain this file, e.g., 'metadata.yaml'.
+        This is checked for the selected tracks only, and never cached.
+    :return: (list) `TrackDir`s sorted by track id, then split.
+    """
+    tracks = select_tracks(scan_tracks(base_dir, use_cache, cache_dir), start, end, splits,
+                           track_ids)
+    if require_file is not None:
+        tracks = [t for t in tracks if os.path.isfile(os.path.join(t.path, require_file))]
+    return tracks
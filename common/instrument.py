@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+#
+# Timing and progress reporting shared by the scripts in this repository. Work on each
+# track (or file) is timed by stage with a `StageTimer`, which is small and picklable so
+# that worker processes can send it back with their results. In the main process, a
+# `Tracer` adds up the timers, shows a live progress line with an ETA, and optionally
+# writes every timer to a JSON-lines trace file, so that a slow run can be broken down
+# into time spent finding files, decoding, processing, encoding, writing, and copying
+# metadata.
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+STAGES = ('discover', 'decode', 'process', 'encode', 'write', 'copy_metadata')
+COUNTERS = ('files', 'bytes_in', 'bytes_out', 'audio_seconds')
+
+
+class StageTimer(object):
+    """
+    Seconds spent in each stage, and counters, for the work on one item (e.g., a track).
+
+    >>> timer = StageTimer('Track00001')
+    >>> with timer.stage('decode'):
+    ...     audio = read(path)
+    >>> timer.count(files=1, bytes_in=os.path.getsize(path), audio_seconds=len(audio) / sr)
+    """
+
+    def __init__(self, item):
+        """
+        :param item (str): name of the item being timed, e.g., a track id or file path.
+        """
+        self.item = item
+        self.stages = dict.fromkeys(STAGES, 0.)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the time spent in its block to stage `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - start
+
+    def count(self, **counters):
+        """
+        Adds to counters, e.g., `timer.count(files=1, bytes_in=1024)`.
+        """
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """
+        Adds the stages and counters of another `StageTimer` into this one.
+        """
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.) + seconds
+        self.count(**other.counters)
+
+    def to_dict(self):
+        return {'item': self.item, 'stages': self.stages, 'counters': self.counters}
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+class Tracer(object):
+    """
+    Collects `StageTimer`s in the main process, shows progress, and writes a trace.
+    Safe to use from several threads at once.
+
+    >>> with Tracer('resample', total=len(tracks), trace_path='trace.jsonl') as tracer:
+    ...     for timer in pool.imap_unordered(work, tracks):
+    ...         tracer.record(timer)
+    """
+
+    def __init__(self, tool, total=None, unit='tracks', trace_path=None, progress=True,
+                 stream=None, interval=0.5):
+        """
+        :param tool (str): name of the script, shown in the progress line and the trace.
+        :param total (int): number of items expected, used for the ETA. Can be set later.
+        :param unit (str): name of the items, shown in the progress line.
+        :param trace_path (str): path of a JSON-lines file to write every timer to. If
+            `None`, no trace is written.
+        :param progress (bool): show a progress line. It is redrawn in place on a
+            terminal, and printed as a new line at most every 30 seconds otherwise.
+        :param stream: where to show progress and the summary. Defaults to stderr.
+        :param interval (float): seconds between redraws of the progress line on a terminal.
+        """
+        self.tool = tool
+        self.total = total
+        self.unit = unit
+        self.progress = progress
+        self.stream = stream if stream is not None else sys.stderr
+        self.totals = StageTimer(tool)
+        self.n_done = 0
+        self._interval = interval if self._is_terminal() else 30.
+        self._start = time.perf_counter()
+        self._last_draw = 0.
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, 'a') if trace_path else None
+
+    def _is_terminal(self):
+        return hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_trace(self, record):
+        if self._trace is not None:
+            self._trace.write(json.dumps(record) + '\n')
+            self._trace.flush()
+
+    def record(self, timer, done=1):
+        """
+        Adds a finished item's timer.
+        :param timer (StageTimer): the timer, or `None` to only count progress.
+        :param done (int): number of items this counts as toward `total`.
+        """
+        with self._lock:
+            self.n_done += done
+            if timer is not None:
+                self.totals.merge(timer)
+                record = timer.to_dict()
+                record.update({'tool': self.tool, 'pid': os.getpid(),
+                               'elapsed': time.perf_counter() - self._start})
+                self._write_trace(record)
+            now = time.perf_counter()
+            if self.progress and now - self._last_draw >= self._interval:
+                self._last_draw = now
+                self._draw()
+
+    def _progress_line(self):
+        elapsed = time.perf_counter() - self._start
+        rate = self.n_done / max(elapsed, 1e-9)
+        line = f'[{self.tool}] {self.n_done}'
+        if self.total:
+            line += f'/{self.total} {self.unit} ({100 * self.n_done / self.total:.0f}%)'
+            if self.n_done:
+                line += f', ETA {_format_duration((self.total - self.n_done) / rate)}'
+        else:
+            line += f' {self.unit}'
+        line += f', {rate:.2f} {self.unit}/s'
+
+        stages = self.totals.stages
+        busy = sum(stages.values())
+        if busy > 0:
+            line += ' | ' + ' '.join(f'{name} {100 * seconds / busy:.0f}%'
+                                     for name, seconds in stages.items() if seconds > 0)
+        return line
+
+    def _draw(self):
+        if self._is_terminal():
+            self.stream.write('\r\033[K' + self._progress_line())
+        else:
+            self.stream.write(self._progress_line() + '\n')
+        self.stream.flush()
+
+    def summary(self):
+        """
+        :return: (dict) totals of every stage and counter, plus the wall time and throughput.
+        """
+        elapsed = time.perf_counter() - self._start
+        return {
+            'tool': self.tool,
+            'items': self.n_done,
+            'seconds': elapsed,
+            'items_per_second': self.n_done / max(elapsed, 1e-9),
+            'audio_seconds_per_second': self.totals.counters['audio_seconds'] / max(elapsed, 1e-9),
+            'stages': dict(self.totals.stages),
+            'counters': dict(self.totals.counters),
+        }
+
+    def close(self):
+        """
+        Shows the summary and closes the trace file, whose last line is the summary.
+        """
+        with self._lock:
+            if self._trace is None and not self.progress:
+                return
+            summary = self.summary()
+            if self.progress:
+                if self._is_terminal():
+                    self.stream.write('\r\033[K')
+                self.stream.write(self._progress_line() + '\n')
+                counters = summary['counters']
+                totals = [f'{counters["bytes_in"] / 1e6:.1f} MB read' if counters['bytes_in'] else '',
+                          f'{counters["bytes_out"] / 1e6:.1f} MB written' if counters['bytes_out'] else '',
+                          f'{counters["audio_seconds"] / 3600:.2f} hours of audio'
+                          if counters['audio_seconds'] else '']
+                totals = ', '.join(t for t in totals if t)
+                self.stream.write(f'[{self.tool}] Finished {self.n_done} {self.unit} in '
+                                  f'{_format_duration(summary["seconds"])}'
+                                  + (f': {totals}.\n' if totals else '.\n'))
+                self.stream.flush()
+                self.progress = False
+            if self._trace is not None:
+                self._write_trace({'summary': summary})
+                self._trace.close()
+                self._trace = None
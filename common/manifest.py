@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Per-track manifests of completed outputs, so that long conversion and resampling
+# runs can be interrupted and resumed. Each output track directory gets a small json
+# file that records, for every output file, the source file it was made from (size,
+# mtime and md5) and the parameters used to make it. On a re-run, outputs whose
+# source and parameters have not changed are skipped.
+
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+MANIFEST_NAME = '.slakh_manifest.json'
+PARTIAL_TAG = '.partial-'
+
+
+def file_md5(path, chunk_size=1 << 20):
+    """
+    Computes the md5 hash of a file, reading it in chunks.
+    :param path (str): path to the file.
+    :param chunk_size (int): number of bytes to read at once.
+    :return: (str) hex digest of the file.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Context manager that yields a temporary path next to `path` to write to. When the
+    block exits cleanly the temporary file is renamed to `path`, otherwise it is removed,
+    so `path` never holds a partially written file. The temporary file keeps the
+    extension of `path`, so tools that infer the format from the extension still work.
+
+    >>> with atomic_output('Track00001/mix.wav') as temp_path:
+    ...     sf.write(temp_path, wav, sr)
+
+    :param path (str): final path of the output file.
+    """
+    out_dir, basename = os.path.split(path)
+    stem, ext = os.path.splitext(basename)
+    temp_path = os.path.join(out_dir, f'.{stem}{PARTIAL_TAG}{os.getpid()}-'
+                                      f'{threading.get_ident()}{ext}')
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def remove_partial_outputs(directory):
+    """
+    Removes temporary files left behind in `directory` by an interrupted `atomic_output`.
+    :param directory (str): directory to clean up. Does nothing if it does not exist.
+    """
+    if not os.path.isdir(directory):
+        return
+    for entry in os.scandir(directory):
+        if entry.name.startswith('.') and PARTIAL_TAG in entry.name and entry.is_file():
+            os.remove(entry.path)
+
+
+class TrackManifest(object):
+    """
+    Manifest of the completed outputs of one track. Entries are keyed by the output
+    path relative to the track directory. Safe to use from several threads at once.
+    """
+
+    def __init__(self, track_dir, params):
+        """
+        :param track_dir (str): output track directory. The manifest is stored in this
+            directory as `MANIFEST_NAME`.
+        :param params (dict): json-serializable parameters used to make the outputs, e.g.,
+            `{'target_sr': 16000}`. Outputs made with different parameters are out of date.
+        """
+        self.track_dir = track_dir
+        self.path = os.path.join(track_dir, MANIFEST_NAME)
+        self.params = json.loads(json.dumps(params))
+        self._lock = threading.Lock()
+
+        self.outputs = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.outputs = json.load(f)['outputs']
+            except (ValueError, KeyError):
+                # A corrupt manifest just means everything gets redone.
+                self.outputs = {}
+
+    def _key(self, out_path):
+        return os.path.relpath(out_path, self.track_dir)
+
+    def is_current(self, src_path, out_path):
+        """
+        Determines whether `out_path` was completely made from the current version of
+        `src_path` with the current parameters. The source is first compared by size and
+        mtime; if only the mtime differs, its md5 hash is compared.
+        :param src_path (str): path to the source file.
+        :param out_path (str): path to the output file.
+        :return: (bool) `True` if the output can be skipped.
+        """
+        with self._lock:
+            entry = self.outputs.get(self._key(out_path))
+        if entry is None or entry['params'] != self.params:
+            return False
+        if not os.path.isfile(out_path) or os.path.getsize(out_path) != entry['output_size']:
+            return False
+        if not os.path.isfile(src_path):
+            return False
+
+        src_stat = os.stat(src_path)
+        if src_stat.st_size != entry['source_size']:
+            return False
+        if src_stat.st_mtime_ns == entry['source_mtime_ns']:
+            return True
+        if file_md5(src_path) != entry['source_md5']:
+            return False
+
+        # Same contents, new mtime (e.g., the source was copied). Remember the new mtime.
+        with self._lock:
+            entry['source_mtime_ns'] = src_stat.st_mtime_ns
+            self._save()
+        return True
+
+    def record(self, src_path, out_path):
+        """
+        Records that `out_path` was completely made from `src_path`, and saves the manifest.
+        :param src_path (str): path to the source file.
+        :param out_path (str): path to the output file.
+        """
+        src_stat = os.stat(src_path)
+        entry = {
+            'source': os.path.abspath(src_path),
+            'source_size': src_stat.st_size,
+            'source_mtime_ns': src_stat.st_mtime_ns,
+            'source_md5': file_md5(src_path),
+            'output_size': os.path.getsize(out_path),
+            'params': self.params,
+        }
+        with self._lock:
+            self.outputs[self._key(out_path)] = entry
+            self._save()
+
+    def _save(self):
+        os.makedirs(self.track_dir, exist_ok=True)
+        with atomic_output(self.path) as temp_path:
+            with open(temp_path, 'w') as f:
+                json.dump({'outputs': self.outputs}, f, indent=1, sort_keys=True)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Reads the notes of a MIDI file into numpy arrays, with note times both in ticks
+# (independent of tempo) and in seconds (following the file's tempo map).
+
+import numpy as np
+import mido
+
+
+DRUM_CHANNEL = 9
+_DEFAULT_TEMPO = 500000  # microseconds per beat, i.e., 120 bpm
+
+
+def _ticks_to_seconds(ticks, tempo_ticks, tempos, ticks_per_beat):
+    """
+    Converts absolute tick times to seconds with a tempo map.
+    :param ticks (np.ndarray): absolute times in ticks.
+    :param tempo_ticks (np.ndarray): sorted absolute times (in ticks) of tempo changes, starting at 0.
+    :param tempos (np.ndarray): tempo (microseconds per beat) from each tempo change on.
+    :param ticks_per_beat (int): resolution of the file.
+    """
+    seconds_per_tick = tempos / 1e6 / ticks_per_beat
+    # Time in seconds at each tempo change
+    change_seconds = np.concatenate([[0.], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])])
+    idx = np.searchsorted(tempo_ticks, ticks, side='right') - 1
+    return change_seconds[idx] + (ticks - tempo_ticks[idx]) * seconds_per_tick[idx]
+
+
+def read_notes(path):
+    """
+    Reads every note in a MIDI file. Notes that are never turned off end at the last
+    event of their track.
+    :param path (str): path to the MIDI file.
+    :return: (dict) numpy arrays with one entry per note, sorted by onset then pitch:
+        `start_tick`, `end_tick`, `start`, `end` (in seconds), `pitch`, `velocity`,
+        `program`, `is_drum`, and `track`; plus `ticks_per_beat` (an int).
+    """
+    midi = mido.MidiFile(path, clip=True)
+    tempo_changes = {0: _DEFAULT_TEMPO}
+    notes = []  # (start_tick, end_tick, pitch, velocity, program, is_drum, track)
+
+    for track_idx, track in enumerate(midi.tracks):
+        tick = 0
+        programs = {}
+        active = {}  # (channel, pitch) -> list of (start_tick, velocity, program)
+        for msg in track:
+            tick += msg.time
+            if msg.type == 'set_tempo':
+                tempo_changes[tick] = msg.tempo
+            elif msg.type == 'program_change':
+                programs[msg.channel] = msg.program
+            elif msg.type == 'note_on' and msg.velocity > 0:
+                active.setdefault((msg.channel, msg.note), []).append(
+                    (tick, msg.velocity, programs.get(msg.channel, 0)))
+            elif msg.type in ('note_off', 'note_on'):
+                started = active.get((msg.channel, msg.note))
+                if started:
+                    start_tick, velocity, program = started.pop(0)
+                    notes.append((start_tick, tick, msg.note, velocity, program,
+                                  msg.channel == DRUM_CHANNEL, track_idx))
+
+        for (channel, pitch), started in active.items():
+            for start_tick, velocity, program in started:
+                notes.append((start_tick, tick, pitch, velocity, program,
+                              channel == DRUM_CHANNEL, track_idx))
+
+    notes.sort(key=lambda n: (n[0], n[2]))
+    columns = list(zip(*notes)) if notes else [()] * 7
+    result = {
+        'start_tick': np.array(columns[0], dtype=np.int64),
+        'end_tick': np.array(columns[1], dtype=np.int64),
+        'pitch': np.array(columns[2], dtype=np.int16),
+        'velocity': np.array(columns[3], dtype=np.int16),
+        'program': np.array(columns[4], dtype=np.int16),
+        'is_drum': np.array(columns[5], dtype=bool),
+        'track': np.array(columns[6], dtype=np.int16),
+        'ticks_per_beat': midi.ticks_per_beat,
+    }
+
+    tempo_ticks = np.array(sorted(tempo_changes), dtype=np.int64)
+    tempos = np.array([tempo_changes[t] for t in tempo_ticks], dtype=np.float64)
+    result['start'] = _ticks_to_seconds(result['start_tick'], tempo_ticks, tempos,
+                                        midi.ticks_per_beat)
+    result['end'] = _ticks_to_seconds(result['end_tick'], tempo_ticks, tempos,
+                                      midi.ticks_per_beat)
+    return result
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+# Mirrors the files that do not change between derived copies of Slakh (metadata.yaml,
+# all_src.mid, and the MIDI/ directory) without duplicating their bytes. Depending on
+# the mode, files are hardlinked, reflinked (copy-on-write clones), or symlinked, with
+# a regular copy as the fallback when the filesystem does not support the chosen mode
+# (e.g., hardlinks across devices).
+#
+# Note that hardlinked files share their contents with the source dataset. Everything in
+# this repo that updates metadata writes a new file and renames it into place, which
+# breaks the link instead of modifying the original. A mirrored file that was rewritten
+# like this (e.g., `metadata.yaml` by `loudness/renormalize.py`) is newer than its source,
+# and is kept on re-runs; it is only replaced again if the source changes after it.
+
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+
+MIRROR_MODES = ('hardlink', 'reflink', 'symlink', 'copy')
+TRACK_EXTRAS = ('metadata.yaml', 'all_src.mid', 'MIDI')
+
+_FICLONE = 0x40049409  # linux/fs.h
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError('Reflinks are not supported on this platform.')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def _is_mirrored(src, dst):
+    """
+    Determines whether `dst` is up to date with `src`: it is the same file, a symlink
+    to it, a copy with the same size and modification time, or a file that was written
+    after `src` was last modified (i.e., the mirror was intentionally rewritten).
+    """
+    if os.path.islink(dst):
+        return os.readlink(dst) == os.path.abspath(src)
+    if not os.path.isfile(dst):
+        return False
+    if os.path.samefile(src, dst):
+        return True
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    if dst_stat.st_mtime_ns > src_stat.st_mtime_ns:
+        return True
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def mirror_file(src, dst, mode='hardlink'):
+    """
+    Makes `dst` mirror the file `src`. If `dst` already mirrors `src`, or was rewritten
+    after `src` was last modified, nothing is done.
+    Otherwise the mirror is made under a temporary name and renamed over `dst`.
+    :param src (str): path to the source file.
+    :param dst (str): path to the mirrored file.
+    :param mode (str): one of `MIRROR_MODES`. If the filesystem does not support the mode,
+        the file is copied instead.
+    :return: (str) the mode that was actually used, or `None` if `dst` was already up to date.
+    """
+    if mode not in MIRROR_MODES:
+        raise ValueError(f'Unknown mirror mode \'{mode}\'. Options are: {", ".join(MIRROR_MODES)}')
+    if _is_mirrored(src, dst):
+        return None
+
+    dst_dir, basename = os.path.split(dst)
+    temp_path = os.path.join(dst_dir, f'.{basename}.mirror-{os.getpid()}-{threading.get_ident()}')
+    try:
+        try:
+            if mode == 'hardlink':
+                os.link(src, temp_path)
+            elif mode == 'reflink':
+                _reflink(src, temp_path)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(src), temp_path)
+            else:
+                shutil.copy2(src, temp_path)
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            mode = 'copy'
+            shutil.copy2(src, temp_path)
+        os.replace(temp_path, dst)
+    finally:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    return mode
+
+
+def mirror_tree(src_dir, dst_dir, mode='hardlink'):
+    """
+    Mirrors every file in `src_dir` into `dst_dir`, recursively, creating directories
+    as needed. See `mirror_file()`.
+    :param src_dir (str): source directory.
+    :param dst_dir (str): destination directory.
+    :param mode (str): one of `MIRROR_MODES`.
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    for entry in os.scandir(src_dir):
+        dst = os.path.join(dst_dir, entry.name)
+        if entry.is_dir():
+            mirror_tree(entry.path, dst, mode)
+        else:
+            mirror_file(entry.path, dst, mode)
+
+
+def mirror_track_extras(in_track_dir, out_track_dir, mode='hardlink'):
+    """
+    Mirrors the non-audio files of a track (`metadata.yaml`, `all_src.mid`, and `MIDI/`)
+    into another copy of the track. Missing files are skipped.
+    :param in_track_dir (str): source `TrackXXXXX` directory.
+    :param out_track_dir (str): destination `TrackXXXXX` directory.
+    :param mode (str): one of `MIRROR_MODES`.
+    """
+    os.makedirs(out_track_dir, exist_ok=True)
+    for name in TRACK_EXTRAS:
+        src = os.path.join(in_track_dir, name)
+        dst = os.path.join(out_track_dir, name)
+        if os.path.isdir(src):
+            mirror_tree(src, dst, mode)
+        elif os.path.isfile(src):
+            mirror_file(src, dst, mode)
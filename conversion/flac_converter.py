@@ -6,137 +6,406 @@
 # Author: Ethan Manilow
 
 import os
+import sys
 import ffmpeg
 import argparse
-import shutil
+import time
 import numpy as np
-import soundfile as sf
-import uuid
 from multiprocessing.dummy import Pool as ThreadPool
-import threading
 from distutils.util import strtobool
 
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversion.reader import audio_info, read_audio  # noqa: E402
+from common.discovery import SPLITS, find_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
+from conversion.packed import (PACKED_DTYPES, PACKED_NAME, pack_track, read_header,  # noqa: E402
+                               track_sources)
+from common.manifest import TrackManifest, atomic_output, remove_partial_outputs  # noqa: E402
+from common.mirror import MIRROR_MODES, mirror_track_extras  # noqa: E402
+
+
+def _run_ffmpeg(input_path, output_path, verbose=False):
+    """
+    Runs one ffmpeg conversion and blocks until the ffmpeg process exits.
+    :param input_path (str): full path to the input file.
+    :param output_path (str): full path to the output file. The format is
+        determined by the extension.
+    :param verbose: if `False`, ffmpeg's output is captured instead of printed.
+    :raises ffmpeg.Error: if ffmpeg exits with a nonzero status.
+    """
+    ffmpeg.input(input_path).output(output_path).run(overwrite_output=True, quiet=not verbose)
+
 
 def _wav_to_flac(input_path, output_dir, verbose=False):
     """
     Converts one file from wav to flac. Reads input wav file from disk and outputs
-    flac file with the same basename into `output_dir`
+    flac file with the same basename into `output_dir`. Blocks until the conversion is done.
     :param input_path (str): full path to wav file. Assumes ends in `.wav`
     :param output_dir (str): directory to output the converted flac file.
         The name will be `input_path` with `.wav` replaced with `.flac.`
     :param verbose:
+    :return: (str) path to the output file.
     """
     basename = os.path.splitext(os.path.basename(input_path))[0]
     output_path = os.path.join(output_dir, basename + '.flac')
-    ffmpeg.input(input_path).output(output_path).run_async(overwrite_output=not verbose)
+    with atomic_output(output_path) as temp_path:
+        _run_ffmpeg(input_path, temp_path, verbose=verbose)
+    return output_path
 
 
 def _flac_to_wav(input_path, output_dir, verbose=False):
     """
     Converts one file from flac to wav. Reads input flac file from disk and outputs
-    wav file with the same basename into `output_dir`
+    wav file with the same basename into `output_dir`. Blocks until the conversion is done.
     :param input_path (str): full path to flac file. Assumes ends in `.flac`
     :param output_dir (str): directory to output the converted wav file. The name will be
         `input_path` with `.flac` replaced with `.wav.`
     :param verbose:
+    :return: (str) path to the output file.
     """
     basename = os.path.splitext(os.path.basename(input_path))[0]
     output_path = os.path.join(output_dir, basename + '.wav')
-    ffmpeg.input(input_path).output(output_path).run_async(overwrite_output=not verbose)
+    with atomic_output(output_path) as temp_path:
+        _run_ffmpeg(input_path, temp_path, verbose=verbose)
+    return output_path
 
 
-def _make_track_subset(input_dir, start=None, end=None):
+class ConversionScheduler(object):
     """
-    Reduces list of tracks to a subset if `start` or `end` are not `None`, else returns full list of
-    track directories.
-    :param input_dir:
-    :param start:
-    :param end:
-    :return:
+    Runs ffmpeg conversion jobs with at most `n_workers` ffmpeg processes in flight.
+
+    Each worker thread starts one ffmpeg process, waits for it to exit and checks its
+    exit status before picking up the next job, so the number of encoder processes
+    never exceeds `n_workers`. Failed jobs are retried up to `retries` times, and
+    successful ones are recorded in their track's manifest (if the job has one).
+    Every file is timed (ffmpeg decodes, encodes, and writes in one `encode` stage) and
+    reported to `tracer`, if there is one.
     """
-    track_directories = sorted([os.path.join(input_dir, d)
-                                for d in os.listdir(input_dir)
-                                if os.path.isdir(os.path.join(input_dir, d))])
-
-    if start is not None and end is not None:
-        track_directories = track_directories[start-1:end-1]
-    elif start is not None:
-        track_directories = track_directories[start-1:]
-    elif end is not None:
-        track_directories = track_directories[:end-1]
 
-    return track_directories
+    def __init__(self, ffmpeg_func, n_workers=1, retries=2, verbose=False, tracer=None):
+        """
+        :param ffmpeg_func: one of `_wav_to_flac` or `_flac_to_wav`.
+        :param n_workers (int): number of ffmpeg processes to keep in flight.
+        :param retries (int): number of times to retry a failed conversion.
+        :param verbose: display ffmpeg output and per-file throughput.
+        :param tracer (Tracer): where to report the time spent on each file, see
+            `common/instrument.py`.
+        """
+        if n_workers < 1:
+            raise ValueError(f'Need at least one worker, got {n_workers}.')
+        self.ffmpeg_func = ffmpeg_func
+        self.n_workers = n_workers
+        self.retries = retries
+        self.verbose = verbose
+        self.tracer = tracer
+
+    def _convert(self, job):
+        input_path, output_dir, manifest = job
+        in_bytes = os.path.getsize(input_path)
+        timer = StageTimer(input_path)
+        error = None
+        start = time.perf_counter()
+        for attempt in range(1, self.retries + 2):
+            try:
+                with timer.stage('encode'):
+                    output_path = self.ffmpeg_func(input_path, output_dir, verbose=self.verbose)
+            except (ffmpeg.Error, OSError) as e:
+                error = e
+                continue
+
+            with timer.stage('write'):
+                if manifest is not None:
+                    manifest.record(input_path, output_path)
+            timer.count(files=1, bytes_in=in_bytes, bytes_out=os.path.getsize(output_path))
+            try:
+                sr, frames, _ = audio_info(input_path)
+                timer.count(audio_seconds=frames / sr)
+            except RuntimeError:
+                pass  # Not a format soundfile can read, so the duration is unknown
+            if self.tracer is not None:
+                self.tracer.record(timer)
+
+            seconds = time.perf_counter() - start
+            if self.verbose:
+                print(f'Converted {input_path} in {seconds:.2f}s '
+                      f'({in_bytes / 1e6 / max(seconds, 1e-9):.2f} MB/s, attempt {attempt})')
+            return input_path, True, in_bytes, seconds, attempt
+
+        stderr = getattr(error, 'stderr', None)
+        reason = stderr.decode(errors='replace').strip().splitlines()[-1] if stderr else error
+        print(f'Failed to convert {input_path} after {self.retries + 1} attempts: {reason}')
+        if self.tracer is not None:
+            self.tracer.record(timer)
+        return input_path, False, in_bytes, time.perf_counter() - start, self.retries + 1
+
+    def run(self, jobs):
+        """
+        Converts every job and waits until all of them are done.
+        :param jobs: iterable of (input_path, output_dir, manifest) tuples, where `manifest`
+            is a `TrackManifest` or `None`. Can be a generator, in which case jobs are
+            started while the rest are still being generated.
+        :return: (dict) aggregate statistics about the conversion run, including a list of
+            input files that failed to convert under the key `failed`.
+        """
+        pool = ThreadPool(self.n_workers)
+        start = time.perf_counter()
+        n_files, n_bytes, failed = 0, 0, []
+        try:
+            for input_path, ok, in_bytes, _, _ in pool.imap_unordered(self._convert, jobs):
+                if ok:
+                    n_files += 1
+                    n_bytes += in_bytes
+                else:
+                    failed.append(input_path)
+        finally:
+            pool.close()
+            pool.join()
+
+        seconds = time.perf_counter() - start
+        stats = {
+            'files': n_files,
+            'failed': failed,
+            'megabytes': n_bytes / 1e6,
+            'seconds': seconds,
+            'files_per_second': n_files / max(seconds, 1e-9),
+            'megabytes_per_second': n_bytes / 1e6 / max(seconds, 1e-9),
+        }
+        print(f'Converted {n_files} files ({stats["megabytes"]:.1f} MB) in {seconds:.1f}s: '
+              f'{stats["files_per_second"]:.2f} files/s, '
+              f'{stats["megabytes_per_second"]:.2f} MB/s, {len(failed)} failed.')
+        return stats
+
+
+def _make_track_subset(input_dir, start=None, end=None, splits=None, track_ids=None):
+    """
+    Finds the tracks to convert (see `common/discovery.py`), optionally only a subset of them.
+    :param input_dir: (str) base directory of Slakh (flat, or with split subdirectories)
+    :param start: (int) lowest Track ID to convert (e.g., 1 for Track00001), inclusive
+    :param end: (int) highest Track ID to convert, inclusive
+    :param splits: (list) only convert tracks in these split directories
+    :param track_ids: (list) only convert these tracks
+    :return: (list) `TrackDir`s of the tracks to convert
+    """
+    return find_tracks(input_dir, start, end, splits, track_ids)
 
 
-def _convert_folder(in_track_dir, mix_name, output_base_dir, ffmpeg_func, verbose=False):
-    track_dir_basename = os.path.basename(in_track_dir)
+def _convert_folder(in_track_dir, mix_name, out_track_dir, out_ext, mirror_mode='hardlink',
+                    timer=None):
+    """
+    Sets up the output directory for one track, mirrors the files that do not need
+    converting (see `common/mirror.py`), and returns the conversion jobs for the mix and
+    each of the stems.
+    Files that are already converted and up to date according to the track's manifest are
+    skipped, as is the whole track if nothing in it needs converting.
+    :param timer: (StageTimer) optional timer of the `discover` and `copy_metadata` stages.
+    :return: (list) of (input_path, output_dir, manifest) tuples.
+    """
+    timer = timer if timer is not None else StageTimer(in_track_dir)
     in_mix_path = os.path.join(in_track_dir, mix_name)
-    out_track_dir = os.path.join(output_base_dir, track_dir_basename)
     out_stems_dir = os.path.join(out_track_dir, 'stems')
-    os.makedirs(out_stems_dir, exist_ok=True)
+    manifest = TrackManifest(out_track_dir, {'format': out_ext})
 
-    shutil.copy(os.path.join(in_track_dir, 'metadata.yaml'),
-                os.path.join(out_track_dir, 'metadata.yaml'))
-    shutil.copy(os.path.join(in_track_dir, 'all_src.mid'),
-                os.path.join(out_track_dir, 'all_src.mid'))
-    shutil.copytree(os.path.join(in_track_dir, 'MIDI'),
-                    os.path.join(out_track_dir, 'MIDI'))
+    def _out_path(in_path, out_dir):
+        return os.path.join(out_dir, os.path.splitext(os.path.basename(in_path))[0] + out_ext)
 
-    ffmpeg_func(in_mix_path, out_track_dir)
+    with timer.stage('discover'):
+        jobs = [(in_mix_path, out_track_dir)]
+        in_stems_dir = os.path.join(in_track_dir, 'stems')
+        for src in sorted(os.listdir(in_stems_dir)):
+            jobs.append((os.path.join(in_stems_dir, src), out_stems_dir))
+        jobs = [(in_path, out_dir, manifest) for in_path, out_dir in jobs
+                if not manifest.is_current(in_path, _out_path(in_path, out_dir))]
+    if not jobs:
+        return jobs
 
-    in_stems_dir = os.path.join(in_track_dir, 'stems')
-    for src in os.listdir(in_stems_dir):
-        src_path = os.path.join(in_stems_dir, src)
-        ffmpeg_func(src_path, out_stems_dir, verbose=verbose)
+    with timer.stage('copy_metadata'):
+        os.makedirs(out_stems_dir, exist_ok=True)
+        remove_partial_outputs(out_track_dir)
+        remove_partial_outputs(out_stems_dir)
+        mirror_track_extras(in_track_dir, out_track_dir, mirror_mode)
+    return jobs
 
 
 def _apply_ffmpeg(base_dir, output_dir, compress=True, start=None, end=None, n_threads=1,
-                  verbose=False):
+                  verbose=False, retries=2, mirror_mode='hardlink', trace_path=None,
+                  progress=False, splits=None, track_ids=None):
 
     if compress:
         ffmpeg_func = _wav_to_flac
         mix_name = 'mix.wav'
+        out_ext = '.flac'
     else:
         ffmpeg_func = _flac_to_wav
         mix_name = 'mix.flac'
-
-    track_directories = _make_track_subset(base_dir, start, end)
-    pool = ThreadPool(n_threads)
-
-    # Make a closure because mix_name, output_dir, and ffmpeg_func are unchanging at this point
-    def _apply_convert_dir(in_track_dir):
-        _convert_folder(in_track_dir, mix_name, output_dir,
-                        ffmpeg_func, verbose=verbose)
-
-    pool.map(_apply_convert_dir, track_directories)
-
-
-def to_flac(base_dir, output_dir, start=None, end=None, n_threads=1, verbose=False):
+        out_ext = '.wav'
+
+    tracks = _make_track_subset(base_dir, start, end, splits, track_ids)
+    tracer = Tracer('flac_converter', unit='files', trace_path=trace_path, progress=progress)
+
+    # Jobs are generated lazily, so conversion starts as soon as the first track is set up.
+    # Until every track is set up, the total number of files is estimated for the ETA.
+    def _jobs():
+        n_jobs = 0
+        for i, track in enumerate(tracks):
+            timer = StageTimer(track.track_id)
+            # The output keeps the split layout of the input
+            jobs = _convert_folder(track.path, mix_name,
+                                   os.path.join(output_dir, track.relative_path), out_ext,
+                                   mirror_mode, timer)
+            n_jobs += len(jobs)
+            tracer.total = round(n_jobs * len(tracks) / (i + 1))
+            tracer.record(timer, done=0)
+            yield from jobs
+
+    scheduler = ConversionScheduler(ffmpeg_func, n_workers=n_threads, retries=retries,
+                                    verbose=verbose, tracer=tracer)
+    with tracer:
+        return scheduler.run(_jobs())
+
+
+def to_flac(base_dir, output_dir, start=None, end=None, n_threads=1, verbose=False, retries=2,
+            mirror_mode='hardlink', trace_path=None, progress=False, splits=None,
+            track_ids=None):
     """
     Convert all wav files in all folders (or a subset thereof) to flac files.
     :param base_dir: (str) path to dataset with uncompressed files
     :param output_dir: (str) new location for compressed dataset
-    :param start: (int) index/id of the starting folder to compress
-    :param end: (int) index/id of the end folder to compress
-    :param n_threads: (int) number of threads to spawn for this task
+    :param start: (int) lowest Track ID to compress (e.g., 1 for Track00001), inclusive
+    :param end: (int) highest Track ID to compress, inclusive
+    :param n_threads: (int) number of ffmpeg processes to run at once
     :param verbose: (str) display ffmpeg output
+    :param retries: (int) number of times to retry a file that fails to convert
+    :param mirror_mode: (str) how to mirror the non-audio files, see `common/mirror.py`
+    :param trace_path: (str) path of a JSON-lines file to write per-file timings to, see
+        `common/instrument.py`
+    :param progress: (bool) show a progress line with an ETA
+    :param splits: (list) only convert tracks in these split directories (e.g., ['train'])
+    :param track_ids: (list) only convert these tracks (e.g., ['Track00001'])
+    :return: (dict) aggregate statistics about the conversion, see `ConversionScheduler.run()`
     """
-    _apply_ffmpeg(base_dir, output_dir, compress=True, start=start, end=end,
-                  n_threads=n_threads, verbose=verbose)
+    return _apply_ffmpeg(base_dir, output_dir, compress=True, start=start, end=end,
+                         n_threads=n_threads, verbose=verbose, retries=retries,
+                         mirror_mode=mirror_mode, trace_path=trace_path, progress=progress,
+                         splits=splits, track_ids=track_ids)
 
 
-def to_wav(base_dir, output_dir, start=None, end=None, n_threads=1, verbose=False):
+def to_wav(base_dir, output_dir, start=None, end=None, n_threads=1, verbose=False, retries=2,
+           mirror_mode='hardlink', trace_path=None, progress=False, splits=None,
+           track_ids=None):
     """
     Convert all flac files in all folders (or a subset thereof) to wav files.
     :param base_dir: (str) path to dataset with compressed files
     :param output_dir: (str) new location for uncompressed dataset
-    :param start: (int) index/id of the starting folder to decompress
-    :param end: (int) index/id of the end folder to decompress
-    :param n_threads: (int) number of threads to spawn for this task
+    :param start: (int) lowest Track ID to decompress (e.g., 1 for Track00001), inclusive
+    :param end: (int) highest Track ID to decompress, inclusive
+    :param n_threads: (int) number of ffmpeg processes to run at once
     :param verbose: (str) display ffmpeg output
+    :param retries: (int) number of times to retry a file that fails to convert
+    :param mirror_mode: (str) how to mirror the non-audio files, see `common/mirror.py`
+    :param trace_path: (str) path of a JSON-lines file to write per-file timings to, see
+        `common/instrument.py`
+    :param progress: (bool) show a progress line with an ETA
+    :param splits: (list) only convert tracks in these split directories (e.g., ['train'])
+    :param track_ids: (list) only convert these tracks (e.g., ['Track00001'])
+    :return: (dict) aggregate statistics about the conversion, see `ConversionScheduler.run()`
     """
-    _apply_ffmpeg(base_dir, output_dir, compress=False, start=start, end=end,
-                  n_threads=n_threads, verbose=verbose)
+    return _apply_ffmpeg(base_dir, output_dir, compress=False, start=start, end=end,
+                         n_threads=n_threads, verbose=verbose, retries=retries,
+                         mirror_mode=mirror_mode, trace_path=trace_path, progress=progress,
+                         splits=splits, track_ids=track_ids)
+
+
+def _pack_folder(job):
+    """
+    Packs the audio of one track into a single file (see `conversion/packed.py`), unless
+    the track's manifest says the packed file is up to date, and mirrors the files that
+    are not audio.
+    :return: (str, bool, StageTimer) track id, whether the track was packed, and the time
+        spent on each stage.
+    """
+    track, out_track_dir, dtype, mirror_mode = job
+    timer = StageTimer(track.track_id)
+    out_path = os.path.join(out_track_dir, PACKED_NAME)
+
+    with timer.stage('discover'):
+        names, paths = track_sources(track.path)
+        # Any change to any source makes the packed file out of date
+        sources = {}
+        for name, path in zip(names, paths):
+            stat = os.stat(path)
+            sources[name] = [stat.st_size, stat.st_mtime_ns]
+        manifest = TrackManifest(out_track_dir, {'format': PACKED_NAME, 'dtype': dtype,
+                                                 'sources': sources})
+        if manifest.is_current(paths[0], out_path):
+            return track.track_id, False, timer
+
+    with timer.stage('copy_metadata'):
+        os.makedirs(out_track_dir, exist_ok=True)
+        remove_partial_outputs(out_track_dir)
+        mirror_track_extras(track.path, out_track_dir, mirror_mode)
+
+    pack_track(track.path, out_path, dtype, timer=timer)
+    with timer.stage('write'):
+        manifest.record(paths[0], out_path)
+    timer.count(files=len(paths), bytes_in=sum(s[0] for s in sources.values()),
+                bytes_out=os.path.getsize(out_path))
+    header = read_header(out_path)
+    timer.count(audio_seconds=len(paths) * header['n_frames'] / header['sr'])
+    return track.track_id, True, timer
+
+
+def to_packed(base_dir, output_dir, start=None, end=None, n_threads=1, dtype='int16',
+              mirror_mode='hardlink', trace_path=None, progress=False, splits=None,
+              track_ids=None):
+    """
+    Packs the mix and stems of every track (or a subset thereof) into one memory-mappable
+    file per track, `TrackXXXXX/audio.slakhpack`, see `conversion/packed.py`.
+    :param base_dir: (str) path to dataset with .flac or .wav files
+    :param output_dir: (str) new location for the packed dataset
+    :param start: (int) lowest Track ID to pack (e.g., 1 for Track00001), inclusive
+    :param end: (int) highest Track ID to pack, inclusive
+    :param n_threads: (int) number of tracks to pack at once
+    :param dtype: (str) 'int16' (lossless for Slakh) or 'float16'
+    :param mirror_mode: (str) how to mirror the non-audio files, see `common/mirror.py`
+    :param trace_path: (str) path of a JSON-lines file to write per-track timings to, see
+        `common/instrument.py`
+    :param progress: (bool) show a progress line with an ETA
+    :param splits: (list) only pack tracks in these split directories (e.g., ['train'])
+    :param track_ids: (list) only pack these tracks (e.g., ['Track00001'])
+    :return: (dict) aggregate statistics about the run, with a list of the tracks that
+        failed to pack under the key `failed`.
+    """
+    if dtype not in PACKED_DTYPES:
+        raise ValueError(f'Cannot pack audio as \'{dtype}\'. Options are: {", ".join(PACKED_DTYPES)}')
+    timer = StageTimer('discover')
+    with timer.stage('discover'):
+        tracks = _make_track_subset(base_dir, start, end, splits, track_ids)
+    jobs = [(t, os.path.join(output_dir, t.relative_path), dtype, mirror_mode) for t in tracks]
+
+    def _pack(job):
+        try:
+            return _pack_folder(job)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f'Failed to pack {job[0].path}: {e}')
+            return job[0].track_id, None, None
+
+    start_time = time.perf_counter()
+    n_packed, failed = 0, []
+    with Tracer('pack', total=len(jobs), trace_path=trace_path, progress=progress) as tracer, \
+            ThreadPool(n_threads) as pool:
+        tracer.record(timer, done=0)
+        for track_id, packed, timer in pool.imap_unordered(_pack, jobs):
+            tracer.record(timer)
+            if packed is None:
+                failed.append(track_id)
+            elif packed:
+                n_packed += 1
+
+    seconds = time.perf_counter() - start_time
+    print(f'Packed {n_packed} tracks in {seconds:.1f}s ({len(jobs) - n_packed - len(failed)} '
+          f'up to date), {len(failed)} failed.')
+    return {'tracks': n_packed, 'failed': failed, 'seconds': seconds}
 
 
 def _read_flac_to_numpy2(filename, aformat='s16be', sr=44100):
@@ -161,25 +430,17 @@ def _read_flac_to_numpy2(filename, aformat='s16be', sr=44100):
     return np.frombuffer(out)
 
 
-def read_flac_to_numpy(filename):
+def read_flac_to_numpy(filename, offset=0, length=None, dtype='float64'):
     """
-    Reads a single flac file to memory as a numpy array.
-    Converts the flac file to uniquely named temp wav using ffmpeg, then reads that into memory
-    and deletes the temp file.
+    Reads a single flac file (or an excerpt of it) to memory as a numpy array.
+    The flac file is decoded in-process, see `conversion/reader.py` for more options.
     :param filename: (str) path to the flac file to read
+    :param offset: (int) first frame to read
+    :param length: (int) number of frames to read, if `None` reads to the end of the file
+    :param dtype: (str) data type of the output, one of 'int16', 'int32', 'float32', 'float64'
     :return: (np.ndarray, int) numpy array of the data and sample rate, respectively.
     """
-    try:
-        thread_id = threading.get_ident()
-    except:
-        thread_id = threading.current_thread().ident
-
-    # this file temp_name is unique AF
-    temp_name = '{}_{}_{}.wav'.format(str(uuid.uuid4()), os.getpid(), thread_id)
-    ffmpeg.input(filename).output(temp_name).run()
-    wav, sr = sf.read(temp_name)
-    os.remove(temp_name)
-    return wav, sr
+    return read_audio(filename, offset=offset, length=length, dtype=dtype)
 
 
 if __name__ == '__main__':
@@ -189,19 +450,52 @@ if __name__ == '__main__':
                         help='Base path to input directory. (Required)')
     parser.add_argument('--output-dir', '-o', type=str, required=True,
                         help='Base path to output directory. (Required)')
-    parser.add_argument('--compress', '-c', type=lambda x:bool(strtobool(x)), required=True,
+    parser.add_argument('--compress', '-c', type=lambda x:bool(strtobool(x)), required=False,
                         help='If true, will convert from .wav to .flac, else'
-                             'will convert from .flac to .wav. (Required)')
+                             'will convert from .flac to .wav. (Required unless --packed)')
+    parser.add_argument('--packed', '-p', type=str, default=None, required=False,
+                        choices=PACKED_DTYPES,
+                        help='Instead of converting, pack the audio of each track into one '
+                             'memory-mappable file of this data type. (Optional)')
     parser.add_argument('--start', '-s', type=int, default=None, required=False,
                         help='If converting a subset, the lowest Track ID. (Optional)')
     parser.add_argument('--end', '-e', type=int, default=None, required=False,
-                        help='If converting a subset, the highest Track ID. (Optional)')
+                        help='If converting a subset, the highest Track ID (inclusive). '
+                             '(Optional)')
+    parser.add_argument('--split', type=str, nargs='+', default=None, required=False,
+                        choices=SPLITS,
+                        help='If converting a subset, only the tracks in these split '
+                             'directories. (Optional)')
+    parser.add_argument('--tracks', type=str, nargs='+', default=None, required=False,
+                        help='If converting a subset, only these Track IDs. (Optional)')
     parser.add_argument('--num-threads', '-t', type=int, default=1, required=False,
-                        help='Number of threads to spawn to convert. (Optional)')
+                        help='Number of ffmpeg processes to run at once. (Optional)')
+    parser.add_argument('--retries', '-r', type=int, default=2, required=False,
+                        help='Number of times to retry a file that fails to convert. (Optional)')
+    parser.add_argument('--mirror-mode', '-m', type=str, default='hardlink', required=False,
+                        choices=MIRROR_MODES,
+                        help='How to mirror metadata and MIDI files into the output. Falls back '
+                             'to copying if the file system does not support it. (Optional)')
+    parser.add_argument('--trace', type=str, default=None, required=False,
+                        help='Path of a JSON-lines file to write the time spent on each file '
+                             'and track to. (Optional)')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Do not show the progress line. (Optional)')
     parser.add_argument('--verbose', '-v', type=lambda x:bool(strtobool(x)), default=False,
                         required=False,
                         help='Whether to print messages while processing. (Optional)')
 
     args = parser.parse_args()
-    _apply_ffmpeg(args.input_dir, args.output_dir, args.compress, args.start,
-                  args.end, args.num_threads, args.verbose)
+    if args.packed is not None:
+        stats = to_packed(args.input_dir, args.output_dir, args.start, args.end, args.num_threads,
+                          args.packed, args.mirror_mode, args.trace, not args.no_progress,
+                          args.split, args.tracks)
+        sys.exit(1 if stats['failed'] else 0)
+    if args.compress is None:
+        parser.error('the following arguments are required: --compress/-c')
+    stats = _apply_ffmpeg(args.input_dir, args.output_dir, args.compress, args.start,
+                          args.end, args.num_threads, args.verbose, args.retries,
+                          args.mirror_mode, args.trace, not args.no_progress, args.split,
+                          args.tracks)
+    if stats['failed']:
+        sys.exit(1)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# A packed, memory-mappable container for the audio of one Slakh track. The mix and all
+# of the stems are stored together in one file as a single (n_frames, n_sources) array of
+# int16 or float16 samples, so an excerpt of every source is one contiguous range of the
+# file. Readers `np.memmap` the file and get excerpts as views into the page cache, with no
+# decoding, no copying, and one open file per track.
+#
+# File layout:
+#   magic (8 bytes) | header length (uint32, little endian) | header (json) | zero padding
+#   | samples, frame-major, starting at `data_offset` (a multiple of 4096)
+#
+# See the README about how to use.
+
+import os
+import json
+import struct
+from contextlib import ExitStack
+
+import numpy as np
+import soundfile as sf
+
+from common.instrument import StageTimer
+from common.manifest import atomic_output
+
+
+PACKED_NAME = 'audio.slakhpack'
+PACKED_DTYPES = ('int16', 'float16')
+MAGIC = b'SLAKHPK1'
+VERSION = 1
+_ALIGNMENT = 4096
+_PREFIX = struct.Struct('<8sI')
+
+
+def _file_dtype(dtype):
+    # Samples are always stored little endian
+    return np.dtype(dtype).newbyteorder('<')
+
+
+def track_sources(track_dir, ext=None, stems_dir='stems', mix_name='mix'):
+    """
+    Finds the audio of a track, in the order it is packed in.
+    :param track_dir (str): path to a `TrackXXXXX` directory.
+    :param ext (str): file extension of the audio. If `None`, '.flac' if the track has a
+        .flac mix, else '.wav'.
+    :return: (list, list) source names (the mix, then the stems sorted by name) and their
+        audio file paths.
+    """
+    if ext is None:
+        ext = '.flac' if os.path.isfile(os.path.join(track_dir, mix_name + '.flac')) else '.wav'
+    in_stems_dir = os.path.join(track_dir, stems_dir)
+    stem_names = sorted(os.path.splitext(s)[0] for s in os.listdir(in_stems_dir)
+                        if os.path.splitext(s)[1] == ext and not s.startswith('.'))
+    names = [mix_name] + stem_names
+    paths = [os.path.join(track_dir, mix_name + ext)] + \
+            [os.path.join(in_stems_dir, s + ext) for s in stem_names]
+    return names, paths
+
+
+def pack_track(track_dir, out_path, dtype='int16', block_size=2 ** 18, ext=None, timer=None):
+    """
+    Packs the mix and stems of a track into one file. Stems that are shorter than the
+    longest source are zero-padded. The file is written under a temporary name and
+    renamed when complete.
+    :param track_dir (str): path to a `TrackXXXXX` directory with mono audio.
+    :param out_path (str): path of the packed file to write.
+    :param dtype (str): one of `PACKED_DTYPES`. 'int16' is lossless for 16-bit audio
+        (e.g., Slakh); float16 keeps about 11 bits of precision over a larger range.
+    :param block_size (int): number of frames to read and write at once.
+    :param ext (str): file extension of the audio. If `None`, '.flac' if the track has a
+        .flac mix, else '.wav'.
+    :param timer (StageTimer): optional timer of the `decode` and `write` stages, see
+        `common/instrument.py`.
+    :return: (list) names of the packed sources, in column order.
+    """
+    if dtype not in PACKED_DTYPES:
+        raise ValueError(f'Cannot pack audio as \'{dtype}\'. Options are: {", ".join(PACKED_DTYPES)}')
+    timer = timer if timer is not None else StageTimer(track_dir)
+    names, paths = track_sources(track_dir, ext)
+    read_dtype = 'int16' if dtype == 'int16' else 'float32'
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(sf.SoundFile(p)) for p in paths]
+        sr = files[0].samplerate
+        for path, f in zip(paths, files):
+            if f.channels != 1:
+                raise ValueError(f'Expected mono audio, but {path} has {f.channels} channels.')
+            if f.samplerate != sr:
+                raise ValueError(f'Sample rate mismatch in {track_dir}: {path} is '
+                                 f'{f.samplerate}Hz, expected {sr}Hz.')
+        n_frames = max(f.frames for f in files)
+
+        header = json.dumps({'version': VERSION, 'sr': sr, 'n_frames': n_frames, 'dtype': dtype,
+                             'sources': names}).encode()
+        data_offset = -(-(_PREFIX.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+        temp_path = stack.enter_context(atomic_output(out_path))
+        with open(temp_path, 'wb') as out:
+            out.write(_PREFIX.pack(MAGIC, len(header)) + header)
+            out.truncate(data_offset + n_frames * len(names) * np.dtype(dtype).itemsize)
+        if n_frames == 0:
+            return names
+        data = np.memmap(temp_path, dtype=_file_dtype(dtype), mode='r+', offset=data_offset,
+                         shape=(n_frames, len(names)))
+
+        block = np.zeros((block_size, len(names)), dtype=dtype)
+        column = np.empty(block_size, dtype=read_dtype)
+        for start in range(0, n_frames, block_size):
+            n = min(block_size, n_frames - start)
+            with timer.stage('decode'):
+                for i, f in enumerate(files):
+                    read = f.read(n, dtype=read_dtype, out=column[:n])
+                    block[:len(read), i] = read
+                    block[len(read):n, i] = 0
+            with timer.stage('write'):
+                data[start:start + n] = block[:n]
+        with timer.stage('write'):
+            data.flush()
+            del data
+    return names
+
+
+def read_header(path):
+    """
+    Reads the header of a packed file.
+    :param path (str): path to the packed file.
+    :return: (dict) `sr`, `n_frames`, `dtype`, `sources` (names, in column order), and
+        `data_offset`.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ValueError(f'{path} is not a packed Slakh track.')
+        magic, header_length = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a packed Slakh track.')
+        header = json.loads(f.read(header_length).decode())
+    if header.get('version') != VERSION:
+        raise ValueError(f'{path} has unsupported version {header.get("version")}.')
+    header['data_offset'] = -(-(_PREFIX.size + header_length) // _ALIGNMENT) * _ALIGNMENT
+    return header
+
+
+class PackedTrack(object):
+    """
+    Read-only, memory-mapped access to a packed track (see `pack_track()`). Excerpts are
+    views into the mapped file, so getting one does not read or copy anything until the
+    samples are used. Safe to share between threads, and cheap to open in every worker
+    process of a data loader.
+
+    >>> track = PackedTrack('Track00001/audio.slakhpack')
+    >>> excerpt = track.excerpt(offset=10 * track.sr, length=5 * track.sr)  # (n_sources, length)
+    >>> mix = excerpt[track.index('mix')]
+    """
+
+    def __init__(self, path):
+        """
+        :param path (str): path to the packed file.
+        """
+        header = read_header(path)
+        self.path = path
+        self.sr = header['sr']
+        self.n_frames = header['n_frames']
+        self.dtype = _file_dtype(header['dtype'])
+        self.sources = list(header['sources'])
+        self._columns = {name: i for i, name in enumerate(self.sources)}
+        if self.n_frames:
+            self.data = np.memmap(path, dtype=self.dtype, mode='r', offset=header['data_offset'],
+                                  shape=(self.n_frames, len(self.sources)))
+        else:
+            self.data = np.zeros((0, len(self.sources)), dtype=self.dtype)
+
+    def __len__(self):
+        return self.n_frames
+
+    def index(self, name):
+        """
+        :return: (int) row of source `name` (e.g., 'mix' or 'S00') in excerpts.
+        """
+        return self._columns[name]
+
+    def excerpt(self, offset=0, length=None, sources=None):
+        """
+        Gets an excerpt of the track.
+        :param offset (int): first frame of the excerpt.
+        :param length (int): number of frames in the excerpt. If `None`, goes to the end of
+            the track. The excerpt must fit within the track.
+        :param sources (list): names of the sources to get, e.g., ['mix', 'S00']. If `None`,
+            gets every source (see `sources`) as a view, without copying. Otherwise the
+            rows are gathered into a new array.
+        :return: (np.ndarray) array of shape (n_sources, length), in the packed dtype.
+        """
+        if length is None:
+            length = self.n_frames - offset
+        if offset < 0 or length < 0 or offset + length > self.n_frames:
+            raise ValueError(f'Excerpt [{offset}, {offset + length}) is outside of {self.path} '
+                             f'({self.n_frames} frames).')
+        view = self.data[offset:offset + length].T
+        if sources is None:
+            return view
+        return view[[self._columns[s] for s in sources]]
+
+    def read(self, offset=0, length=None, sources=None, dtype='float32', out=None):
+        """
+        Reads an excerpt into a new (or preallocated) array. int16 samples are scaled to
+        [-1, 1) when read as floats, like `soundfile` does. Frames past the end of the track
+        are zero-padded.
+        :param dtype (str): a float type, or the packed dtype to read samples as they are.
+        :param out (np.ndarray): optional preallocated (n_sources, length) array to read into.
+        :return: (np.ndarray) array of shape (n_sources, length).
+        """
+        dtype = np.dtype(dtype if out is None else out.dtype)
+        if dtype.kind != 'f' and dtype != self.dtype:
+            raise ValueError(f'Cannot read {self.path} as \'{dtype.name}\', only as floats or '
+                             f'as \'{self.dtype.name}\'.')
+        sources = self.sources if sources is None else sources
+        if length is None:
+            length = max(0, self.n_frames - offset)
+        if out is None:
+            out = np.empty((len(sources), length), dtype=dtype)
+        n = max(0, min(length, self.n_frames - offset))
+        out[:, n:] = 0
+        if n == 0:
+            return out
+        view = self.excerpt(offset, n)
+        scale = 1. / 32768 if self.dtype == np.int16 and dtype.kind == 'f' else 1
+        for i, name in enumerate(sources):
+            np.multiply(view[self._columns[name]], scale, out=out[i, :n], casting='unsafe')
+        return out
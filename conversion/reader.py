@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# In-process, seekable readers for Slakh audio. FLAC (and wav) files are decoded
+# directly by libsndfile through `soundfile`, so no temp files and no ffmpeg
+# subprocesses are involved. Excerpts are read by seeking, so only the requested
+# frames get decoded.
+
+import os
+
+import numpy as np
+import soundfile as sf
+
+
+SUPPORTED_DTYPES = ('int16', 'int32', 'float32', 'float64')
+
+
+def _check_dtype(dtype):
+    dtype = np.dtype(dtype).name
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f'Cannot read audio as \'{dtype}\'. '
+                         f'Options are: {", ".join(SUPPORTED_DTYPES)}')
+    return dtype
+
+
+def audio_info(path):
+    """
+    Gets the sample rate, number of frames, and number of channels of an audio file
+    without decoding any audio.
+    :param path (str): path to the audio file.
+    :return: (int, int, int) sample rate, number of frames, and number of channels.
+    """
+    info = sf.info(path)
+    return info.samplerate, info.frames, info.channels
+
+
+def read_audio(path, offset=0, length=None, dtype='float32', out=None):
+    """
+    Reads a whole audio file, or an excerpt of it, into a numpy array. The file is
+    decoded in-process and seeked to `offset`, so reading a short excerpt of a long
+    file only decodes the requested frames.
+
+    Mono files are returned as 1-D arrays, multichannel files as
+    (n_frames, n_channels) arrays. If the excerpt extends past the end of the file,
+    the remainder is filled with zeros so that the output always has `length` frames.
+    :param path (str): path to the audio file (.flac or .wav).
+    :param offset (int): first frame of the excerpt.
+    :param length (int): number of frames in the excerpt. If `None`, reads to the end of the file.
+    :param dtype (str): one of `SUPPORTED_DTYPES`. Integer types are not rescaled, i.e.,
+        16-bit audio read as 'int16' is returned as is.
+    :param out (np.ndarray): optional preallocated array to read into.
+    :return: (np.ndarray, int) audio data and sample rate, respectively.
+    """
+    dtype = _check_dtype(dtype)
+    with sf.SoundFile(path, 'r') as f:
+        if offset < 0 or offset > f.frames:
+            raise ValueError(f'Offset {offset} is outside of {path} ({f.frames} frames).')
+        if length is None:
+            length = f.frames - offset
+        f.seek(offset)
+        data = f.read(length, dtype=dtype, always_2d=False, fill_value=0, out=out)
+        return data, f.samplerate
+
+
+def read_track_stems(track_dir, stem_names=None, offset=0, length=None, dtype='float32',
+                     out=None, stems_dir='stems', ext='.flac'):
+    """
+    Reads all (or a subset of) the stems of a track into one preallocated 2-D array
+    of shape (n_stems, length). All stems are assumed to be mono, as they are in Slakh.
+    Stems shorter than the requested excerpt are zero-padded.
+    :param track_dir (str): path to a `TrackXXXXX` directory.
+    :param stem_names (list): stem names without extension (e.g., ['S00', 'S03']). If `None`,
+        reads every stem in the `stems` directory, sorted by name.
+    :param offset (int): first frame of the excerpt. Must not be negative.
+    :param length (int): number of frames in the excerpt. If `None`, uses the length of the
+        longest requested stem minus `offset`.
+    :param dtype (str): one of `SUPPORTED_DTYPES`.
+    :param out (np.ndarray): optional preallocated (n_stems, length) C-contiguous array to
+        read into, e.g., to reuse a buffer across calls.
+    :param stems_dir (str): name of the directory holding the stems within `track_dir`.
+    :param ext (str): file extension of the stems.
+    :return: (np.ndarray, list, int) stem audio, stem names (row order), and sample rate.
+    """
+    dtype = _check_dtype(dtype)
+    if offset < 0:
+        raise ValueError(f'Excerpt of {track_dir} starts before the track does (offset {offset}).')
+    in_stems_dir = os.path.join(track_dir, stems_dir)
+    if stem_names is None:
+        stem_names = sorted(os.path.splitext(s)[0] for s in os.listdir(in_stems_dir)
+                            if os.path.splitext(s)[1] == ext)
+    paths = [os.path.join(in_stems_dir, s + ext) for s in stem_names]
+
+    if length is None:
+        length = max(0, max(audio_info(p)[1] for p in paths) - offset)
+
+    if out is None:
+        out = np.empty((len(paths), length), dtype=dtype)
+    elif out.shape != (len(paths), length) or out.dtype != np.dtype(dtype):
+        raise ValueError(f'Expected `out` with shape {(len(paths), length)} and dtype {dtype}, '
+                         f'got {out.shape} and {out.dtype}.')
+
+    sr = None
+    for i, path in enumerate(paths):
+        with sf.SoundFile(path, 'r') as f:
+            if f.channels != 1:
+                raise ValueError(f'Expected mono stems, but {path} has {f.channels} channels.')
+            if sr is None:
+                sr = f.samplerate
+            elif f.samplerate != sr:
+                raise ValueError(f'Sample rate mismatch in {track_dir}: {path} is '
+                                 f'{f.samplerate}Hz, expected {sr}Hz.')
+            if offset >= f.frames:
+                out[i] = 0
+                continue
+            f.seek(offset)
+            f.read(length, dtype=dtype, always_2d=False, fill_value=0, out=out[i])
+
+    return out, list(stem_names), sr
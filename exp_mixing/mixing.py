@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+#
+# Mixes the stems of Slakh tracks into the mixtures and sources used in benchmark
+# experiments, e.g., a mixture of only the bass, drums, guitar, and piano of a track,
+# with those four instruments as the sources to separate.
+#
+# The stems of a track are loaded as one stacked float32 array and mixed with a single
+# matrix product, where each row of the mixing matrix picks (and scales) the stems that
+# make up one source. The mixture is the sum of the sources, scaled so that it does not
+# peak above the track's `target_peak`.
+# Mixtures can be written to disk in parallel worker processes, or made on the fly as
+# batches of random excerpts for training.
+# See the README about how to use.
+
+import os
+import sys
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.manifest import atomic_output  # noqa: E402
+from conversion.reader import read_track_stems  # noqa: E402
+from loader.slakh_dataset import SlakhDataset  # noqa: E402
+
+
+MIXTURE_NAME = 'mix'
+DEFAULT_TARGET_PEAK = -1.0  # dBFS
+
+
+def mixing_matrix(stem_classes, source_classes):
+    """
+    Makes the matrix that sums the stems of a track into sources, one per instrument class.
+    :param stem_classes: (list) `inst_class` of each stem of the track, e.g., ['Bass', 'Piano', 'Piano'].
+    :param source_classes: (list) `inst_class` of each source to make, e.g., ['Bass', 'Drums'].
+    :return: (np.ndarray) float32 array of shape (len(source_classes), len(stem_classes)) that
+        is 1 where a stem belongs to a source and 0 elsewhere.
+    """
+    stem_classes = np.asarray(stem_classes, dtype=object)
+    return np.stack([stem_classes == c for c in source_classes]).astype(np.float32)
+
+
+def stem_gains(metadata, stem_ids, undo_overall_gain=False):
+    """
+    Linear gain of each stem of a track before mixing.
+
+    The stems in Slakh are loudness normalized to `normalization_factor` and then scaled by
+    the track's `overall_gain` (so that they sum to `mix`). If the track was never normalized,
+    its stems are first brought to `normalization_factor` with their `integrated_loudness`.
+    :param metadata: (dict) contents of the track's `metadata.yaml`.
+    :param stem_ids: (list) ids of the stems, in row order.
+    :param undo_overall_gain: (bool) undo the track's `overall_gain`, so the stems are at
+        their loudness normalized levels instead of the levels they have in `mix`.
+    :return: (np.ndarray) float32 array of gains, one per stem.
+    """
+    gains = np.ones(len(stem_ids), dtype=np.float64)
+    if not metadata.get('normalized', True) and 'normalization_factor' in metadata:
+        loudness = np.array([metadata['stems'][s].get('integrated_loudness',
+                                                      metadata['normalization_factor'])
+                             for s in stem_ids], dtype=np.float64)
+        gains *= 10 ** ((metadata['normalization_factor'] - loudness) / 20)
+    if undo_overall_gain and metadata.get('overall_gain'):
+        gains /= metadata['overall_gain']
+    return gains.astype(np.float32)
+
+
+def peak_safe_gain(mixture, target_peak=DEFAULT_TARGET_PEAK, normalize=False):
+    """
+    Gain that keeps the peak of `mixture` at or below `target_peak`.
+    :param mixture: (np.ndarray) mixture(s), with time on the last axis.
+    :param target_peak: (float) highest allowed peak, in dBFS.
+    :param normalize: (bool) also raise quiet mixtures, so that every peak is at `target_peak`
+        (like `overall_gain` does for the full mix of a Slakh track).
+    :return: (np.ndarray) float32 gain for each mixture, shape `mixture.shape[:-1]`.
+    """
+    peak = np.abs(mixture).max(axis=-1).astype(np.float64)
+    limit = 10 ** (target_peak / 20)
+    gain = np.divide(limit, peak, out=np.ones_like(peak), where=peak > 0)
+    if not normalize:
+        gain = np.minimum(gain, 1.)
+    return gain.astype(np.float32)
+
+
+def mix(stems, matrix, gains, target_peak=DEFAULT_TARGET_PEAK, normalize=False):
+    """
+    Mixes stacked stems into sources and a mixture.
+    :param stems: (np.ndarray) float32 stems, shape (..., n_stems, n_frames). Leading axes
+        (e.g., a batch of excerpts) are mixed in the same call.
+    :param matrix: (np.ndarray) mixing matrix, shape (n_sources, n_stems), see `mixing_matrix()`.
+    :param gains: (np.ndarray) gain of each stem, shape (..., n_stems), see `stem_gains()`.
+    :param target_peak: (float) highest allowed peak of the mixture, in dBFS.
+    :param normalize: (bool) see `peak_safe_gain()`.
+    :return: (np.ndarray, np.ndarray) the mixture, shape (..., n_frames), and the sources,
+        shape (..., n_sources, n_frames), with the same gain applied so that the sources
+        still sum to the mixture.
+    """
+    weights = (matrix * np.asarray(gains, dtype=np.float32)[..., None, :]).astype(np.float32)
+    sources = np.matmul(weights, stems)
+    mixture = sources.sum(axis=-2)
+    gain = peak_safe_gain(mixture, target_peak, normalize)
+    mixture *= gain[..., None]
+    sources *= gain[..., None, None]
+    return mixture, sources
+
+
+def _materialize_track(job):
+    in_track_dir, out_track_dir, stem_ids, matrix, gains, source_names, \
+        target_peak, normalize, ext = job
+    stems, _, sr = read_track_stems(in_track_dir, stem_ids, ext=ext)
+    mixture, sources = mix(stems, matrix, gains, target_peak, normalize)
+
+    os.makedirs(out_track_dir, exist_ok=True)
+    for name, audio in [(MIXTURE_NAME, mixture)] + list(zip(source_names, sources)):
+        with atomic_output(os.path.join(out_track_dir, name + '.wav')) as temp_path:
+            sf.write(temp_path, audio, sr, subtype='FLOAT')
+    return os.path.basename(in_track_dir)
+
+
+class ExperimentMixer(object):
+    """
+    Makes mixtures of the stems of selected instrument classes, with one source per class,
+    from every track that has at least one stem of each class.
+
+    >>> mixer = ExperimentMixer(SlakhDataset('/path/to/slakh2100', split='train'),
+    ...                         ['Bass', 'Drums', 'Guitar', 'Piano'])
+    >>> mixture, sources = mixer.get_excerpt(mixer.track_ids[0], offset=0, length=5 * 44100)
+    >>> sources.shape
+    (4, 220500)
+    >>> for mixtures, sources in mixer.batches(batch_size=16, length=44100):
+    ...     train_step(mixtures, sources)
+    """
+
+    def __init__(self, dataset, source_classes, target_peak=None, undo_overall_gain=False,
+                 normalize=False):
+        """
+        :param dataset: (SlakhDataset) the tracks to mix, decoded to a float dtype.
+        :param source_classes: (list) `inst_class` of each source, e.g., ['Bass', 'Drums'].
+        :param target_peak: (float) highest allowed peak of a mixture, in dBFS. If `None`,
+            uses each track's `target_peak`.
+        :param undo_overall_gain: (bool) see `stem_gains()`.
+        :param normalize: (bool) see `peak_safe_gain()`.
+        """
+        self.dataset = dataset
+        self.source_classes = list(source_classes)
+        self.target_peak = target_peak
+        self.undo_overall_gain = undo_overall_gain
+        self.normalize = normalize
+
+        # Stems, mixing matrix, and stem gains of every track with all of the sources
+        self.recipes = {}
+        for track_id in dataset.track_ids:
+            stem_ids = [s for s in dataset.stem_ids(track_id)
+                        if dataset.stem_metadata(track_id, s).get('inst_class') in self.source_classes]
+            classes = [dataset.stem_metadata(track_id, s)['inst_class'] for s in stem_ids]
+            matrix = mixing_matrix(classes, self.source_classes)
+            if not matrix.any(axis=1).all():
+                continue
+            metadata = dataset.tracks[track_id]['metadata']
+            self.recipes[track_id] = (stem_ids, matrix,
+                                      stem_gains(metadata, stem_ids, undo_overall_gain))
+        self.track_ids = sorted(self.recipes.keys())
+
+    def _target_peak(self, track_id):
+        if self.target_peak is not None:
+            return self.target_peak
+        return self.dataset.tracks[track_id]['metadata'].get('target_peak', DEFAULT_TARGET_PEAK)
+
+    def get_excerpt(self, track_id, offset=0, length=None):
+        """
+        Mixes an excerpt of a track.
+        :param track_id: (str) e.g., 'Track00001'.
+        :param offset: (int) first frame of the excerpt.
+        :param length: (int) number of frames in the excerpt. If `None`, goes to the end of the mix.
+        :return: (np.ndarray, np.ndarray) the mixture, shape (length,), and the sources,
+            shape (len(source_classes), length).
+        """
+        stem_ids, matrix, gains = self.recipes[track_id]
+        stems = self.dataset.get_excerpt(track_id, stem_ids, offset, length).astype(np.float32)
+        return mix(stems, matrix, gains, self._target_peak(track_id), self.normalize)
+
+    def batches(self, batch_size, length, n_batches=None, seed=None):
+        """
+        Yields batches of mixtures and sources of random excerpts of random tracks. The
+        excerpts of the next batch are prefetched (if the dataset has prefetch threads)
+        while the current batch is in use.
+        :param batch_size: (int) number of excerpts per batch.
+        :param length: (int) number of frames per excerpt.
+        :param n_batches: (int) number of batches to yield. If `None`, yields forever.
+        :param seed: (int) seed of the random excerpts.
+        :return: generator of (np.ndarray, np.ndarray) tuples, the mixtures, shape
+            (batch_size, length), and the sources, shape (batch_size, len(source_classes), length).
+        """
+        rng = np.random.RandomState(seed)
+
+        def pick():
+            picks = []
+            for track_id in rng.choice(self.track_ids, batch_size):
+                n_frames = self.dataset.track_length(track_id)[0]
+                picks.append((track_id, rng.randint(0, max(1, n_frames - length + 1))))
+            self.dataset.prefetch((t, self.recipes[t][0]) for t, _ in picks)
+            return picks
+
+        upcoming = pick()
+        batch = 0
+        while n_batches is None or batch < n_batches:
+            picks, upcoming = upcoming, pick()
+            mixtures = np.empty((batch_size, length), dtype=np.float32)
+            sources = np.empty((batch_size, len(self.source_classes), length), dtype=np.float32)
+            for i, (track_id, offset) in enumerate(picks):
+                mixtures[i], sources[i] = self.get_excerpt(track_id, offset, length)
+            yield mixtures, sources
+            batch += 1
+
+    def materialize(self, output_dir, n_workers=1, source_names=None):
+        """
+        Writes the full-length mixture and sources of every track to
+        `output_dir/TrackXXXXX/{mix, <source name>}.wav`, in parallel worker processes.
+        :param output_dir: (str) directory to write the tracks to.
+        :param n_workers: (int) number of worker processes.
+        :param source_names: (list) file names of the sources (without extension). If `None`,
+            uses the lower case instrument classes.
+        """
+        if source_names is None:
+            source_names = [c.lower().replace(' ', '_') for c in self.source_classes]
+        jobs = []
+        for track_id in self.track_ids:
+            track = self.dataset.tracks[track_id]
+            stem_ids, matrix, gains = self.recipes[track_id]
+            out_track_dir = os.path.join(output_dir, track_id)
+            jobs.append((track['path'], out_track_dir, stem_ids, matrix, gains, source_names,
+                         self._target_peak(track_id), self.normalize, track['ext']))
+
+        with Pool(n_workers) as pool:
+            for track_id in pool.imap_unordered(_materialize_track, jobs):
+                print(f'Mixed {track_id}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of Slakh.')
+    parser.add_argument('--output-dir', '-o', type=str, required=True,
+                        help='Directory to write the mixtures and sources to.')
+    parser.add_argument('--sources', '-s', type=str, nargs='+', required=True,
+                        help='Instrument classes (inst_class in metadata.yaml) to make sources of, '
+                             'e.g., Bass Drums Guitar Piano.')
+    parser.add_argument('--split', type=str, default=None,
+                        help='Only mix tracks in this split directory (e.g., test).')
+    parser.add_argument('--target-peak', '-p', type=float, default=None,
+                        help='Highest allowed peak of a mixture, in dBFS. Defaults to the '
+                             'target_peak of each track.')
+    parser.add_argument('--undo-overall-gain', '-u', action='store_true',
+                        help='Mix the stems at their loudness normalized levels instead of at '
+                             'their levels in the full mix.')
+    parser.add_argument('--normalize', '-n', action='store_true',
+                        help='Scale every mixture so that it peaks at the target peak, instead '
+                             'of only turning down mixtures that would peak above it.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of worker processes.')
+    args = parser.parse_args()
+
+    mixer = ExperimentMixer(SlakhDataset(args.input_dir, split=args.split, cache_bytes=0),
+                            args.sources, args.target_peak, args.undo_overall_gain, args.normalize)
+    mixer.materialize(args.output_dir, args.num_workers)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#
+# Builds a compact, columnar index of the metadata of every track and stem in Slakh,
+# so that tools can answer questions like "all rendered bass stems in train" without
+# opening thousands of `metadata.yaml` files. The index is built once (parsing the
+# yaml files in parallel with libyaml's C loader, when available) and saved as a
+# single .npz file.
+#
+# See the README about how to use.
+
+import os
+import sys
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import yaml
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import find_tracks  # noqa: E402
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+INDEX_NAME = 'slakh_index.npz'
+
+# Columns with a small number of distinct strings are stored as integer codes into a
+# table of categories.
+_CATEGORICAL = ('inst_class', 'plugin_name')
+
+
+def _find_metadata_files(base_dir):
+    """
+    Finds the `metadata.yaml` of every track in `base_dir` (flat layout) and in its split
+    subdirectories.
+    :return: (list) of (split, metadata path) tuples, where split is `None` for the flat layout.
+    """
+    return [(t.split, os.path.join(t.path, 'metadata.yaml'))
+            for t in find_tracks(base_dir, require_file='metadata.yaml')]
+
+
+def _parse_metadata(job):
+    split, metadata_path = job
+    with open(metadata_path, 'r') as f:
+        metadata = yaml.load(f, Loader=_YAML_LOADER)
+
+    track_dir = os.path.dirname(metadata_path)
+    track = {
+        'track_id': os.path.basename(track_dir),
+        'split': split or '',
+        'overall_gain': metadata.get('overall_gain', 1.0),
+        'target_peak': metadata.get('target_peak', 0.0),
+    }
+    stems = []
+    for stem_id, stem in sorted(metadata['stems'].items()):
+        stems.append({
+            'stem_id': stem_id,
+            'program_num': stem.get('program_num', -1),
+            'inst_class': stem.get('inst_class') or '',
+            'plugin_name': stem.get('plugin_name') or '',
+            'is_drum': bool(stem.get('is_drum', False)),
+            'audio_rendered': bool(stem.get('audio_rendered', False)),
+            'midi_saved': bool(stem.get('midi_saved', False)),
+            'integrated_loudness': stem['integrated_loudness']
+            if stem.get('integrated_loudness') is not None else np.nan,
+        })
+    return track, stems
+
+
+class MetadataIndex(object):
+    """
+    Columnar index of the tracks and stems in Slakh.
+
+    Track columns (one entry per track): `track_id`, `split`, `overall_gain`, `target_peak`.
+    Stem columns (one entry per stem): `track` (row of the track in the track columns),
+    `stem_id`, `program_num`, `inst_class`, `plugin_name`, `is_drum`, `audio_rendered`,
+    `midi_saved`, `integrated_loudness`.
+
+    >>> index = MetadataIndex.load('/path/to/slakh2100/slakh_index.npz')
+    >>> bass = index.query(split='train', inst_class='Bass', audio_rendered=True)
+    >>> bass['track_id'][:2], bass['stem_id'][:2]
+    (array(['Track00001', 'Track00001'], ...), array(['S01', 'S07'], ...))
+    """
+
+    def __init__(self, tracks, stems, categories):
+        """
+        Use `build()` or `load()` instead of calling this directly.
+        :param tracks (dict): track columns, as numpy arrays.
+        :param stems (dict): stem columns, as numpy arrays. Categorical columns hold codes.
+        :param categories (dict): table of strings for each categorical column.
+        """
+        self.tracks = tracks
+        self.stems = stems
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.tracks['track_id'])
+
+    @classmethod
+    def build(cls, base_dir, n_workers=1):
+        """
+        Builds the index by parsing every `metadata.yaml` in `base_dir`.
+        :param base_dir (str): base directory of Slakh, either the flat layout or with
+            train/validation/test (and omitted) subdirectories.
+        :param n_workers (int): number of processes parsing yaml files in parallel.
+        :return: (MetadataIndex)
+        """
+        jobs = _find_metadata_files(base_dir)
+        with Pool(n_workers) as pool:
+            parsed = pool.map(_parse_metadata, jobs, chunksize=max(1, len(jobs) // (8 * n_workers)))
+
+        tracks = {k: [] for k in ('track_id', 'split', 'overall_gain', 'target_peak')}
+        stems = {k: [] for k in ('track', 'stem_id', 'program_num', 'inst_class', 'plugin_name',
+                                 'is_drum', 'audio_rendered', 'midi_saved', 'integrated_loudness')}
+        for row, (track, track_stems) in enumerate(parsed):
+            for k in tracks:
+                tracks[k].append(track[k])
+            for stem in track_stems:
+                stems['track'].append(row)
+                for k, v in stem.items():
+                    stems[k].append(v)
+
+        tracks = {
+            'track_id': np.array(tracks['track_id'], dtype='U'),
+            'split': np.array(tracks['split'], dtype='U'),
+            'overall_gain': np.array(tracks['overall_gain'], dtype=np.float32),
+            'target_peak': np.array(tracks['target_peak'], dtype=np.float32),
+        }
+        categories = {}
+        for k in _CATEGORICAL:
+            categories[k], stems[k] = np.unique(np.array(stems[k], dtype='U'), return_inverse=True)
+            stems[k] = stems[k].astype(np.int32)
+        stems = {
+            'track': np.array(stems['track'], dtype=np.int32),
+            'stem_id': np.array(stems['stem_id'], dtype='U'),
+            'program_num': np.array(stems['program_num'], dtype=np.int16),
+            'inst_class': stems['inst_class'],
+            'plugin_name': stems['plugin_name'],
+            'is_drum': np.array(stems['is_drum'], dtype=bool),
+            'audio_rendered': np.array(stems['audio_rendered'], dtype=bool),
+            'midi_saved': np.array(stems['midi_saved'], dtype=bool),
+            'integrated_loudness': np.array(stems['integrated_loudness'], dtype=np.float32),
+        }
+        return cls(tracks, stems, categories)
+
+    def save(self, path):
+        """
+        Saves the index as a single uncompressed .npz file.
+        """
+        arrays = {f'track.{k}': v for k, v in self.tracks.items()}
+        arrays.update({f'stem.{k}': v for k, v in self.stems.items()})
+        arrays.update({f'category.{k}': v for k, v in self.categories.items()})
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index saved with `save()`.
+        """
+        tracks, stems, categories = {}, {}, {}
+        tables = {'track': tracks, 'stem': stems, 'category': categories}
+        with np.load(path) as data:
+            for name in data.files:
+                table, column = name.split('.', 1)
+                tables[table][column] = data[name]
+        return cls(tracks, stems, categories)
+
+    def _mask(self, column, value, values):
+        if value is None:
+            return None
+        value = np.atleast_1d(np.asarray(value))
+        if column in self.categories:
+            value = np.flatnonzero(np.isin(self.categories[column], value))
+        return np.isin(values, value)
+
+    def query(self, split=None, track_ids=None, **stem_filters):
+        """
+        Finds the stems that match every given filter. Each filter is either a single value
+        or a list of acceptable values, and filters that are `None` are ignored.
+
+        >>> index.query(split=['train', 'validation'], program_num=range(32, 40), audio_rendered=True)
+
+        :param split: split(s) of the track, e.g., 'train'.
+        :param track_ids: track id(s), e.g., 'Track00001'.
+        :param stem_filters: filters on the stem columns, e.g., `inst_class='Bass'`, `is_drum=False`.
+        :return: (dict) columns of the matching stems, with the track columns joined in.
+        """
+        masks = []
+        for column, value in stem_filters.items():
+            if column not in self.stems or column == 'track':
+                raise KeyError(f'Cannot query on \'{column}\'.')
+            masks.append(self._mask(column, value, self.stems[column]))
+
+        track_masks = [self._mask('split', split, self.tracks['split']),
+                       self._mask('track_id', track_ids, self.tracks['track_id'])]
+        track_masks = [m for m in track_masks if m is not None]
+        if track_masks:
+            masks.append(np.logical_and.reduce(track_masks)[self.stems['track']])
+
+        masks = [m for m in masks if m is not None]
+        rows = np.flatnonzero(np.logical_and.reduce(masks)) if masks else \
+            np.arange(len(self.stems['stem_id']))
+
+        result = {}
+        for column, values in self.stems.items():
+            values = values[rows]
+            if column in self.categories:
+                values = self.categories[column][values]
+            result[column] = values
+        track_rows = result.pop('track')
+        for column, values in self.tracks.items():
+            result[column] = values[track_rows]
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of Slakh.')
+    parser.add_argument('--output', '-o', type=str, required=False, default=None,
+                        help=f'Path to write the index to. Defaults to INPUT_DIR/{INDEX_NAME}.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of processes to parse metadata files with.')
+    args = parser.parse_args()
+
+    index = MetadataIndex.build(args.input_dir, args.num_workers)
+    output = args.output or os.path.join(args.input_dir, INDEX_NAME)
+    index.save(output)
+    print(f'Indexed {len(index)} tracks and {len(index.stems["stem_id"])} stems into {output}',
+          file=sys.stderr)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# Random-access loading of excerpts of Slakh tracks. The index of tracks and stems is
+# built from every `metadata.yaml` once, and decoded stems are kept in an LRU cache so
+# that repeated excerpts of the same track do not decode the same files over and over.
+# Upcoming requests can be handed to a pool of background threads to decode ahead of time.
+# Piano rolls precomputed from the MIDI files (see `pianoroll/pianoroll.py`) can be
+# loaded for the same excerpts.
+
+import os
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+import yaml
+
+from common.cache import LRUCache
+from common.discovery import find_tracks
+from conversion.packed import PACKED_NAME, PackedTrack
+from conversion.reader import audio_info, read_audio
+from pianoroll.pianoroll import PIANOROLL_NAME, PianoRoll
+
+
+MIX_NAME = 'mix'
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class SlakhDataset(object):
+    """
+    Serves excerpts of the mix and stems of Slakh tracks.
+
+    >>> dataset = SlakhDataset('/path/to/slakh2100', split='train', cache_bytes=4 * 2**30)
+    >>> track_id = dataset.track_ids[0]
+    >>> excerpt = dataset.get_excerpt(track_id, ['mix', 'S00', 'S01'], offset=44100, length=5 * 44100)
+    >>> excerpt.shape
+    (3, 220500)
+
+    Works with both the original flat layout (`base_dir/TrackXXXXX`) and split
+    layouts (`base_dir/train/TrackXXXXX`, ...), and with .flac or .wav audio.
+    """
+
+    def __init__(self, base_dir, split=None, cache_bytes=2 ** 30, n_prefetch_threads=0,
+                 dtype='float32'):
+        """
+        :param base_dir (str): base directory of Slakh.
+        :param split (str): only index tracks in this split directory (e.g., 'train').
+            If `None`, indexes every track.
+        :param cache_bytes (int): memory budget, in bytes, for decoded stems.
+        :param n_prefetch_threads (int): number of background threads used by `prefetch()`.
+            If 0, `prefetch()` does nothing.
+        :param dtype (str): data type to decode audio into, see `conversion/reader.py`.
+        """
+        self.base_dir = base_dir
+        self.dtype = dtype
+        self.cache = LRUCache(cache_bytes)
+        self.tracks = self._build_index(base_dir, split)
+        self.track_ids = sorted(self.tracks.keys())
+        self._pool = ThreadPool(n_prefetch_threads) if n_prefetch_threads > 0 else None
+
+    @staticmethod
+    def _find_track_dirs(base_dir, split):
+        return [(t.split, t.path) for t in find_tracks(base_dir, splits=split)]
+
+    @staticmethod
+    def _build_index(base_dir, split):
+        tracks = {}
+        for track_split, track_dir in SlakhDataset._find_track_dirs(base_dir, split):
+            metadata_path = os.path.join(track_dir, 'metadata.yaml')
+            if not os.path.isfile(metadata_path):
+                continue
+            with open(metadata_path, 'r') as f:
+                metadata = yaml.load(f, Loader=_YAML_LOADER)
+
+            ext = '.flac' if os.path.isfile(os.path.join(track_dir, MIX_NAME + '.flac')) else '.wav'
+            stems = {stem_id: stem for stem_id, stem in metadata['stems'].items()
+                     if stem.get('audio_rendered', True)}
+            tracks[os.path.basename(track_dir)] = {
+                'path': track_dir,
+                'split': track_split,
+                'ext': ext,
+                'stems': stems,
+                'metadata': metadata,
+            }
+            packed_path = os.path.join(track_dir, PACKED_NAME)
+            if os.path.isfile(packed_path):
+                tracks[os.path.basename(track_dir)]['packed'] = packed_path
+            pianoroll_path = os.path.join(track_dir, PIANOROLL_NAME)
+            if os.path.isfile(pianoroll_path):
+                tracks[os.path.basename(track_dir)]['pianoroll'] = pianoroll_path
+        return tracks
+
+    def audio_path(self, track_id, name):
+        """
+        :return: (str) path to the audio file of the mix (`name` is "mix") or a stem of a track.
+        """
+        track = self.tracks[track_id]
+        if name == MIX_NAME:
+            return os.path.join(track['path'], name + track['ext'])
+        return os.path.join(track['path'], track['metadata'].get('audio_dir', 'stems'),
+                            name + track['ext'])
+
+    def stem_ids(self, track_id):
+        """
+        :return: (list) sorted ids of the rendered stems of a track, e.g., ['S00', 'S01', ...]
+        """
+        return sorted(self.tracks[track_id]['stems'].keys())
+
+    def stem_metadata(self, track_id, stem_id):
+        """
+        :return: (dict) the metadata of one stem, as in `metadata.yaml`.
+        """
+        return self.tracks[track_id]['stems'][stem_id]
+
+    def track_length(self, track_id):
+        """
+        :return: (int, int) number of frames in the mix of a track, and its sample rate.
+        """
+        track = self.tracks[track_id]
+        if 'length' not in track:
+            if 'packed' in track:
+                packed = self._packed(track_id)
+                sr, frames = packed.sr, len(packed)
+            else:
+                sr, frames, _ = audio_info(self.audio_path(track_id, MIX_NAME))
+            track['length'], track['sr'] = frames, sr
+        return track['length'], track['sr']
+
+    def _packed(self, track_id):
+        track = self.tracks[track_id]
+        if 'packed_track' not in track:
+            track['packed_track'] = PackedTrack(track['packed'])
+        return track['packed_track']
+
+    def piano_roll(self, track_id):
+        """
+        :return: (PianoRoll) the precomputed piano rolls of a track, see `pianoroll/pianoroll.py`.
+        """
+        track = self.tracks[track_id]
+        if 'pianoroll' not in track:
+            raise ValueError(f'{track_id} has no {PIANOROLL_NAME}. Make it with pianoroll/pianoroll.py.')
+        if 'pianoroll_data' not in track:
+            track['pianoroll_data'] = PianoRoll(track['pianoroll'])
+        return track['pianoroll_data']
+
+    def _load(self, track_id, name):
+        key = (track_id, name)
+        return self.cache.get_or_load(key, lambda: read_audio(self.audio_path(track_id, name),
+                                                              dtype=self.dtype)[0])
+
+    def _read_excerpt(self, track_id, name, offset, out):
+        """
+        Decodes an excerpt of one source into `out`, leaving frames past its end untouched.
+        """
+        path = self.audio_path(track_id, name)
+        n = max(0, min(len(out), audio_info(path)[1] - offset))
+        if n > 0:
+            read_audio(path, offset=offset, length=n, dtype=self.dtype, out=out[:n])
+
+    def get_excerpt(self, track_id, stems=None, offset=0, length=None):
+        """
+        Gets an excerpt of some (or all) of the sources in a track, decoding only the sources
+        that are not in the cache. Without a cache (`cache_bytes=0`), only the frames of the
+        excerpt are decoded. Tracks packed into one file (see `conversion/packed.py`) are read
+        straight from the memory-mapped file instead, without decoding or caching.
+        :param track_id (str): e.g., 'Track00001'.
+        :param stems (list): names of the sources to get, e.g., ['mix', 'S00']. If `None`, gets
+            every rendered stem of the track (not the mix).
+        :param offset (int): first frame of the excerpt. Must not be negative.
+        :param length (int): number of frames in the excerpt. If `None`, goes to the end of
+            the mix. Sources that end before the excerpt does are zero-padded.
+        :return: (np.ndarray) array of shape (len(stems), length).
+        """
+        if stems is None:
+            stems = self.stem_ids(track_id)
+        if offset < 0:
+            raise ValueError(f'Excerpt of {track_id} starts before the track does (offset {offset}).')
+        if length is None:
+            length = max(0, self.track_length(track_id)[0] - offset)
+
+        excerpt = np.zeros((len(stems), length), dtype=self.dtype)
+        if 'packed' in self.tracks[track_id]:
+            return self._packed(track_id).read(offset, length, stems, out=excerpt)
+        for i, name in enumerate(stems):
+            if self.cache.max_bytes == 0 and (track_id, name) not in self.cache:
+                # Nothing would be kept, so only decode the frames of the excerpt
+                self._read_excerpt(track_id, name, offset, excerpt[i])
+                continue
+            audio = self._load(track_id, name)
+            n = max(0, min(length, audio.shape[0] - offset))
+            excerpt[i, :n] = audio[offset:offset + n]
+        return excerpt
+
+    def get_piano_roll(self, track_id, stems=None, offset=0, length=None, onsets=False,
+                       velocity=False):
+        """
+        Gets the piano rolls of the frames that cover an excerpt of audio, e.g., the labels
+        of an excerpt from `get_excerpt()`. Only the notes in the excerpt are rendered.
+        :param track_id (str): e.g., 'Track00001'.
+        :param stems (list): ids of the stems to get, e.g., ['S00', 'S01']. If `None`, gets
+            every stem that has MIDI.
+        :param offset (int): first frame of the audio excerpt, at the sample rate of the audio.
+            Must not be negative.
+        :param length (int): number of frames in the audio excerpt. If `None`, goes to the end
+            of the mix.
+        :param onsets (bool): only mark the frame each note starts in.
+        :param velocity (bool): mark notes with their velocity instead of `True`.
+        :return: (np.ndarray) array of shape (len(stems), 128, n_frames), see
+            `PianoRoll.roll()`.
+        """
+        if offset < 0:
+            raise ValueError(f'Excerpt of {track_id} starts before the track does (offset {offset}).')
+        roll = self.piano_roll(track_id)
+        n_samples, sr = self.track_length(track_id)
+        if length is None:
+            length = max(0, n_samples - offset)
+        start, n_frames = roll.frame_range(offset, length, sr)
+        return roll.roll(start, n_frames, stems, onsets, velocity)
+
+    def prefetch(self, requests):
+        """
+        Starts decoding the sources of upcoming requests in background threads, so that the
+        later calls to `get_excerpt()` for them hit the cache.
+        :param requests: iterable of (track_id, stems) tuples, where `stems` is as in
+            `get_excerpt()`.
+        """
+        if self._pool is None:
+            return
+        for track_id, stems in requests:
+            if 'packed' in self.tracks[track_id]:
+                continue  # Read straight from the page cache, nothing to decode
+            for name in (stems if stems is not None else self.stem_ids(track_id)):
+                if (track_id, name) not in self.cache:
+                    self._pool.apply_async(self._load, (track_id, name))
+
+    def close(self):
+        """
+        Stops the prefetch threads.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Re-measures the loudness of the stems of Slakh tracks (e.g., after resampling) and
+# renormalizes them the same way Slakh was made: every stem is brought to the track's
+# `normalization_factor`, and then all stems get one gain (`overall_gain`) so that their
+# sum, the mix, peaks at `target_peak`. The new loudness and gain are written back to
+# each track's `metadata.yaml`.
+#
+# Each track is streamed block by block, with all of its stems stacked into one array,
+# and tracks are processed in parallel worker processes.
+# See the README about how to use.
+
+import os
+import sys
+import argparse
+from contextlib import ExitStack
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+import yaml
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import find_tracks  # noqa: E402
+from common.manifest import atomic_output  # noqa: E402
+from loader.slakh_dataset import MIX_NAME  # noqa: E402
+from loudness.bs1770 import LoudnessMeter, gated_loudness, gain_to  # noqa: E402
+
+
+DEFAULT_BLOCK_SIZE = 2 ** 18
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def _blocks(paths, block_size):
+    """
+    Reads files of the same sample rate in lockstep, block by block. Every channel of
+    every file is a row of the yielded float32 arrays, and shorter files are zero-padded.
+    :return: (np.ndarray, generator) first row of each file (plus the total number of rows),
+        and a generator of arrays of shape (n_rows, <= block_size).
+    """
+    infos = [sf.info(p) for p in paths]
+    rows = np.cumsum([0] + [i.channels for i in infos])
+    n_frames = max([i.frames for i in infos] + [0])
+
+    def generate():
+        block = np.zeros((rows[-1], block_size), dtype=np.float32)
+        with ExitStack() as stack:
+            files = [stack.enter_context(sf.SoundFile(p)) for p in paths]
+            for start in range(0, n_frames, block_size):
+                n = min(block_size, n_frames - start)
+                for i, f in enumerate(files):
+                    data = f.read(n, dtype='float32', always_2d=True, fill_value=0)
+                    block[rows[i]:rows[i + 1], :n] = data.T
+                yield block[:, :n]
+
+    return rows, generate()
+
+
+def measure_files(paths, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Measures the integrated loudness of audio files with the same sample rate in one pass.
+    The channels of multichannel files are measured together.
+    :param paths (list): paths to the audio files.
+    :param block_size (int): number of frames to read at once.
+    :return: (np.ndarray) loudness of each file, in LUFS (-inf for silent files).
+    """
+    if not paths:
+        return np.zeros(0)
+    rows, blocks = _blocks(paths, block_size)
+    meter = LoudnessMeter(sf.info(paths[0]).samplerate)
+    for block in blocks:
+        meter.push(block)
+    energy = np.add.reduceat(meter.block_energy(), rows[:-1], axis=0)
+    return gated_loudness(energy)
+
+
+def _stem_paths(track_dir, metadata, ext):
+    stems_dir = os.path.join(track_dir, metadata.get('audio_dir', 'stems'))
+    stem_ids = sorted(s for s, stem in metadata['stems'].items() if stem.get('audio_rendered', True)
+                      and os.path.isfile(os.path.join(stems_dir, s + ext)))
+    return stem_ids, [os.path.join(stems_dir, s + ext) for s in stem_ids]
+
+
+def renormalize_track(track_dir, normalization_factor=None, target_peak=None, measure_only=False,
+                      submix_dirs=(), block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Measures, renormalizes, and rewrites the stems and mix of one track, and updates its
+    `metadata.yaml`.
+
+    The stems on disk already have the old `overall_gain` applied, so the loudness of each
+    stem before that gain is written to `integrated_loudness`, like in the original metadata.
+    :param track_dir (str): track directory, with `metadata.yaml`, a mix, and stems.
+    :param normalization_factor (float): loudness to bring each stem to, in LUFS. If `None`,
+        uses the value in `metadata.yaml`.
+    :param target_peak (float): peak of the mix, in dBFS. If `None`, uses the value in
+        `metadata.yaml`.
+    :param measure_only (bool): only measure the loudness and update the metadata, do not
+        change any audio.
+    :param submix_dirs (list): names of submix directories in the track (see
+        `submixes/submixes.py`) whose sources to also measure. Their loudness is written to
+        `submix_loudness` in the metadata, the audio is not changed.
+    :param block_size (int): number of frames to read at once.
+    :return: (dict) the updated metadata.
+    """
+    metadata_path = os.path.join(track_dir, 'metadata.yaml')
+    with open(metadata_path) as f:
+        metadata = yaml.load(f, Loader=_YAML_LOADER)
+    if normalization_factor is None:
+        normalization_factor = metadata.get('normalization_factor', -13.0)
+    if target_peak is None:
+        target_peak = metadata.get('target_peak', -1.0)
+    old_gain = metadata.get('overall_gain') or 1.0
+
+    ext = '.flac' if os.path.isfile(os.path.join(track_dir, MIX_NAME + '.flac')) else '.wav'
+    stem_ids, stem_paths = _stem_paths(track_dir, metadata, ext)
+    loudness = measure_files(stem_paths, block_size)
+    for stem_id, stem_loudness in zip(stem_ids, loudness - 20 * np.log10(old_gain)):
+        metadata['stems'][stem_id]['integrated_loudness'] = \
+            float(stem_loudness) if np.isfinite(stem_loudness) else None
+
+    if not measure_only and stem_paths:
+        rows, blocks = _blocks(stem_paths, block_size)
+        # Gain of each row (channel of a stem) that brings its stem to the normalization factor
+        gains = np.repeat(gain_to(loudness, normalization_factor), np.diff(rows))
+        gains = gains.astype(np.float32)[:, None]
+        sizes = np.diff(rows)
+        if not np.all(sizes == sizes[0]):
+            raise ValueError(f'Stems of {track_dir} do not all have the same number of channels.')
+
+        # The peak of the normalized mix sets the new overall gain
+        peak = 0.
+        for block in blocks:
+            normalized = (block * gains).reshape(len(stem_paths), sizes[0], -1)
+            peak = max(peak, float(np.abs(normalized.sum(axis=0)).max(initial=0.)))
+        overall_gain = 10 ** (target_peak / 20) / peak if peak > 0 else 1.
+
+        infos = [sf.info(p) for p in stem_paths]
+        mix_path = os.path.join(track_dir, MIX_NAME + ext)
+        mix_info = sf.info(mix_path) if os.path.isfile(mix_path) else infos[0]
+        _, blocks = _blocks(stem_paths, block_size)
+        with ExitStack() as stack:
+            def open_output(path, info):
+                # Each output is closed before `atomic_output` renames it, since exits run in reverse
+                temp_path = stack.enter_context(atomic_output(path))
+                return stack.enter_context(sf.SoundFile(temp_path, 'w', info.samplerate,
+                                                        info.channels, info.subtype))
+
+            out_stems = [open_output(p, i) for p, i in zip(stem_paths, infos)]
+            out_mix = open_output(mix_path, mix_info)
+            for block in blocks:
+                scaled = (block * (gains * np.float32(overall_gain))).reshape(
+                    len(stem_paths), sizes[0], -1)
+                for f, stem in zip(out_stems, scaled):
+                    f.write(stem.T)
+                out_mix.write(scaled.sum(axis=0).T)
+
+        metadata['overall_gain'] = float(overall_gain)
+        metadata['normalization_factor'] = float(normalization_factor)
+        metadata['target_peak'] = float(target_peak)
+        metadata['normalized'] = True
+
+    for submix_dir in submix_dirs:
+        submix_dir_path = os.path.join(track_dir, submix_dir)
+        if not os.path.isdir(submix_dir_path):
+            continue
+        names = sorted(os.path.splitext(n)[0] for n in os.listdir(submix_dir_path)
+                       if n.endswith('.wav') and not n.startswith('.'))
+        submix_loudness = measure_files([os.path.join(submix_dir_path, n + '.wav') for n in names],
+                                        block_size)
+        metadata.setdefault('submix_loudness', {})[submix_dir] = {
+            n: float(l) if np.isfinite(l) else None for n, l in zip(names, submix_loudness)}
+
+    with atomic_output(metadata_path) as temp_path:
+        with open(temp_path, 'w') as f:
+            yaml.dump(metadata, f, Dumper=_YAML_DUMPER, default_flow_style=False)
+    return metadata
+
+
+def _renormalize_track(job):
+    track_dir, kwargs = job
+    renormalize_track(track_dir, **kwargs)
+    return os.path.basename(track_dir)
+
+
+def renormalize_all(base_dir, n_workers=1, **kwargs):
+    """
+    Runs `renormalize_track()` on every track in `base_dir` in parallel worker processes.
+    :param base_dir (str): base directory of Slakh (flat, or with split subdirectories).
+    :param n_workers (int): number of worker processes.
+    :param kwargs: passed on to `renormalize_track()`.
+    """
+    track_dirs = [t.path for t in find_tracks(base_dir, require_file='metadata.yaml')]
+    with Pool(n_workers) as pool:
+        for track_id in pool.imap_unordered(_renormalize_track,
+                                            [(d, kwargs) for d in track_dirs]):
+            print(f'Finished {track_id}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of Slakh (e.g., resampled or converted). Tracks are '
+                             'updated in place.')
+    parser.add_argument('--normalization-factor', '-l', type=float, default=None,
+                        help='Loudness (LUFS) to normalize every stem to. Defaults to the '
+                             'normalization_factor of each track.')
+    parser.add_argument('--target-peak', '-p', type=float, default=None,
+                        help='Peak (dBFS) of the renormalized mix. Defaults to the target_peak '
+                             'of each track.')
+    parser.add_argument('--measure-only', action='store_true',
+                        help='Only measure loudness and update metadata.yaml, do not change '
+                             'any audio.')
+    parser.add_argument('--submixes', '-s', type=str, nargs='*', default=[],
+                        help='Names of submix directories in each track to also measure.')
+    parser.add_argument('--block-size', '-b', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='Number of frames to read at once.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of worker processes.')
+    args = parser.parse_args()
+
+    renormalize_all(args.input_dir, args.num_workers, normalization_factor=args.normalization_factor,
+                    target_peak=args.target_peak, measure_only=args.measure_only,
+                    submix_dirs=args.submixes, block_size=args.block_size)
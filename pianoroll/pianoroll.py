@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+#
+# Precomputes frame-aligned piano rolls from the per-stem MIDI files of Slakh
+# (`TrackXXXXX/MIDI/SXX.mid`), so that training code does not parse MIDI at load time.
+# Every stem's notes are parsed once, in worker processes, and quantized to frames of
+# `hop` samples at sample rate `sr`. The notes of all stems of a track are stored
+# together, sparsely, in one file per track (`TrackXXXXX/pianoroll.npz`):
+#
+#   stem_ids, program, is_drum, audio_rendered   one entry per stem
+#   stem_offsets                                 notes of stem i are [stem_offsets[i], stem_offsets[i + 1])
+#   onset, offset, pitch, velocity               one entry per note; onset and offset (exclusive)
+#                                                are in frames, sorted by onset within each stem
+#   max_offset                                   running maximum of `offset` within each stem
+#
+# Since onsets are sorted and `max_offset` never decreases, the notes sounding in any
+# window of frames are found with two binary searches per stem, and dense rolls are only
+# rendered for the window that is asked for (see `PianoRoll`).
+# See the README about how to use.
+
+import os
+import sys
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+import yaml
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import SPLITS, find_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
+from common.manifest import TrackManifest, atomic_output, remove_partial_outputs  # noqa: E402
+from common.midi_notes import read_notes  # noqa: E402
+
+
+PIANOROLL_NAME = 'pianoroll.npz'
+VERSION = 1
+N_PITCHES = 128
+DEFAULT_SR = 16000
+DEFAULT_HOP = 512
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _midi_stems(track_dir, metadata):
+    """
+    :return: (list) (stem id, stem metadata, path to its MIDI file) of every stem whose
+        MIDI file was saved, sorted by stem id.
+    """
+    midi_dir = os.path.join(track_dir, 'MIDI')
+    stems = []
+    for stem_id, stem in sorted(metadata['stems'].items()):
+        path = os.path.join(midi_dir, stem_id + '.mid')
+        if stem.get('midi_saved', True) and os.path.isfile(path):
+            stems.append((stem_id, stem, path))
+    return stems
+
+
+def _audio_frames(track_dir, sr, hop):
+    """
+    :return: (int) number of frames that cover the mix of a track, or `None` if the track
+        has no mix.
+    """
+    for ext in ('.flac', '.wav'):
+        path = os.path.join(track_dir, 'mix' + ext)
+        if os.path.isfile(path):
+            info = sf.info(path)
+            return -(-info.frames * sr // (info.samplerate * hop))
+    return None
+
+
+def quantize_notes(notes, sr, hop):
+    """
+    Quantizes note times to frames. Onsets and offsets are rounded to the nearest frame
+    boundary, and every note lasts at least one frame.
+    :param notes (dict): output of `common.midi_notes.read_notes()`.
+    :param sr (int): sample rate the frames are counted at.
+    :param hop (int): number of samples per frame.
+    :return: (np.ndarray, np.ndarray) onset and offset (exclusive) frame of every note.
+    """
+    frames_per_second = sr / hop
+    onset = np.round(notes['start'] * frames_per_second).astype(np.int32)
+    offset = np.round(notes['end'] * frames_per_second).astype(np.int32)
+    return onset, np.maximum(offset, onset + 1)
+
+
+def compute_piano_roll(track_dir, out_path, sr=DEFAULT_SR, hop=DEFAULT_HOP, timer=None):
+    """
+    Parses the MIDI file of every stem of a track and writes their notes, in frames, to
+    one file (see the top of this file for its contents).
+    :param track_dir (str): path to a `TrackXXXXX` directory.
+    :param out_path (str): path of the file to write.
+    :param sr (int): sample rate the frames are counted at, usually that of the audio the
+        piano rolls go with.
+    :param hop (int): number of samples per frame.
+    :param timer (StageTimer): optional timer of the `decode`, `process`, and `write`
+        stages, see `common/instrument.py`.
+    :return: (int) number of frames that cover the track.
+    """
+    timer = timer if timer is not None else StageTimer(track_dir)
+    with timer.stage('decode'):
+        with open(os.path.join(track_dir, 'metadata.yaml')) as f:
+            metadata = yaml.load(f, Loader=_YAML_LOADER)
+        stems = _midi_stems(track_dir, metadata)
+        stem_notes = [read_notes(path) for _, _, path in stems]
+
+    with timer.stage('process'):
+        columns = {'onset': [], 'offset': [], 'pitch': [], 'velocity': [], 'max_offset': []}
+        stem_offsets = [0]
+        for notes in stem_notes:
+            onset, offset = quantize_notes(notes, sr, hop)
+            order = np.lexsort((notes['pitch'], onset))
+            columns['onset'].append(onset[order])
+            columns['offset'].append(offset[order])
+            columns['pitch'].append(notes['pitch'][order].astype(np.uint8))
+            columns['velocity'].append(notes['velocity'][order].astype(np.uint8))
+            columns['max_offset'].append(np.maximum.accumulate(offset[order]))
+            stem_offsets.append(stem_offsets[-1] + len(onset))
+        dtypes = {'onset': np.int32, 'offset': np.int32, 'pitch': np.uint8, 'velocity': np.uint8,
+                  'max_offset': np.int32}
+        arrays = {name: np.concatenate(values).astype(dtypes[name]) if values
+                  else np.zeros(0, dtype=dtypes[name]) for name, values in columns.items()}
+
+        n_frames = _audio_frames(track_dir, sr, hop)
+        if n_frames is None:
+            n_frames = int(arrays['offset'].max()) if len(arrays['offset']) else 0
+        arrays.update({
+            'version': np.int64(VERSION),
+            'sr': np.int64(sr),
+            'hop': np.int64(hop),
+            'n_frames': np.int64(n_frames),
+            'stem_ids': np.array([s for s, _, _ in stems], dtype=str),
+            'program': np.array([stem.get('program_num', 0) for _, stem, _ in stems], dtype=np.int16),
+            'is_drum': np.array([bool(stem.get('is_drum', False)) for _, stem, _ in stems], dtype=bool),
+            'audio_rendered': np.array([bool(stem.get('audio_rendered', True)) for _, stem, _ in stems],
+                                       dtype=bool),
+            'stem_offsets': np.array(stem_offsets, dtype=np.int64),
+        })
+
+    with timer.stage('write'):
+        with atomic_output(out_path) as temp_path:
+            np.savez(temp_path, **arrays)
+    return n_frames
+
+
+class PianoRoll(object):
+    """
+    Windowed access to the precomputed piano rolls of a track (see `compute_piano_roll()`).
+    The notes of the whole track are small, so they are loaded once; getting the notes or
+    a dense roll of a window only looks at the notes that sound in it.
+
+    >>> roll = PianoRoll('Track00001/pianoroll.npz')
+    >>> start, length = roll.frame_range(offset=10 * 44100, length=5 * 44100, sr=44100)
+    >>> frames = roll.roll(start, length, ['S00', 'S01'])  # (2, 128, length) bool
+    >>> onsets = roll.roll(start, length, ['S00', 'S01'], onsets=True)
+    """
+
+    def __init__(self, path):
+        """
+        :param path (str): path to the piano roll file.
+        """
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        if int(arrays['version']) != VERSION:
+            raise ValueError(f'{path} has unsupported version {int(arrays["version"])}.')
+        self.path = path
+        self.sr = int(arrays['sr'])
+        self.hop = int(arrays['hop'])
+        self.n_frames = int(arrays['n_frames'])
+        self.stem_ids = [str(s) for s in arrays['stem_ids']]
+        self.program = arrays['program']
+        self.is_drum = arrays['is_drum']
+        self.audio_rendered = arrays['audio_rendered']
+        self._stem_offsets = arrays['stem_offsets']
+        self._notes = {name: arrays[name] for name in ('onset', 'offset', 'pitch', 'velocity')}
+        self._max_offset = arrays['max_offset']
+        self._stems = {stem_id: i for i, stem_id in enumerate(self.stem_ids)}
+
+    def __len__(self):
+        return self.n_frames
+
+    def frame_range(self, offset, length, sr=None):
+        """
+        Finds the frames that cover an excerpt of audio.
+        :param offset (int): first sample of the excerpt.
+        :param length (int): number of samples in the excerpt.
+        :param sr (int): sample rate of the audio. If `None`, the sample rate of the piano roll.
+        :return: (int, int) first frame, and number of frames.
+        """
+        sr = sr or self.sr
+        start = offset * self.sr // (sr * self.hop)
+        end = -(-(offset + length) * self.sr // (sr * self.hop))
+        return start, end - start
+
+    def _window(self, stem_id, start, end):
+        """
+        :return: (int, int) range of note indices that might sound in frames [start, end).
+        """
+        i = self._stems[stem_id]
+        lo, hi = self._stem_offsets[i], self._stem_offsets[i + 1]
+        # Notes before `first` all end by `start`, and notes from `last` on start after `end`
+        first = lo + np.searchsorted(self._max_offset[lo:hi], start, side='right')
+        last = lo + np.searchsorted(self._notes['onset'][lo:hi], end, side='left')
+        return first, max(first, last)
+
+    def notes(self, stem_id, start=0, end=None):
+        """
+        Gets the notes of one stem that sound in a window of frames.
+        :param stem_id (str): e.g., 'S00'.
+        :param start (int): first frame of the window.
+        :param end (int): frame after the end of the window. If `None`, the end of the track.
+        :return: (dict) `onset`, `offset` (exclusive), `pitch`, and `velocity` arrays, with one
+            entry per note that overlaps the window, sorted by onset. Frames are not clipped
+            to the window.
+        """
+        end = self.n_frames if end is None else end
+        first, last = self._window(stem_id, start, end)
+        keep = self._notes['offset'][first:last] > start
+        return {name: values[first:last][keep] for name, values in self._notes.items()}
+
+    def roll(self, start=0, length=None, stems=None, onsets=False, velocity=False):
+        """
+        Renders a dense piano roll of a window of frames.
+        :param start (int): first frame of the window.
+        :param length (int): number of frames in the window. If `None`, goes to the end of
+            the track. Frames past the end of the track are empty.
+        :param stems (list): ids of the stems to render, e.g., ['S00', 'S01']. If `None`,
+            renders every stem (see `stem_ids`).
+        :param onsets (bool): only mark the frame each note starts in, instead of every frame
+            it sounds in.
+        :param velocity (bool): mark notes with their velocity instead of `True`. Where notes
+            of the same pitch overlap, the later one wins.
+        :return: (np.ndarray) bool (or uint8 if `velocity`) array of shape
+            (len(stems), 128, length).
+        """
+        stems = self.stem_ids if stems is None else stems
+        if length is None:
+            length = max(0, self.n_frames - start)
+        out = np.zeros((len(stems), N_PITCHES, length), dtype=np.uint8 if velocity else bool)
+        for row, stem_id in enumerate(stems):
+            notes = self.notes(stem_id, start, start + length)
+            onset = notes['onset'] - start
+            if onsets:
+                keep = onset >= 0
+                out[row, notes['pitch'][keep], onset[keep]] = \
+                    notes['velocity'][keep] if velocity else True
+                continue
+            onset = np.maximum(onset, 0)
+            offset = np.minimum(notes['offset'] - start, length)
+            # Every (note, frame) pair, without a Python loop over the notes
+            durations = offset - onset
+            note_idx = np.repeat(np.arange(len(onset)), durations)
+            first = np.cumsum(durations) - durations  # position of each note's first pair
+            frames = onset[note_idx] + np.arange(len(note_idx)) - first[note_idx]
+            out[row, notes['pitch'][note_idx], frames] = \
+                notes['velocity'][note_idx] if velocity else True
+        return out
+
+
+def _piano_roll_folder(job):
+    """
+    Computes the piano rolls of one track, unless the track's manifest says they are up
+    to date.
+    :return: (str, bool, StageTimer) track id, whether the piano rolls were computed (`None`
+        if this failed), and the time spent on each stage.
+    """
+    track, sr, hop = job
+    timer = StageTimer(track.track_id)
+    out_path = os.path.join(track.path, PIANOROLL_NAME)
+    metadata_path = os.path.join(track.path, 'metadata.yaml')
+    try:
+        with timer.stage('discover'):
+            midi_dir = os.path.join(track.path, 'MIDI')
+            # Any change to any MIDI file makes the piano rolls out of date
+            sources = {}
+            if os.path.isdir(midi_dir):
+                for entry in os.scandir(midi_dir):
+                    if entry.name.endswith('.mid'):
+                        stat = entry.stat()
+                        sources[entry.name] = [stat.st_size, stat.st_mtime_ns]
+            manifest = TrackManifest(track.path, {'format': PIANOROLL_NAME, 'version': VERSION,
+                                                  'sr': sr, 'hop': hop, 'sources': sources})
+            if manifest.is_current(metadata_path, out_path):
+                return track.track_id, False, timer
+            remove_partial_outputs(track.path)
+
+        n_frames = compute_piano_roll(track.path, out_path, sr, hop, timer=timer)
+        with timer.stage('write'):
+            manifest.record(metadata_path, out_path)
+    except (OSError, ValueError, KeyError, EOFError) as e:
+        print(f'Failed to compute piano rolls of {track.path}: {e}')
+        return track.track_id, None, timer
+
+    timer.count(files=len(sources), bytes_in=sum(s[0] for s in sources.values()),
+                bytes_out=os.path.getsize(out_path), audio_seconds=n_frames * hop / sr)
+    return track.track_id, True, timer
+
+
+def compute_all_piano_rolls(base_dir, sr=DEFAULT_SR, hop=DEFAULT_HOP, n_workers=1, start=None,
+                            end=None, splits=None, track_ids=None, trace_path=None, progress=False):
+    """
+    Computes the piano rolls of every track (or a subset of them) in worker processes, and
+    writes them into each track directory as `PIANOROLL_NAME`.
+    :param base_dir: (str) base directory of Slakh.
+    :param sr: (int) sample rate the frames are counted at.
+    :param hop: (int) number of samples per frame.
+    :param n_workers: (int) number of worker processes.
+    :param start: (int) lowest Track ID to process (e.g., 1 for Track00001), inclusive.
+    :param end: (int) highest Track ID to process, inclusive.
+    :param splits: (list) only process tracks in these split directories.
+    :param track_ids: (list) only process these tracks.
+    :param trace_path: (str) path of a JSON-lines file to write the time spent on each track
+        to, see `common/instrument.py`.
+    :param progress: (bool) show a progress line with an ETA.
+    :return: (dict) number of tracks processed, and a list of the tracks that failed under
+        the key `failed`.
+    """
+    timer = StageTimer('discover')
+    with timer.stage('discover'):
+        tracks = find_tracks(base_dir, start, end, splits, track_ids, require_file='metadata.yaml')
+    jobs = [(t, sr, hop) for t in tracks]
+
+    n_done, failed = 0, []
+    with Tracer('pianoroll', total=len(jobs), trace_path=trace_path, progress=progress) as tracer, \
+            Pool(n_workers) as pool:
+        tracer.record(timer, done=0)
+        for track_id, done, timer in pool.imap_unordered(_piano_roll_folder, jobs):
+            tracer.record(timer)
+            if done is None:
+                failed.append(track_id)
+            elif done:
+                n_done += 1
+            if progress:
+                continue
+            if done:
+                print(f'Finished {track_id}')
+            elif done is not None:
+                print(f'{track_id} is up to date, skipping.')
+    return {'tracks': n_done, 'failed': failed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of Slakh. Piano rolls are written into each track '
+                             'directory.')
+    parser.add_argument('--sample-rate', '-sr', type=int, default=DEFAULT_SR,
+                        help='Sample rate that frames are counted at, usually that of the audio '
+                             'the piano rolls go with.')
+    parser.add_argument('--hop', type=int, default=DEFAULT_HOP,
+                        help='Number of samples per frame.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of worker processes.')
+    parser.add_argument('--start', type=int, default=None,
+                        help='If processing a subset, the lowest Track ID.')
+    parser.add_argument('--end', type=int, default=None,
+                        help='If processing a subset, the highest Track ID (inclusive).')
+    parser.add_argument('--split', type=str, nargs='+', default=None, choices=SPLITS,
+                        help='If processing a subset, only the tracks in these split directories.')
+    parser.add_argument('--tracks', type=str, nargs='+', default=None,
+                        help='If processing a subset, only these Track IDs.')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Path of a JSON-lines file to write the time spent on each track to.')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Print every track instead of showing a progress line.')
+    args = parser.parse_args()
+
+    stats = compute_all_piano_rolls(args.input_dir, args.sample_rate, args.hop, args.num_workers,
+                                    args.start, args.end, args.split, args.tracks, args.trace,
+                                    not args.no_progress)
+    if stats['failed']:
+        sys.exit(1)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# Converts, resamples, and makes submixes of Slakh in a single pass. Each track's mix and
+# stems (.flac or .wav) are decoded once, block by block, into one stacked float32 array
+# that goes through a single `StreamingResampler`, and the submix sources are summed from
+# the stems in memory with one matrix product per block. Only the final outputs are
+# written, so there are no intermediate copies of the dataset to write and read back.
+#
+# Tracks are spread across worker processes. Like the other scripts, each output track
+# keeps a manifest so an interrupted run can be resumed, the non-audio files are mirrored
+# into the output, and progress and per-stage timings can be shown and traced.
+# See the README about how to use.
+
+import os
+import sys
+import argparse
+from contextlib import ExitStack
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile as sf
+import yaml
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import SPLITS, find_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
+from common.manifest import TrackManifest, atomic_output, remove_partial_outputs  # noqa: E402
+from common.mirror import MIRROR_MODES, mirror_track_extras  # noqa: E402
+from conversion.packed import track_sources  # noqa: E402
+from resampling.engine import StreamingResampler, output_length  # noqa: E402
+from submixes.submixes import Submixes  # noqa: E402
+
+
+OUTPUT_FORMATS = ('wav', 'flac')
+DEFAULT_BLOCK_SIZE = 2 ** 16
+_FLAC_SUBTYPES = ('PCM_S8', 'PCM_16', 'PCM_24')
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def submix_matrix(submixes, metadata, stem_ids):
+    """
+    Makes the matrix that sums the stems of a track into its submix sources.
+    :param submixes: (Submixes) the submix definitions.
+    :param metadata: (dict) contents of the track's `metadata.yaml`.
+    :param stem_ids: (list) ids of the stems, in row order.
+    :return: (np.ndarray) float32 array of shape (len(submixes.output_keys), len(stem_ids))
+        that is 1 where a stem goes into a submix source and 0 elsewhere.
+    """
+    matrix = np.zeros((len(submixes.output_keys), len(stem_ids)), dtype=np.float32)
+    for col, rows in enumerate(submixes.assign(metadata, stem_ids)):
+        matrix[rows, col] = 1
+    return matrix
+
+
+def _track_params(target_sr, submixes, write_stems, write_mix, out_format, sources):
+    """
+    Parameters of a track's outputs, for its manifest. Any change to the sources (size or
+    mtime) makes all of the outputs out of date, since submixes depend on every stem.
+    """
+    params = {'target_sr': target_sr, 'stems': write_stems, 'mix': write_mix,
+              'format': out_format, 'sources': {}}
+    if submixes is not None:
+        params['submixes'] = {d.submix_name: d.submix_data for d in submixes.definitions}
+    for name, path in sources:
+        stat = os.stat(path)
+        params['sources'][name] = [stat.st_size, stat.st_mtime_ns]
+    return params
+
+
+def preprocess_track(in_track_dir, out_track_dir, target_sr=None, submixes=None, write_stems=True,
+                     write_mix=True, out_format='wav', block_size=DEFAULT_BLOCK_SIZE,
+                     mirror_mode='hardlink', timer=None):
+    """
+    Converts, resamples, and makes the submixes of one track in a single pass over its audio.
+    :param in_track_dir: (str) input `TrackXXXXX` directory, with .flac or .wav audio.
+    :param out_track_dir: (str) output `TrackXXXXX` directory.
+    :param target_sr: (int) sample rate of the outputs. If `None`, keeps the input's.
+    :param submixes: (Submixes) submix definitions to make, or `None` for no submixes.
+        Submix sources are written to `out_track_dir/<submix name>/`, like `submixes.py` does.
+    :param write_stems: (bool) write the (converted and resampled) stems.
+    :param write_mix: (bool) write the (converted and resampled) mix.
+    :param out_format: (str) one of `OUTPUT_FORMATS`.
+    :param block_size: (int) number of input frames to decode and process at a time.
+    :param mirror_mode: (str) how to mirror the non-audio files, see `common/mirror.py`.
+    :param timer: (StageTimer) optional timer of every stage.
+    :return: (int) number of files written, 0 if the track was already up to date.
+    """
+    if not (write_stems or write_mix or submixes is not None):
+        raise ValueError('Nothing to write: no stems, no mix, and no submixes.')
+    timer = timer if timer is not None else StageTimer(os.path.basename(in_track_dir))
+    ext = '.' + out_format
+    # Rows of the processed blocks are the mix (only if it is written), then the stems
+    lead = 1 if write_mix else 0
+
+    with timer.stage('discover'):
+        names, paths = track_sources(in_track_dir)
+        mix_path, stem_ids = paths[0], names[1:]
+        infos = [sf.info(p) for p in paths]
+        sr, n_channels = infos[0].samplerate, infos[0].channels
+        for path, info in zip(paths, infos):
+            if info.samplerate != sr or info.channels != n_channels:
+                raise ValueError(f'Expected every file of {in_track_dir} to be {sr}Hz with '
+                                 f'{n_channels} channel(s), but {path} is not.')
+        target_sr = target_sr or sr
+        subtype = infos[0].subtype
+        if out_format == 'flac' and subtype not in _FLAC_SUBTYPES:
+            subtype = 'PCM_16'
+
+        # Every output, as (path, length in input frames, its row in the processed blocks)
+        outputs = []
+        if write_mix:
+            outputs.append((os.path.join(out_track_dir, 'mix' + ext), infos[0].frames, 0))
+        if write_stems:
+            outputs += [(os.path.join(out_track_dir, 'stems', s + ext), i.frames, row)
+                        for row, (s, i) in enumerate(zip(stem_ids, infos[1:]), lead)]
+        matrix = None
+        if submixes is not None:
+            with open(os.path.join(in_track_dir, 'metadata.yaml')) as f:
+                metadata = yaml.load(f, Loader=_YAML_LOADER)
+            matrix = submix_matrix(submixes, metadata, stem_ids)
+            # Submixes are as long as the mix, and follow the mix (and stems, if written)
+            first_row = lead + len(stem_ids) if write_stems else lead
+            outputs += [(os.path.splitext(submixes.output_path(out_track_dir, key))[0] + ext,
+                         infos[0].frames, row)
+                        for row, key in enumerate(submixes.output_keys, first_row)]
+
+        manifest = TrackManifest(out_track_dir, _track_params(
+            target_sr, submixes, write_stems, write_mix, out_format, zip(names, paths)))
+        if all(manifest.is_current(mix_path, path) for path, _, _ in outputs):
+            return 0
+
+    with timer.stage('copy_metadata'):
+        for out_dir in sorted({os.path.dirname(path) for path, _, _ in outputs}):
+            os.makedirs(out_dir, exist_ok=True)
+            remove_partial_outputs(out_dir)
+        mirror_track_extras(in_track_dir, out_track_dir, mirror_mode)
+
+    n_frames = max(i.frames for i in infos)
+    block_size = min(block_size, max(n_frames, 1))
+    n_out = [output_length(frames, sr, target_sr) for _, frames, _ in outputs]
+    written = [0] * len(outputs)
+    streamer = StreamingResampler(sr, target_sr) if target_sr != sr else None
+    # Rows of the decoded block are the mix (unless it is not written, then it is not
+    # decoded either), then the stems. When the stems are not written, they are summed
+    # into the submixes before resampling, so fewer rows get resampled. Otherwise the
+    # submixes are summed from the resampled stems.
+    in_paths = paths[1 - lead:]
+    block = np.zeros((len(in_paths), n_channels, block_size), dtype=np.float32)
+
+    with ExitStack() as stack:
+        in_files = [stack.enter_context(sf.SoundFile(p)) for p in in_paths]
+        out_files = []
+        for path, _, _ in outputs:
+            # Each output is closed before `atomic_output` renames it, since exits run in reverse
+            temp_path = stack.enter_context(atomic_output(path))
+            out_files.append(stack.enter_context(
+                sf.SoundFile(temp_path, 'w', target_sr, n_channels, subtype)))
+
+        def _process(rows, last=False):
+            with timer.stage('process'):
+                if streamer is not None:
+                    rows = streamer.flush() if last else streamer.push(rows)
+                if matrix is not None and write_stems:
+                    rows = np.concatenate([rows, np.tensordot(matrix, rows[lead:], axes=1)])
+            with timer.stage('write'):
+                for i, (f, (_, _, row)) in enumerate(zip(out_files, outputs)):
+                    n = min(rows.shape[-1], n_out[i] - written[i])
+                    if n > 0:
+                        f.write(rows[row, :, :n].T)
+                        written[i] += n
+
+        for start in range(0, n_frames, block_size):
+            n = min(block_size, n_frames - start)
+            with timer.stage('decode'):
+                for i, f in enumerate(in_files):
+                    data = f.read(n, dtype='float32', always_2d=True, fill_value=0)
+                    block[i, :, :n] = data.T
+            rows = block[:, :, :n]
+            if not write_stems:
+                with timer.stage('process'):
+                    submix_rows = [np.tensordot(matrix, rows[lead:], axes=1)] if matrix is not None else []
+                    rows = np.concatenate([rows[:lead]] + submix_rows)
+            _process(rows)
+        if streamer is not None:
+            _process(None, last=True)
+
+    with timer.stage('write'):
+        for path, _, _ in outputs:
+            manifest.record(mix_path, path)
+    timer.count(files=len(outputs), bytes_in=sum(os.path.getsize(p) for p in in_paths),
+                bytes_out=sum(os.path.getsize(path) for path, _, _ in outputs),
+                audio_seconds=sum(i.frames for i in infos[1 - lead:]) / sr)
+    return len(outputs)
+
+
+def _preprocess_track(job):
+    track, out_track_dir, kwargs = job
+    timer = StageTimer(track.track_id)
+    try:
+        n_written = preprocess_track(track.path, out_track_dir, timer=timer, **kwargs)
+    except (OSError, RuntimeError, ValueError, KeyError) as e:
+        print(f'Failed to preprocess {track.path}: {e}')
+        n_written = None
+    return track.track_id, n_written, timer
+
+
+def preprocess(input_dir, output_dir, target_sr=None, submix_files=(), write_stems=True,
+               write_mix=True, out_format='wav', block_size=DEFAULT_BLOCK_SIZE, n_workers=1,
+               mirror_mode='hardlink', start=None, end=None, splits=None, track_ids=None,
+               trace_path=None, progress=False):
+    """
+    Runs `preprocess_track()` on every track (or a subset of them) in worker processes. The
+    output keeps the split layout of the input.
+    :param input_dir: (str) base directory of Slakh, with .flac or .wav audio.
+    :param output_dir: (str) base directory of the output.
+    :param submix_files: (list) paths to submix definition files, see `submixes/submixes.py`.
+    :param n_workers: (int) number of worker processes.
+    :param start: (int) lowest Track ID to preprocess (e.g., 1 for Track00001), inclusive.
+    :param end: (int) highest Track ID to preprocess, inclusive.
+    :param splits: (list) only preprocess tracks in these split directories.
+    :param track_ids: (list) only preprocess these tracks.
+    :param trace_path: (str) path of a JSON-lines file to write the time spent on each track
+        to, see `common/instrument.py`.
+    :param progress: (bool) show a progress line with an ETA.
+    :param kwargs: see `preprocess_track()` for the rest.
+    :return: (dict) number of tracks processed, and a list of the tracks that failed under
+        the key `failed`.
+    """
+    if out_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Cannot write \'{out_format}\'. Options are: {", ".join(OUTPUT_FORMATS)}')
+    if not (write_stems or write_mix or submix_files):
+        raise ValueError('Nothing to write: no stems, no mix, and no submixes.')
+    submixes = Submixes(None, list(submix_files)) if submix_files else None
+    kwargs = {'target_sr': target_sr, 'submixes': submixes, 'write_stems': write_stems,
+              'write_mix': write_mix, 'out_format': out_format, 'block_size': block_size,
+              'mirror_mode': mirror_mode}
+
+    timer = StageTimer('discover')
+    with timer.stage('discover'):
+        tracks = find_tracks(input_dir, start, end, splits, track_ids, require_file='metadata.yaml')
+    jobs = [(t, os.path.join(output_dir, t.relative_path), kwargs) for t in tracks]
+
+    n_done, failed = 0, []
+    with Tracer('preprocess', total=len(jobs), trace_path=trace_path, progress=progress) as tracer, \
+            Pool(n_workers) as pool:
+        tracer.record(timer, done=0)
+        for track_id, n_written, timer in pool.imap_unordered(_preprocess_track, jobs):
+            tracer.record(timer)
+            if n_written is None:
+                failed.append(track_id)
+            elif n_written:
+                n_done += 1
+            if progress:
+                continue
+            if n_written:
+                print(f'Finished {track_id}')
+            elif n_written == 0:
+                print(f'{track_id} is up to date, skipping.')
+    return {'tracks': n_done, 'failed': failed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of Slakh, with .flac or .wav audio.')
+    parser.add_argument('--output-dir', '-o', type=str, required=True,
+                        help='Base directory of the output.')
+    parser.add_argument('--sample-rate', '-sr', type=int, default=None,
+                        help='Sample rate of the output. Defaults to the sample rate of the input.')
+    parser.add_argument('--submix-definition-file', '-s', type=str, nargs='+', default=[],
+                        help='Path(s) to yaml file(s) that define submixes to make.')
+    parser.add_argument('--no-stems', action='store_true',
+                        help='Do not write the stems, only the mix and submixes.')
+    parser.add_argument('--no-mix', action='store_true', help='Do not write the mix.')
+    parser.add_argument('--format', '-f', type=str, choices=OUTPUT_FORMATS, default='wav',
+                        help='Audio format of the output.')
+    parser.add_argument('--block-size', '-b', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='Number of frames to decode and process at a time.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of worker processes.')
+    parser.add_argument('--mirror-mode', '-m', type=str, default='hardlink', choices=MIRROR_MODES,
+                        help='How to mirror metadata and MIDI files into the output.')
+    parser.add_argument('--start', type=int, default=None,
+                        help='If preprocessing a subset, the lowest Track ID.')
+    parser.add_argument('--end', type=int, default=None,
+                        help='If preprocessing a subset, the highest Track ID (inclusive).')
+    parser.add_argument('--split', type=str, nargs='+', default=None, choices=SPLITS,
+                        help='If preprocessing a subset, only the tracks in these split directories.')
+    parser.add_argument('--tracks', type=str, nargs='+', default=None,
+                        help='If preprocessing a subset, only these Track IDs.')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Path of a JSON-lines file to write the time spent on each track to.')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Print every track instead of showing a progress line.')
+    args = parser.parse_args()
+    if args.no_stems and args.no_mix and not args.submix_definition_file:
+        parser.error('Nothing to write: give submix definition files (-s) when using both '
+                     '--no-stems and --no-mix.')
+
+    stats = preprocess(args.input_dir, args.output_dir, args.sample_rate,
+                       args.submix_definition_file, not args.no_stems, not args.no_mix,
+                       args.format, args.block_size, args.num_workers, args.mirror_mode,
+                       args.start, args.end, args.split, args.tracks, args.trace,
+                       not args.no_progress)
+    if stats['failed']:
+        sys.exit(1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Polyphase resampling engine. The anti-aliasing filter is designed once per
+# (input_sr, target_sr) pair and reused for every file, and all sources of a track
+# (mix and stems share a length and sample rate) are resampled together as one
+# stacked float32 array.
+#
+# The filter is the same one `scipy.signal.resample_poly` designs by default
+# (a Kaiser-windowed sinc with beta=5.0 and 10 zero crossings per side).
+
+import functools
+import math
+from collections import namedtuple
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+
+PolyphaseFilter = namedtuple('PolyphaseFilter', ['up', 'down', 'h', 'n_pre_remove'])
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(input_sr, target_sr):
+    """
+    Designs (or gets the cached) polyphase filter to resample from `input_sr` to `target_sr`.
+    :param input_sr (int): sample rate of the input.
+    :param target_sr (int): sample rate of the output.
+    :return: (PolyphaseFilter) upsampling and downsampling factors, the zero-padded float32
+        filter taps (read only), and the number of leading output samples to discard to
+        compensate for the delay of the filter.
+    """
+    g = math.gcd(int(input_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(input_sr) // g
+
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * up
+
+    # Zero-pad the filter so the output samples are centered
+    n_pre_pad = down - half_len % down
+    n_pre_remove = (half_len + n_pre_pad) // down
+    h = np.concatenate([np.zeros(n_pre_pad), h]).astype(np.float32)
+    h.flags.writeable = False
+    return PolyphaseFilter(up, down, h, n_pre_remove)
+
+
+def output_length(n_frames, input_sr, target_sr):
+    """
+    Number of output frames when resampling `n_frames` frames from `input_sr` to `target_sr`.
+    """
+    g = math.gcd(int(input_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(input_sr) // g
+    return -(-n_frames * up // down)
+
+
+def resample(x, input_sr, target_sr, axis=-1):
+    """
+    Resamples `x` from `input_sr` to `target_sr` along `axis`. Every other axis is
+    resampled in the same call, so stack sources of equal length (e.g., the mix and
+    stems of a track) to resample them all at once.
+    :param x (np.ndarray): audio to resample. Converted to float32 if it is not already.
+    :param input_sr (int): sample rate of `x`.
+    :param target_sr (int): desired sample rate.
+    :param axis (int): time axis of `x`.
+    :return: (np.ndarray) float32 resampled audio with
+        `output_length(x.shape[axis], input_sr, target_sr)` frames along `axis`.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if input_sr == target_sr:
+        return x.copy()
+
+    up, down, h, n_pre_remove = polyphase_filter(input_sr, target_sr)
+    n_in = x.shape[axis]
+    n_out = output_length(n_in, input_sr, target_sr)
+
+    y = upfirdn(h, x, up, down, axis=axis)
+
+    # The full convolution is zero past its end, so pad if it is shorter than needed
+    y = np.moveaxis(y, axis, -1)
+    missing = n_pre_remove + n_out - y.shape[-1]
+    if missing > 0:
+        y = np.concatenate([y, np.zeros(y.shape[:-1] + (missing,), dtype=y.dtype)], axis=-1)
+    return np.moveaxis(y[..., n_pre_remove:n_pre_remove + n_out], -1, axis)
+
+
+class StreamingResampler(object):
+    """
+    Resamples audio that arrives in blocks, with output that is sample-exact with
+    calling `resample()` on the whole signal at once. Only the last few input frames
+    that the filter still needs are kept between blocks, so memory use is bounded by
+    the block size regardless of how long the signal is.
+
+    >>> streamer = StreamingResampler(44100, 16000)
+    >>> for block in blocks:  # blocks have shape (..., n_frames)
+    ...     out.write(streamer.push(block))
+    >>> out.write(streamer.flush())
+    """
+
+    def __init__(self, input_sr, target_sr):
+        """
+        :param input_sr (int): sample rate of the input.
+        :param target_sr (int): desired sample rate.
+        """
+        self.input_sr = input_sr
+        self.target_sr = target_sr
+        self.up, self.down, self.h, self.n_pre_remove = polyphase_filter(input_sr, target_sr)
+        self._buffer = None  # Input frames that are still needed, starting at _buffer_start
+        self._buffer_start = 0
+        self._n_in = 0
+        self._next_out = self.n_pre_remove  # Index of the next output in the full convolution
+
+    def _first_needed_input(self, m):
+        # First input frame that output `m` depends on, rounded down to a multiple of `down`
+        # so that the output phase of a convolution starting there matches the full one.
+        first = max(0, -(-(m * self.down - len(self.h) + 1) // self.up))
+        return first // self.down * self.down
+
+    def _outputs(self, m_end):
+        """
+        Computes outputs `_next_out` up to (not including) `m_end` from the buffer, then
+        drops input frames no later output needs.
+        """
+        if m_end <= self._next_out:
+            return np.zeros(self._buffer.shape[:-1] + (0,), dtype=np.float32)
+
+        first = self._first_needed_input(self._next_out)
+        last = (m_end - 1) * self.down // self.up
+        x = self._buffer[..., first - self._buffer_start:last + 1 - self._buffer_start]
+        y = upfirdn(self.h, x, self.up, self.down, axis=-1)
+
+        shift = first // self.down * self.up
+        missing = m_end - shift - y.shape[-1]
+        if missing > 0:
+            y = np.concatenate([y, np.zeros(y.shape[:-1] + (missing,), dtype=y.dtype)], axis=-1)
+        y = y[..., self._next_out - shift:m_end - shift]
+
+        self._next_out = m_end
+        keep = self._first_needed_input(m_end)
+        self._buffer = self._buffer[..., keep - self._buffer_start:]
+        self._buffer_start = keep
+        return y
+
+    def push(self, block):
+        """
+        Adds a block of input and returns every output frame that can be computed so far.
+        :param block (np.ndarray): input frames, with time on the last axis. All blocks
+            must have the same shape except for the last axis.
+        :return: (np.ndarray) float32 output frames, with time on the last axis. Can be empty.
+        """
+        block = np.asarray(block, dtype=np.float32)
+        if self._buffer is None:
+            self._buffer = block.copy()
+        else:
+            self._buffer = np.concatenate([self._buffer, block], axis=-1)
+        self._n_in += block.shape[-1]
+        if self._n_in == 0:
+            return self._outputs(0)
+
+        # Outputs are complete once the last input frame they depend on has arrived
+        return self._outputs((self._n_in * self.up - 1) // self.down + 1)
+
+    def flush(self):
+        """
+        Returns the remaining output frames, treating the input as ended. The total number of
+        frames returned by `push()` and `flush()` is
+        `output_length(total input frames, input_sr, target_sr)`.
+        :return: (np.ndarray) float32 output frames, with time on the last axis.
+        """
+        if self._buffer is None:
+            return np.zeros((0,), dtype=np.float32)
+
+        m_end = self.n_pre_remove + output_length(self._n_in, self.input_sr, self.target_sr)
+        last = (m_end - 1) * self.down // self.up
+        n_pad = last + 1 - self._buffer_start - self._buffer.shape[-1]
+        if n_pad > 0:
+            pad = np.zeros(self._buffer.shape[:-1] + (n_pad,), dtype=np.float32)
+            self._buffer = np.concatenate([self._buffer, pad], axis=-1)
+        return self._outputs(m_end)
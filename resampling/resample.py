@@ -1,20 +1,29 @@
 #!/usr/bin/env python3
 
 import os
-import shutil
 import sys
 
 import yaml
 import json
 import soundfile as sf
 import numpy as np
-import stempeg
-import librosa
+import ffmpeg
 import argparse
+from contextlib import ExitStack
+from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 
 from loguru import logger
 
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import SPLITS, find_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
+from common.manifest import TrackManifest, atomic_output, remove_partial_outputs  # noqa: E402
+from common.mirror import MIRROR_MODES, mirror_track_extras  # noqa: E402
+from conversion.reader import read_audio  # noqa: E402
+from resampling.engine import StreamingResampler, output_length, resample  # noqa: E402
+
 
 def get_args(parser):
     parser.add_argument('--input-dir', '-i', required=True, type=str, help='Input base directory.')
@@ -22,7 +31,30 @@ def get_args(parser):
                         help='Output base directory.')
     parser.add_argument('--dataset', '-d', required=True, type=str, help='Dataset to resample')
     parser.add_argument('--sample_rate', '-sr', required=True, type=int, help='Target sample rate')
-    parser.add_argument('--n-threads', '-t', required=True, type=int, help='Number of threads to run in parallel.')
+    parser.add_argument('--n-threads', '-t', required=True, type=int, help='Number of processes (Slakh) or threads (MUSDB) '
+                                                                             'to run in parallel.')
+    parser.add_argument('--mirror-mode', '-m', required=False, type=str, default='hardlink',
+                        choices=MIRROR_MODES,
+                        help='How to mirror metadata and MIDI files into the output (Slakh only).')
+    parser.add_argument('--block-size', '-b', required=False, type=int, default=None,
+                        help='Stream audio through the resampler in blocks of this many frames, '
+                             'instead of loading whole files (Slakh only).')
+    parser.add_argument('--keep-stereo', action='store_true',
+                        help='Keep MUSDB stems stereo instead of summing them to mono (MUSDB only).')
+    parser.add_argument('--trace', required=False, type=str, default=None,
+                        help='Path of a JSON-lines file to write the time spent on each track to.')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Log every track instead of showing a progress line.')
+    parser.add_argument('--start', required=False, type=int, default=None,
+                        help='If resampling a subset, the lowest Track ID (Slakh only).')
+    parser.add_argument('--end', required=False, type=int, default=None,
+                        help='If resampling a subset, the highest Track ID, inclusive (Slakh only).')
+    parser.add_argument('--split', required=False, type=str, nargs='+', default=None,
+                        choices=SPLITS,
+                        help='If resampling a subset, only the tracks in these split directories '
+                             '(Slakh only).')
+    parser.add_argument('--tracks', required=False, type=str, nargs='+', default=None,
+                        help='If resampling a subset, only these Track IDs (Slakh only).')
     args = parser.parse_args()
     return args
 
@@ -39,104 +71,314 @@ def main():
     logger.remove()
     logger.add(sys.stdout, format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
                                   "<level>{level: <8}</level> | "
-                                  "<level>{message}</level>")
+                                  "<level>{message}</level>", level='INFO')
 
     logger.info('Starting resampling...')
     if dataset in ['slakh', 'flakh']:
-        slakh_resample(base_dir, sample_rate, output_dir, n_threads)
+        slakh_resample(base_dir, sample_rate, output_dir, n_threads, args.mirror_mode,
+                       args.block_size, args.trace, not args.no_progress, args.start, args.end,
+                       args.split, args.tracks)
     elif dataset == 'musdb':
-        musdb_decode_and_resample(base_dir, sample_rate, output_dir, n_threads)
+        musdb_decode_and_resample(base_dir, sample_rate, output_dir, n_threads, args.keep_stereo,
+                                  args.trace, not args.no_progress)
     else:
         raise ValueError(f'Cannot resample {dataset}')
 
     logger.info('Completed resampling.')
 
 
-def resample_wav(in_path, out_path, sr):
-    wav, input_sr = sf.read(in_path)
-    wav = librosa.resample(wav, input_sr, sr, scale=False)
-    sf.write(out_path, wav, sr)
+def resample_wav(in_path, out_path, sr, block_size=None, timer=None):
+    """
+    Resamples one file to `sr`.
+    :param in_path: path to the input file.
+    :param out_path: path to the output file.
+    :param sr: sample rate of the output file.
+    :param block_size: if not `None`, read, resample, and write the file in blocks of this
+        many frames instead of loading it all at once. The output is the same either way.
+    :param timer: (StageTimer) optional timer of the decode, process, and write stages.
+    """
+    timer = timer if timer is not None else StageTimer(in_path)
+    if block_size:
+        _resample_streaming([(in_path, out_path)], [sf.info(in_path)], sr, block_size, timer)
+        return
+
+    info = sf.info(in_path)
+    with timer.stage('decode'):
+        wav, input_sr = sf.read(in_path, dtype='float32')
+    with timer.stage('process'):
+        wav = resample(wav, input_sr, sr, axis=0)
+    with timer.stage('write'), atomic_output(out_path) as temp_path:
+        sf.write(temp_path, wav, sr, subtype=info.subtype)
+
 
+def _resample_streaming(paths, infos, target_sr, block_size, timer):
+    """
+    Resamples files with the same sample rate in lockstep, block by block. Every channel
+    of every file is a row of one stacked array that goes through a single
+    `StreamingResampler`, and output is written as it becomes available.
+    """
+    input_sr = infos[0].samplerate
+    rows = np.cumsum([0] + [i.channels for i in infos])
+    n_out = [output_length(i.frames, input_sr, target_sr) for i in infos]
+    written = [0] * len(paths)
+    streamer = StreamingResampler(input_sr, target_sr)
+    block = np.zeros((rows[-1], block_size), dtype=np.float32)
 
-def slakh_resample(input_dir, target_sr, output_dir, n_threads=1):
+    with ExitStack() as stack:
+        in_files = [stack.enter_context(sf.SoundFile(in_path)) for in_path, _ in paths]
+        out_files = []
+        for (_, out_path), info in zip(paths, infos):
+            # Each output is closed before `atomic_output` renames it, since exits run in reverse
+            temp_path = stack.enter_context(atomic_output(out_path))
+            out_files.append(stack.enter_context(
+                sf.SoundFile(temp_path, 'w', target_sr, info.channels, info.subtype)))
 
-    pool = ThreadPool(n_threads)
-    track_dirs = sorted([track_dir for track_dir in os.listdir(input_dir)
-                         if os.path.isdir(os.path.join(input_dir, track_dir))
-                         and 'metadata.yaml' in os.listdir(os.path.join(input_dir, track_dir))])
+        def _write(resampled):
+            with timer.stage('write'):
+                for i, f in enumerate(out_files):
+                    n = min(resampled.shape[-1], n_out[i] - written[i])
+                    if n > 0:
+                        f.write(resampled[rows[i]:rows[i + 1], :n].T)
+                        written[i] += n
 
-    def _resamp(track_dir):
-        logger.info(f'Resampling {track_dir} stems...')
-        input_track_dir = os.path.join(input_dir, track_dir)
-        output_track_dir = os.path.join(output_dir, track_dir)
-        os.makedirs(output_track_dir, exist_ok=True)
+        for start in range(0, max(i.frames for i in infos), block_size):
+            n = min(block_size, max(i.frames for i in infos) - start)
+            with timer.stage('decode'):
+                for i, f in enumerate(in_files):
+                    data = f.read(n, dtype='float32', always_2d=True, fill_value=0)
+                    block[rows[i]:rows[i + 1], :n] = data.T
+            with timer.stage('process'):
+                resampled = streamer.push(block[:, :n])
+            _write(resampled)
+        with timer.stage('process'):
+            resampled = streamer.flush()
+        _write(resampled)
 
-        in_mix_path = os.path.join(input_track_dir, 'mix.wav')
-        out_mix_path = os.path.join(output_track_dir, 'mix.wav')
-        resample_wav(in_mix_path, out_mix_path, target_sr)
 
-        shutil.copy(os.path.join(input_track_dir, 'metadata.yaml'),
-                    os.path.join(output_track_dir, 'metadata.yaml'))
-        shutil.copy(os.path.join(input_track_dir, 'all_src.mid'),
-                    os.path.join(output_track_dir, 'all_src.mid'))
-        if not os.path.isdir(os.path.join(output_track_dir, 'MIDI')):
-            shutil.copytree(os.path.join(input_track_dir, 'MIDI'),
-                            os.path.join(output_track_dir, 'MIDI'))
+def resample_files(paths, target_sr, block_size=None, timer=None):
+    """
+    Resamples several mono files with the same sample rate (e.g., the mix and stems of a
+    track) in one call by stacking them into a single float32 array. Files of different
+    lengths are zero-padded to the longest one, which does not change the result.
+    Falls back to resampling one at a time if the files are not all mono at the same rate.
+    :param paths (list): list of (input_path, output_path) tuples.
+    :param target_sr (int): sample rate of the output files.
+    :param block_size (int): if not `None`, stream the files through the resampler in
+        blocks of this many frames, so memory use does not depend on their length.
+    :param timer (StageTimer): optional timer of the decode, process, and write stages,
+        which also counts the files, bytes, and seconds of audio.
+    """
+    timer = timer if timer is not None else StageTimer(paths[0][0])
+    infos = [sf.info(in_path) for in_path, _ in paths]
+    timer.count(files=len(paths), bytes_in=sum(os.path.getsize(i) for i, _ in paths),
+                audio_seconds=sum(i.frames / i.samplerate for i in infos))
+    _resample_files(paths, infos, target_sr, block_size, timer)
+    timer.count(bytes_out=sum(os.path.getsize(o) for _, o in paths))
 
-        in_stems_dir = os.path.join(input_track_dir, 'stems')
-        out_stems_dir = os.path.join(output_track_dir, 'stems')
-        os.makedirs(out_stems_dir, exist_ok=True)
-        for src in os.listdir(in_stems_dir):
+
+def _resample_files(paths, infos, target_sr, block_size, timer):
+    input_sr = infos[0].samplerate
+    if any(i.channels != 1 or i.samplerate != input_sr for i in infos):
+        for in_path, out_path in paths:
+            resample_wav(in_path, out_path, target_sr, block_size, timer)
+        return
+
+    if block_size:
+        _resample_streaming(paths, infos, target_sr, block_size, timer)
+        return
+
+    stacked = np.zeros((len(paths), max(i.frames for i in infos)), dtype=np.float32)
+    with timer.stage('decode'):
+        for row, ((in_path, _), info) in enumerate(zip(paths, infos)):
+            read_audio(in_path, out=stacked[row, :info.frames])
+
+    with timer.stage('process'):
+        resampled = resample(stacked, input_sr, target_sr)
+    with timer.stage('write'):
+        for row, ((_, out_path), info) in enumerate(zip(paths, infos)):
+            n_out = output_length(info.frames, input_sr, target_sr)
+            with atomic_output(out_path) as temp_path:
+                sf.write(temp_path, resampled[row, :n_out], target_sr, subtype=info.subtype)
+
+
+def _resample_slakh_track(job):
+    """
+    Resamples the mix and stems of one track that are not up to date in the output
+    track's manifest. Runs in a worker process.
+    :return: (str, int, StageTimer) track directory name, number of files resampled, and
+        the time spent on each stage.
+    """
+    input_track_dir, output_track_dir, target_sr, mirror_mode, block_size = job
+    in_stems_dir = os.path.join(input_track_dir, 'stems')
+    out_stems_dir = os.path.join(output_track_dir, 'stems')
+    timer = StageTimer(os.path.basename(input_track_dir))
+
+    # Figure out which files still need resampling, per this track's manifest
+    with timer.stage('discover'):
+        manifest = TrackManifest(output_track_dir, {'target_sr': target_sr})
+        todo = [(os.path.join(input_track_dir, 'mix.wav'),
+                 os.path.join(output_track_dir, 'mix.wav'))]
+        for src in sorted(os.listdir(in_stems_dir)):
             if os.path.splitext(src)[-1] != '.wav':
                 continue
-            in_src_path = os.path.join(in_stems_dir, src)
-            out_src_path = os.path.join(out_stems_dir, src)
-            resample_wav(in_src_path, out_src_path, target_sr)
+            todo.append((os.path.join(in_stems_dir, src), os.path.join(out_stems_dir, src)))
+        todo = [(i, o) for i, o in todo if not manifest.is_current(i, o)]
+    if not todo:
+        return os.path.basename(input_track_dir), 0, timer
+
+    with timer.stage('copy_metadata'):
+        os.makedirs(out_stems_dir, exist_ok=True)
+        remove_partial_outputs(output_track_dir)
+        remove_partial_outputs(out_stems_dir)
+        mirror_track_extras(input_track_dir, output_track_dir, mirror_mode)
 
-    pool.map(_resamp, track_dirs)
+    resample_files(todo, target_sr, block_size, timer)
+    with timer.stage('write'):
+        for in_path, out_path in todo:
+            manifest.record(in_path, out_path)
+    return os.path.basename(input_track_dir), len(todo), timer
 
 
-def musdb_decode_and_resample(input_dir, target_sr, output_dir, n_threads):
+def slakh_resample(input_dir, target_sr, output_dir, n_threads=1, mirror_mode='hardlink',
+                   block_size=None, trace_path=None, progress=False, start=None, end=None,
+                   splits=None, track_ids=None):
     """
-    Reads MUSDB18 .stem.mp4 files, splits them into .wav files at `target_sr`.
-    Sums the stereo files to mono TODO: option to not sum to mono
-    :param input_dir:
-    :param target_sr:
-    :param output_dir:
-    :param n_threads:
-    :return:
+    Resamples every track in a Slakh directory of .wav files. Tracks are spread across
+    `n_threads` worker processes, and within a track the mix and all stems are resampled
+    together (see `resample_files()`).
+    :param input_dir: base directory of Slakh (as .wav files).
+    :param target_sr: sample rate of the output.
+    :param output_dir: base directory of the resampled copy.
+    :param n_threads: number of worker processes.
+    :param mirror_mode: how to mirror the non-audio files, see `common/mirror.py`.
+    :param block_size: if not `None`, stream each track through the resampler in blocks of
+        this many frames, which bounds memory per worker regardless of track length.
+    :param trace_path: path of a JSON-lines file to write the time spent on each track to,
+        see `common/instrument.py`.
+    :param progress: show a progress line with an ETA instead of logging every track.
+    :param start: lowest Track ID to resample (e.g., 1 for Track00001), inclusive.
+    :param end: highest Track ID to resample, inclusive.
+    :param splits: only resample tracks in these split directories (e.g., ['train']).
+    :param track_ids: only resample these tracks (e.g., ['Track00001']).
+    """
+    timer = StageTimer('discover')
+    with timer.stage('discover'):
+        tracks = find_tracks(input_dir, start, end, splits, track_ids,
+                             require_file='metadata.yaml')
+    # The output keeps the split layout of the input
+    jobs = [(t.path, os.path.join(output_dir, t.relative_path), target_sr, mirror_mode,
+             block_size) for t in tracks]
+
+    log = logger.debug if progress else logger.info
+    with Tracer('resample', total=len(jobs), trace_path=trace_path, progress=progress) as tracer, \
+            Pool(n_threads) as pool:
+        tracer.record(timer, done=0)
+        for track_dir, n_resampled, timer in pool.imap_unordered(_resample_slakh_track, jobs):
+            tracer.record(timer)
+            if n_resampled:
+                log(f'Resampled {n_resampled} files in {track_dir}.')
+            else:
+                log(f'{track_dir} is up to date, skipping.')
+
+
+MUSDB_STEM_LABELS = ['mixture', 'drums', 'bass', 'other', 'vocals']
+
+
+def _audio_streams(stempeg_path):
+    """
+    Probes a .stem.mp4 file with ffmpeg.
+    :return: (list) ffprobe info of every audio stream (stem) in the file, in order.
+    """
+    return [s for s in ffmpeg.probe(stempeg_path)['streams'] if s['codec_type'] == 'audio']
+
+
+def _decode_stem(stempeg_path, stem_idx, stream_info, keep_stereo=False):
+    """
+    Decodes one stem (audio stream) of a .stem.mp4 file with ffmpeg as float32. Unless
+    `keep_stereo` is set, ffmpeg sums the channels to mono while decoding, so only the
+    mono stem is ever held in memory.
+    :param stream_info: (dict) ffprobe info of the stem's stream, see `_audio_streams()`.
+    :return: (np.ndarray, int) audio of shape (n_frames, n_channels), and its sample rate.
     """
-    stem_labels = ['mixture', 'drums', 'bass', 'other', 'vocals']
+    sr = int(stream_info['sample_rate'])
+    n_channels = int(stream_info['channels']) if keep_stereo else 1
+
+    output_kwargs = {'format': 'f32le', 'acodec': 'pcm_f32le'}
+    if not keep_stereo:
+        channels = '+'.join(f'c{c}' for c in range(int(stream_info['channels'])))
+        output_kwargs['af'] = f'pan=mono|c0={channels}'
+    out, _ = (ffmpeg.input(stempeg_path)[f'a:{stem_idx}']
+              .output('pipe:', **output_kwargs)
+              .run(capture_stdout=True, capture_stderr=True))
+    return np.frombuffer(out, dtype='<f4').reshape(-1, n_channels), sr
+
 
-    pool = ThreadPool(n_threads)
+def _resample_musdb_stem(job):
+    stempeg_path, stem_idx, stream_info, output_wav_dir, target_sr, keep_stereo = job
+    timer = StageTimer(f'{stempeg_path}:{MUSDB_STEM_LABELS[stem_idx]}')
+    with timer.stage('decode'):
+        wav, input_sr = _decode_stem(stempeg_path, stem_idx, stream_info, keep_stereo)
+    with timer.stage('process'):
+        wav = resample(wav, input_sr, target_sr, axis=0)
+    out_path = os.path.join(output_wav_dir, f'{MUSDB_STEM_LABELS[stem_idx]}.wav')
+    with timer.stage('write'), atomic_output(out_path) as temp_path:
+        sf.write(temp_path, wav, target_sr)
+    timer.count(files=1, bytes_out=os.path.getsize(out_path), audio_seconds=len(wav) / target_sr)
+    return stempeg_path, timer
 
+
+def musdb_decode_and_resample(input_dir, target_sr, output_dir, n_threads, keep_stereo=False,
+                              trace_path=None, progress=False):
+    """
+    Reads MUSDB18 .stem.mp4 files, splits them into .wav files at `target_sr`.
+    Each stem is decoded separately by ffmpeg (which also sums it to mono, unless
+    `keep_stereo` is set) and resampled on its own, so stems of the same file are
+    processed in parallel and a worker only holds one stem in memory at a time.
+    :param input_dir: base directory of MUSDB18 (with train/test subdirectories).
+    :param target_sr: sample rate of the output.
+    :param output_dir: base directory of the output.
+    :param n_threads: number of stems to decode and resample at once.
+    :param keep_stereo: if `True`, keep the stems stereo instead of summing them to mono.
+    :param trace_path: path of a JSON-lines file to write the time spent on each stem to,
+        see `common/instrument.py`.
+    :param progress: show a progress line with an ETA instead of logging every file.
+    """
+    files = []  # (path to a .stem.mp4 file, its output directory)
     for split in ['train', 'test']:
         in_dir = os.path.join(input_dir, split)
         if not os.path.isdir(in_dir):
-            logger.warning(f'Looking for f{in_dir}, but not found!')
+            logger.warning(f'Looking for {in_dir}, but not found!')
             continue
 
         out_dir = os.path.join(output_dir, split)
-        os.makedirs(out_dir, exist_ok=True)
-        stempeg_paths = [f for f in os.listdir(in_dir)
-                         if os.path.isfile(os.path.join(in_dir, f))
-                         if os.path.splitext(f)[1] == '.mp4']
+        stempeg_filenames = [f for f in os.listdir(in_dir)
+                             if os.path.isfile(os.path.join(in_dir, f))
+                             if os.path.splitext(f)[1] == '.mp4']
 
-        def _resamp(stempeg_filename):
-            stempeg_path = os.path.join(in_dir, stempeg_filename)
+        for stempeg_filename in sorted(stempeg_filenames):
             stempeg_filename_stub = stempeg_filename.replace('.stem.mp4', '').replace(' ', '')
             output_wav_dir = os.path.join(out_dir, stempeg_filename_stub)
             os.makedirs(output_wav_dir, exist_ok=True)
+            files.append((os.path.join(in_dir, stempeg_filename), output_wav_dir))
 
-            # read stempeg format
-            stem, input_sr = stempeg.read_stems(stempeg_path)
-            for i, name in enumerate(stem_labels):
-                wav = np.sum(stem[i, ...], axis=1)  # sum to mono
-                wav = librosa.resample(wav, input_sr, target_sr)
-                out_path = os.path.join(output_wav_dir, f'{name}.wav')
-                sf.write(out_path, wav, target_sr)
-
-        pool.map(_resamp, stempeg_paths)
+    n_done = {}
+    log = logger.debug if progress else logger.info
+    with ThreadPool(n_threads) as pool:
+        # Every file is probed once, and its stems' jobs share the result
+        timer = StageTimer('discover')
+        with timer.stage('discover'):
+            streams = pool.map(_audio_streams, [path for path, _ in files])
+        jobs = [(path, stem_idx, file_streams[stem_idx], output_wav_dir, target_sr, keep_stereo)
+                for (path, output_wav_dir), file_streams in zip(files, streams)
+                for stem_idx in range(len(MUSDB_STEM_LABELS))]
+        with Tracer('resample', total=len(jobs), unit='stems', trace_path=trace_path,
+                    progress=progress) as tracer:
+            tracer.record(timer, done=0)
+            for stempeg_path, timer in pool.imap_unordered(_resample_musdb_stem, jobs):
+                tracer.record(timer)
+                n_done[stempeg_path] = n_done.get(stempeg_path, 0) + 1
+                if n_done[stempeg_path] == len(MUSDB_STEM_LABELS):
+                    log(f'Resampled {os.path.basename(stempeg_path)}.')
 
 
 if __name__ == '__main__':
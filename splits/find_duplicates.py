@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#
+# Finds tracks whose `all_src.mid` files are duplicates of each other, and writes
+# `duplicates.json` plus split files (like `splits_v2.json` and `redux.json`) in which
+# no MIDI file is in more than one split.
+#
+# Exact duplicates are found by md5 hash. Near duplicates (e.g., the same notes with
+# different tempo events or tracks in a different order) are found by fingerprinting
+# the note events of each file, independent of tempo and track order, and comparing
+# MinHash signatures of the fingerprints through locality-sensitive hashing, so files
+# are only compared to likely duplicates instead of to every other file.
+# See the README about how to use.
+
+import os
+import sys
+import json
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import find_tracks  # noqa: E402
+from common.manifest import file_md5  # noqa: E402
+from common.midi_notes import read_notes  # noqa: E402
+from splits.resplit_slakh import orig_split  # noqa: E402
+
+
+MIDI_NAME = 'all_src.mid'
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _find_midi_files(base_dir):
+    """
+    Finds the `all_src.mid` of every track in `base_dir` (flat layout) and in its split
+    subdirectories.
+    :return: (dict) track id -> (split or `None`, path to the MIDI file).
+    """
+    return {t.track_id: (t.split, os.path.join(t.path, MIDI_NAME))
+            for t in find_tracks(base_dir, require_file=MIDI_NAME)}
+
+
+def note_shingles(notes, grid=12, k=4):
+    """
+    Fingerprints the note events of a MIDI file as a set of hashed shingles. Onsets are
+    measured in beats (so tempo events do not matter) and quantized to `grid` steps per
+    beat, and notes from all tracks are merged and sorted (so track order does not matter).
+    Each shingle is `k` consecutive (pitch, time since previous onset) pairs, so the
+    fingerprint also does not depend on where the music starts.
+    :param notes: (dict) output of `common.midi_notes.read_notes()`.
+    :param grid: (int) steps per beat to quantize onsets to.
+    :param k: (int) number of consecutive notes per shingle.
+    :return: (np.ndarray) sorted unique uint64 shingle hashes. Empty for files with fewer
+        than `k` notes, which are too short to fingerprint and can only match by md5.
+    """
+    if len(notes['pitch']) < k:
+        return np.zeros(0, dtype=np.uint64)
+    onsets = np.round(notes['start_tick'] * grid / notes['ticks_per_beat']).astype(np.int64)
+    pitch = notes['pitch'].astype(np.int64) + 128 * notes['is_drum']
+    order = np.lexsort((pitch, onsets))
+    onsets, pitch = onsets[order], pitch[order]
+
+    deltas = np.minimum(np.diff(onsets, prepend=onsets[0]), 4 * grid)
+    events = (pitch << 8) | deltas  # one int per note
+    windows = np.lib.stride_tricks.sliding_window_view(events, k)
+    # Cheap polynomial hash of each window of k events
+    multipliers = np.array([1000003 ** i for i in range(k)], dtype=np.uint64)
+    hashes = (windows.astype(np.uint64) * multipliers).sum(axis=1)
+    return np.unique(hashes)
+
+
+class MinHasher(object):
+    """
+    MinHash signatures of sets of integers, for estimating Jaccard similarity.
+    """
+
+    def __init__(self, n_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MAX_HASH, size=(n_perm, 1), dtype=np.uint64)
+        self.b = rng.randint(0, _MAX_HASH, size=(n_perm, 1), dtype=np.uint64)
+
+    def signature(self, values):
+        """
+        :param values: (np.ndarray) uint64 set members.
+        :return: (np.ndarray) uint64 signature with `n_perm` entries, or `None` for an empty
+            set, which has no meaningful similarity to anything (e.g., a MIDI file without notes).
+        """
+        if len(values) == 0:
+            return None
+        values = (values & np.uint64(_MAX_HASH))[None, :]
+        return ((self.a * values + self.b) % np.uint64(_MERSENNE_PRIME)).min(axis=1)
+
+
+def _fingerprint(job):
+    track_id, midi_path, n_perm = job
+    # Unreadable MIDI, and MIDI without notes, can still be matched by md5
+    md5 = file_md5(midi_path)
+    try:
+        signature = MinHasher(n_perm).signature(note_shingles(read_notes(midi_path)))
+    except (OSError, ValueError, EOFError, KeyError, IndexError) as e:
+        print(f'Could not read notes from {midi_path}: {e}', file=sys.stderr)
+        signature = None
+    return track_id, md5, signature
+
+
+class _UnionFind(object):
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[max(x, y)] = min(x, y)
+
+
+def find_duplicates(base_dir, n_workers=1, threshold=0.9, n_perm=64, n_bands=16, exact_only=False,
+                    max_candidates=100):
+    """
+    Finds groups of tracks with duplicated MIDI.
+    :param base_dir: (str) base directory of a Slakh-style dataset.
+    :param n_workers: (int) number of processes to hash and fingerprint files with.
+    :param threshold: (float) estimated Jaccard similarity of note fingerprints above which
+        two files are near duplicates.
+    :param n_perm: (int) number of MinHash permutations. Must be divisible by `n_bands`.
+    :param n_bands: (int) number of LSH bands. More bands find more candidate pairs.
+    :param exact_only: (bool) only find exact (md5) duplicates.
+    :param max_candidates: (int) maximum number of other members of an LSH bucket each
+        member is compared to, so that unusually large buckets do not take quadratic time.
+    :return: (dict, dict) track id -> {'midi_md5', 'midi_duplicates'} (the format of
+        `duplicates.json`), and track id -> split (or `None`) of each track found.
+    """
+    if n_perm % n_bands:
+        raise ValueError(f'n_perm ({n_perm}) must be divisible by n_bands ({n_bands}).')
+
+    midi_files = _find_midi_files(base_dir)
+    jobs = [(track_id, path, n_perm) for track_id, (_, path) in sorted(midi_files.items())]
+    with Pool(n_workers) as pool:
+        if exact_only:
+            results = [(j[0], md5, None) for j, md5 in
+                       zip(jobs, pool.map(file_md5, [j[1] for j in jobs], chunksize=64))]
+        else:
+            results = pool.map(_fingerprint, jobs, chunksize=16)
+
+    groups = _UnionFind()
+    by_md5 = {}
+    for track_id, md5, _ in results:
+        groups.find(track_id)
+        if md5 in by_md5:
+            groups.union(by_md5[md5], track_id)
+        else:
+            by_md5[md5] = track_id
+
+    # Only tracks that share a whole band of their signature are compared
+    rows = n_perm // n_bands
+    buckets = {}
+    signatures = {t: s for t, _, s in results if s is not None}
+    for track_id, signature in signatures.items():
+        for band in range(n_bands):
+            key = (band, signature[band * rows:(band + 1) * rows].tobytes())
+            buckets.setdefault(key, []).append(track_id)
+
+    # Members of a bucket with identical signatures are duplicates without comparing them.
+    # Otherwise every pair in a bucket is compared (up to `max_candidates` per member),
+    # since two members can be near duplicates of each other without either being one of
+    # the bucket's first member
+    for members in buckets.values():
+        distinct = {}
+        for track_id in members:
+            key = signatures[track_id].tobytes()
+            if key in distinct:
+                groups.union(distinct[key], track_id)
+            else:
+                distinct[key] = track_id
+        members = list(distinct.values())
+        if len(members) < 2:
+            continue
+        matrix = np.stack([signatures[t] for t in members])
+        for i, first in enumerate(members[:-1]):
+            candidates = members[i + 1:i + 1 + max_candidates]
+            similarity = np.mean(matrix[i + 1:i + 1 + len(candidates)] == matrix[i], axis=1)
+            for track_id in np.asarray(candidates)[similarity >= threshold]:
+                groups.union(first, str(track_id))
+
+    members = {}
+    for track_id, _, _ in results:
+        members.setdefault(groups.find(track_id), []).append(track_id)
+
+    duplicates = {}
+    for track_id, md5, _ in results:
+        group = members[groups.find(track_id)]
+        duplicates[track_id] = {
+            'midi_md5': md5,
+            'midi_duplicates': sorted(t for t in group if t != track_id),
+        }
+    return duplicates, {t: split for t, (split, _) in midi_files.items()}
+
+
+def make_splits(duplicates, splits):
+    """
+    Makes split files in the format of `splits_v2.json` (every track kept, groups of
+    duplicates moved into one split) and `redux.json` (one track of each group of
+    duplicates kept, the rest omitted). Each group goes to the split most of its tracks
+    are already in; ties go to the split of the group's first track.
+    :param duplicates: (dict) output of `find_duplicates()`.
+    :param splits: (dict) track id -> current split, as returned by `find_duplicates()`.
+    :return: (dict, dict) the 'split2' and 'redux' style split data.
+    """
+    flat = sorted(t for t, s in splits.items() if s is None)
+    if flat:
+        raise ValueError(f'{len(flat)} tracks (e.g., {flat[0]}) are not in a split directory, '
+                         f'so split files cannot be made for them.')
+
+    def _move(track_id, source, dest):
+        # Like `resplit_slakh.py`, no action means the track is in its Slakh2100-orig split
+        if dest == orig_split(track_id):
+            return {'action': None}
+        return {'action': 'move', 'source_split': source, 'destination_split': dest}
+
+    split2, redux = {}, {}
+    for track_id in sorted(duplicates):
+        group = sorted([track_id] + duplicates[track_id]['midi_duplicates'])
+        counts = Counter(splits[t] for t in group)
+        best = max(counts.values())
+        dest = next(splits[t] for t in group if counts[splits[t]] == best)
+        source = splits[track_id]
+        split2[track_id] = _move(track_id, source, dest)
+
+        keeper = next(t for t in group if splits[t] == dest)
+        if track_id != keeper:
+            redux[track_id] = {'action': 'omit', 'source_split': source}
+        else:
+            redux[track_id] = _move(track_id, source, source)
+    return split2, redux
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', '-i', type=str, required=True,
+                        help='Base directory of the dataset (flat, or with train/validation/test '
+                             'subdirectories).')
+    parser.add_argument('--output-dir', '-o', type=str, required=True,
+                        help='Directory to write duplicates.json, splits_v2.json, and redux.json to.')
+    parser.add_argument('--num-workers', '-t', type=int, default=1,
+                        help='Number of processes to hash MIDI files with.')
+    parser.add_argument('--threshold', type=float, default=0.9,
+                        help='Similarity of note fingerprints (0-1) above which two MIDI files '
+                             'are near duplicates.')
+    parser.add_argument('--exact-only', '-e', action='store_true',
+                        help='Only find exact (md5) duplicates.')
+    args = parser.parse_args()
+
+    duplicates, track_splits = find_duplicates(args.input_dir, args.num_workers, args.threshold,
+                                               exact_only=args.exact_only)
+    outputs = [('duplicates.json', duplicates)]
+    if any(split is None for split in track_splits.values()):
+        print('Tracks are not in train/validation/test subdirectories, so only duplicates.json '
+              'is written.', file=sys.stderr)
+    else:
+        split2, redux = make_splits(duplicates, track_splits)
+        outputs += [('splits_v2.json', split2), ('redux.json', redux)]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, data in outputs:
+        with open(os.path.join(args.output_dir, name), 'w') as f:
+            json.dump(data, f, indent=4)
+
+    n_dups = sum(1 for d in duplicates.values() if d['midi_duplicates'])
+    print(f'{n_dups} of {len(duplicates)} tracks have MIDI duplicates.', file=sys.stderr)
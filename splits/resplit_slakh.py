@@ -2,60 +2,220 @@
 
 import json
 import os
+import sys
 import argparse
 import shutil
 
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import SPLITS, scan_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
 
-def do_all_updates(slakh_base_dir, new_splits_file):
-    with open(new_splits_file) as f:
-        new_splits = json.load(f)
 
-    for track_id, track_dict in new_splits.items():
-        action = track_dict['action']
+SPLIT_DIRS = list(SPLITS)
+JOURNAL_NAME = '.resplit_journal.json'
+VIEW_MANIFEST_NAME = 'splits.json'
 
-        if action:
-            source_dir = track_dict['source_split']
-            source_path = os.path.join(slakh_base_dir, source_dir, track_id)
 
-            if action == 'move':
-                dest_dir = track_dict['destination_split']
-                dest_path = os.path.join(slakh_base_dir, dest_dir, track_id)
+def orig_split(track_id):
+    """
+    The split of a track in Slakh2100-orig.
+    :param track_id (str): e.g., 'Track00001'.
+    :return: (str) 'train', 'validation', or 'test'.
+    """
+    if track_id <= 'Track01500':
+        return 'train'
+    elif track_id <= 'Track01875':
+        return 'validation'
+    else:
+        return 'test'
 
-            elif action == 'omit':
-                omit_dir = os.path.join(slakh_base_dir, 'omitted')
-                os.makedirs(omit_dir, exist_ok=True)
-                dest_path = os.path.join(omit_dir, track_id)
 
-            else:
-                raise ValueError(f"Unknown action: \'{action}\'")
+def target_splits(track_ids, new_splits_file=None):
+    """
+    Figures out the split of every track for a split configuration.
+    :param track_ids: iterable of track ids, e.g., 'Track00001'.
+    :param new_splits_file: path to a json file with split data (splits_v2.json or redux.json).
+        If `None`, gives the splits of Slakh2100-orig.
+    :return: (dict) track id -> split name.
+    """
+    new_splits = {}
+    if new_splits_file is not None:
+        with open(new_splits_file) as f:
+            new_splits = json.load(f)
 
-            shutil.move(source_path, dest_path)
+    targets = {}
+    for track_id in track_ids:
+        action = new_splits.get(track_id, {}).get('action')
+        if not action:
+            targets[track_id] = orig_split(track_id)
+        elif action == 'move':
+            targets[track_id] = new_splits[track_id]['destination_split']
+        elif action == 'omit':
+            targets[track_id] = 'omitted'
+        else:
+            raise ValueError(f"Unknown action: \'{action}\'")
+    return targets
 
 
-def reset(slakh_base_dir):
-    split_dirs = ['train', 'validation', 'test', 'omitted']
+def _current_locations(slakh_base_dir):
+    """
+    Finds which split directory each track is currently in.
+    :return: (dict) track id -> split name.
+    """
+    return {t.track_id: t.split for t in scan_tracks(slakh_base_dir) if t.split is not None}
 
-    track_dirs = []
-    for split in split_dirs:
-        split_path = os.path.join(slakh_base_dir, split)
-        if not os.path.isdir(split_path):
-            continue
-        for track in os.listdir(split_path):
-            track_path = os.path.join(split_path, track)
-            if os.path.isdir(track_path) and track[:5] == 'Track':
-                track_dirs.append(track_path)
 
-    for track_path in track_dirs:
-        track_id = os.path.basename(track_path)
-        if track_id <= 'Track01500':
-            dest_path = os.path.join(slakh_base_dir, 'train', track_id)
-        elif track_id <= 'Track01875':
-            dest_path = os.path.join(slakh_base_dir, 'validation', track_id)
-        else:
-            dest_path = os.path.join(slakh_base_dir, 'test', track_id)
+def _do_moves(slakh_base_dir, moves, tracer=None):
+    """
+    Moves tracks between split directories. Moves that were already done (the track is
+    at its destination, not its source) are skipped, so this can safely be repeated.
+    A track that is at both its source and its destination is an error, since moving it
+    would put one copy inside the other.
+    """
+    for track_id, source_split, dest_split in moves:
+        timer = StageTimer(track_id)
+        source_path = os.path.join(slakh_base_dir, source_split, track_id)
+        dest_path = os.path.join(slakh_base_dir, dest_split, track_id)
+        if os.path.isdir(source_path) and os.path.isdir(dest_path):
+            raise FileExistsError(f'{track_id} is in both {source_split} and {dest_split}. Remove '
+                                  f'one of them and run again.')
+        if os.path.isdir(source_path) or not os.path.isdir(dest_path):
+            with timer.stage('write'):
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                shutil.move(source_path, dest_path)
+        if tracer is not None:
+            tracer.record(timer)
+
+
+def _finish_journal(slakh_base_dir, tracer=None):
+    """
+    Finishes the moves of a previous run that did not complete, if there was one.
+    """
+    journal_path = os.path.join(slakh_base_dir, JOURNAL_NAME)
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path) as f:
+        moves = json.load(f)['moves']
+    print(f'Finishing {len(moves)} track moves from an interrupted run.')
+    if tracer is not None:
+        tracer.total = len(moves)
+    _do_moves(slakh_base_dir, moves, tracer)
+    os.remove(journal_path)
+
+
+def apply_splits(slakh_base_dir, new_splits_file=None, trace_path=None, progress=False):
+    """
+    Moves track directories so that Slakh2100 is in the given split configuration. Only
+    tracks that are not already in their target split are moved, so any configuration
+    can be switched to directly from any other (e.g., Slakh2100-split2 to Slakh2100-redux),
+    and applying the same configuration twice does nothing.
+
+    The planned moves are written to a journal before any track is moved. If the run is
+    interrupted, the next run finishes those moves first.
+    :param slakh_base_dir: base directory of Slakh2100 (with train/validation/test subdirectories).
+    :param new_splits_file: path to a json file with split data (splits_v2.json or redux.json).
+        If `None`, moves back to the splits of Slakh2100-orig.
+    :param trace_path: path of a JSON-lines file to write the time spent on each move to,
+        see `common/instrument.py`.
+    :param progress: show a progress line with an ETA.
+    :return: (int) number of tracks moved.
+    """
+    with Tracer('resplit', trace_path=trace_path, progress=progress) as tracer:
+        _finish_journal(slakh_base_dir, tracer)
+
+        timer = StageTimer('plan')
+        with timer.stage('discover'):
+            locations = _current_locations(slakh_base_dir)
+            targets = target_splits(locations.keys(), new_splits_file)
+            moves = [(track_id, locations[track_id], targets[track_id])
+                     for track_id in sorted(locations) if locations[track_id] != targets[track_id]]
+        tracer.record(timer, done=0)
+        if not moves:
+            return 0
+
+        journal_path = os.path.join(slakh_base_dir, JOURNAL_NAME)
+        with timer.stage('write'):
+            with open(journal_path + '.tmp', 'w') as f:
+                json.dump({'split_file': new_splits_file, 'moves': moves}, f, indent=1)
+            os.replace(journal_path + '.tmp', journal_path)
 
-        if dest_path != track_path:
-            shutil.move(track_path, dest_path)
+        tracer.n_done, tracer.total = 0, len(moves)
+        _do_moves(slakh_base_dir, moves, tracer)
+        os.remove(journal_path)
+        return len(moves)
+
+
+def do_all_updates(slakh_base_dir, new_splits_file, trace_path=None, progress=False):
+    return apply_splits(slakh_base_dir, new_splits_file, trace_path, progress)
+
+
+def reset(slakh_base_dir, trace_path=None, progress=False):
+    return apply_splits(slakh_base_dir, None, trace_path, progress)
+
+
+def make_view(slakh_base_dir, view_dir, new_splits_file=None, manifest_only=False,
+              trace_path=None, progress=False):
+    """
+    Makes a view of Slakh2100 in a split configuration without moving any tracks. The view
+    is a directory with train/validation/test/omitted subdirectories of symlinks to the
+    track directories, wherever they currently are, plus a `splits.json` manifest that
+    lists the tracks in each split. Several views (e.g., one for each configuration) can
+    exist side by side.
+
+    The view is built under a temporary name and then swapped in, so an existing view is
+    replaced all at once and an interrupted run never leaves a half-built view behind.
+    :param slakh_base_dir: base directory of Slakh2100 (with train/validation/test subdirectories).
+    :param view_dir: directory to make the view in.
+    :param new_splits_file: path to a json file with split data (splits_v2.json or redux.json).
+        If `None`, makes a view of Slakh2100-orig.
+    :param manifest_only: if `True`, only write the `splits.json` manifest, no symlinks.
+    :param trace_path: path of a JSON-lines file to write the time spent on each split to,
+        see `common/instrument.py`.
+    :param progress: show a progress line with an ETA.
+    :return: (dict) split name -> sorted list of track ids.
+    """
+    tracer = Tracer('resplit', total=len(SPLIT_DIRS), unit='splits', trace_path=trace_path,
+                    progress=progress)
+    timer = StageTimer('plan')
+    with timer.stage('discover'):
+        locations = _current_locations(slakh_base_dir)
+        targets = target_splits(locations.keys(), new_splits_file)
+        splits = {split: sorted(t for t, s in targets.items() if s == split)
+                  for split in SPLIT_DIRS}
+    tracer.record(timer, done=0)
+
+    view_dir = os.path.abspath(view_dir.rstrip(os.sep))
+    temp_dir = f'{view_dir}.tmp-{os.getpid()}'
+    os.makedirs(temp_dir)
+    try:
+        for split, track_ids in splits.items():
+            timer = StageTimer(split)
+            if not manifest_only:
+                with timer.stage('write'):
+                    os.makedirs(os.path.join(temp_dir, split))
+                    for track_id in track_ids:
+                        track_path = os.path.abspath(os.path.join(
+                            slakh_base_dir, locations[track_id], track_id))
+                        os.symlink(track_path, os.path.join(temp_dir, split, track_id))
+                timer.count(files=len(track_ids))
+            tracer.record(timer)
+        with open(os.path.join(temp_dir, VIEW_MANIFEST_NAME), 'w') as f:
+            json.dump({'base_dir': os.path.abspath(slakh_base_dir),
+                       'split_file': new_splits_file, 'splits': splits}, f, indent=1)
+
+        old_dir = f'{view_dir}.old-{os.getpid()}'
+        if os.path.isdir(view_dir):
+            os.rename(view_dir, old_dir)
+        os.rename(temp_dir, view_dir)
+        # The old view only contains symlinks, which rmtree removes without following
+        shutil.rmtree(old_dir, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    finally:
+        tracer.close()
+    return splits
 
 
 if __name__ == '__main__':
@@ -65,12 +225,32 @@ if __name__ == '__main__':
                         required=True)
     parser.add_argument('--split-file', '-s', type=str, help='Path to a json file containing '
                                                              'split data. Either splits_v2.json '
-                                                             'or redux.json',
-                        default='[[PLEASE PROVIDE SPLIT JSON FILE]]')
+                                                             'or redux.json. Required unless '
+                                                             '--reset is given.',
+                        default=None)
     parser.add_argument('--reset', '-r', action='store_true', help='Reset Slakh2100 directory to '
                                                                    'original splits.')
+    parser.add_argument('--view-dir', '-v', type=str, default=None,
+                        help='Instead of moving tracks, make a view of the splits in this '
+                             'directory out of symlinks to the tracks.')
+    parser.add_argument('--manifest-only', '-m', action='store_true',
+                        help='With --view-dir, only write the splits.json manifest of the view, '
+                             'no symlinks.')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Path of a JSON-lines file to write the time spent on each track '
+                             'move to.')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Do not show the progress line.')
     args = parser.parse_args()
-    if args.reset:
-        reset(args.slakh_dir)
+    if args.split_file is None and not args.reset:
+        parser.error('--split-file/-s is required unless --reset/-r is given')
+    split_file = None if args.reset else args.split_file
+    progress = not args.no_progress
+
+    if args.view_dir:
+        make_view(args.slakh_dir, args.view_dir, split_file, args.manifest_only, args.trace,
+                  progress)
+    elif args.reset:
+        reset(args.slakh_dir, args.trace, progress)
     else:
-        do_all_updates(args.slakh_dir, args.split_file)
+        do_all_updates(args.slakh_dir, args.split_file, args.trace, progress)
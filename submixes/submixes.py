@@ -6,6 +6,8 @@
 # Author: Ethan Manilow
 
 import os
+import sys
+from contextlib import ExitStack
 
 import yaml
 import soundfile as sf
@@ -13,6 +15,12 @@ import numpy as np
 from multiprocessing.dummy import Pool as ThreadPool
 import argparse
 
+# Allow running this file as a script from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.discovery import find_tracks  # noqa: E402
+from common.instrument import StageTimer, Tracer  # noqa: E402
+from common.manifest import atomic_output  # noqa: E402
+
 
 def _file_ready_string(string):
     """
@@ -24,14 +32,17 @@ def _file_ready_string(string):
     return string.replace(' ', '_').lower()
 
 
-class Submixes(object):
+class SubmixDefinition(object):
+    """
+    One submix definition file: a `Mixing key` and the `Recipes` that say which sources
+    get mixed into which submix source.
+    """
     RESIDUALS_KEY = 'residuals'
 
-    def __init__(self, base_dir, submix_file):
-
-        self.base_directory = base_dir
+    def __init__(self, submix_file):
         self.submix_name = os.path.splitext(os.path.basename(submix_file))[0]
-        self.submix_data = yaml.load(open(submix_file, 'r'))
+        with open(submix_file, 'r') as f:
+            self.submix_data = yaml.safe_load(f)
         self.submix_recipes = self.submix_data['Recipes']
 
         all_vals = [i for s in self.submix_recipes.values() for i in s]
@@ -44,10 +55,6 @@ class Submixes(object):
         if self.RESIDUALS_KEY in self.submix_recipes.keys():
             raise ValueError('\'{}\' is a reserved submix name.'.format(self.RESIDUALS_KEY))
 
-    def _get_all_src_dirs(self):
-        return sorted([root for root, dirs, files in os.walk(self.base_directory)
-                       if 'metadata.yaml' in files])
-
     @staticmethod
     def _invert_dict(d):
         """
@@ -62,76 +69,192 @@ class Submixes(object):
         """
         return {i: k for k, v in d.items() for i in v}
 
-    def do_all_submixes(self, n_threads=1):
-        dirs = self._get_all_src_dirs()
-        pool = ThreadPool(n_threads)
-        pool.map(self.do_submix, dirs)
+    @property
+    def output_names(self):
+        """
+        File-ready names of every submix source this definition makes, including residuals.
+        """
+        return [_file_ready_string(k) for k in self.submix_recipes.keys()] + [self.RESIDUALS_KEY]
 
-    def do_submix(self, srcs_dir):
-        src_metadata = yaml.load(open(os.path.join(srcs_dir, 'metadata.yaml'), 'r'))
-        submix_dir = os.path.join(srcs_dir, _file_ready_string(self.submix_name))
-        os.makedirs(submix_dir, exist_ok=True)
+    def submix_for(self, src_metadata):
+        """
+        Figures out which submix source a source belongs to.
+        :param src_metadata: (dict) the metadata of one source (one entry under `stems` in
+            `metadata.yaml`).
+        :return: (str) file-ready name of the submix source.
+        """
+        src_submix_name = src_metadata[self.submix_key]
+        key = self._inv_sm[src_submix_name] if src_submix_name in self._inv_sm else self.RESIDUALS_KEY
+        return _file_ready_string(key)
+
+
+class Submixes(object):
+    """
+    Makes submixes for one or more submix definition files. Every source of a track is
+    read once, and added into every submix source it belongs to across all of the
+    definitions.
+
+    Tracks are processed in blocks of `block_size` frames: each block of each source is
+    read into a preallocated float32 buffer and added in place into the buffers of its
+    submix sources, which are written out as they are finished. Memory per track is a
+    few blocks, no matter how long the track is or how many sources it has.
+    """
+    RESIDUALS_KEY = SubmixDefinition.RESIDUALS_KEY
 
-        mix_wav, sr = sf.read(os.path.join(srcs_dir, 'mix.wav'))
+    def __init__(self, base_dir, submix_files, block_size=2 ** 16):
+        """
+        :param base_dir: (str) base directory of Slakh (as .wav files).
+        :param submix_files: (str or list) path(s) to submix definition files.
+        :param block_size: (int) number of frames to read, mix, and write at a time.
+        """
+        if isinstance(submix_files, str):
+            submix_files = [submix_files]
 
-        submixes_dict = {_file_ready_string(k): [] for k in self.submix_recipes.keys()}
-        submixes_dict[self.RESIDUALS_KEY] = []
+        self.base_directory = base_dir
+        self.definitions = [SubmixDefinition(f) for f in submix_files]
+        self.block_size = block_size
 
-        # Use the file's metadata and the submix recipe to gather all the
-        # sources together.
-        for s in os.listdir(os.path.join(srcs_dir, 'stems')):
-            src_path = os.path.join(srcs_dir, 'stems', s)
-            src_wav, sr = sf.read(src_path)
+        # Names are compared as directory names, since each submix is written to one
+        names = [_file_ready_string(d.submix_name) for d in self.definitions]
+        if len(set(names)) != len(names):
+            raise ValueError('Submix definition files must have unique names.')
 
-            # Figure out which submix this source belongs to
-            src_id = os.path.splitext(s)[0]
-            src_submix_name = src_metadata[src_id][self.submix_key]
-            key = self._inv_sm[src_submix_name] if src_submix_name in self._inv_sm else self.RESIDUALS_KEY
-            key = _file_ready_string(key)
+        # Every submix source made, as (definition index, file-ready name)
+        self.output_keys = [(i, name) for i, d in enumerate(self.definitions)
+                            for name in d.output_names]
 
-            if key not in submixes_dict.keys():
-                # Should be in the dict already, but just to make sure
-                submixes_dict[key] = []
+    def _get_all_src_dirs(self):
+        return [t.path for t in find_tracks(self.base_directory, require_file='metadata.yaml')]
 
-            submixes_dict[key].append(src_wav)
+    def output_path(self, srcs_dir, key):
+        """
+        :return: (str) path of the file for submix source `key` (see `output_keys`) of a track.
+        """
+        i, src_name = key
+        return os.path.join(srcs_dir, _file_ready_string(self.definitions[i].submix_name),
+                            '{}.wav'.format(src_name))
 
-        # Sum all of the sources in each submix and ready the info for the feature reader.
-        for src_name, src_data in submixes_dict.items():
+    def assign(self, src_metadata, src_ids):
+        """
+        Figures out which submix sources each source gets added to, for every definition.
+        :param src_metadata: (dict) the contents of a track's `metadata.yaml`.
+        :param src_ids: (list) source ids, e.g., ['S00', 'S01'].
+        :return: (list) for each source, the indices (into `output_keys`) of its submix sources.
+        """
+        rows = {key: row for row, key in enumerate(self.output_keys)}
+        return [[rows[(i, d.submix_for(src_metadata['stems'][src_id]))]
+                 for i, d in enumerate(self.definitions)]
+                for src_id in src_ids]
 
-            # if there's no data for this submix, write a file of 0's
-            if len(src_data) <= 0:
-                src_data = np.zeros((1, mix_wav.shape[0]))
+    def do_all_submixes(self, n_threads=1, trace_path=None, progress=False):
+        """
+        Makes the submixes of every track.
+        :param n_threads: (int) number of tracks to make submixes of at once.
+        :param trace_path: (str) path of a JSON-lines file to write the time spent on each
+            track to, see `common/instrument.py`.
+        :param progress: (bool) show a progress line with an ETA.
+        """
+        timer = StageTimer('discover')
+        with timer.stage('discover'):
+            dirs = self._get_all_src_dirs()
+        with Tracer('submixes', total=len(dirs), trace_path=trace_path,
+                    progress=progress) as tracer, ThreadPool(n_threads) as pool:
+            tracer.record(timer, done=0)
+            for timer in pool.imap_unordered(self.do_submix, dirs):
+                tracer.record(timer)
 
+    def do_submix(self, srcs_dir):
+        """
+        Makes the submixes of one track.
+        :param srcs_dir: (str) the track directory.
+        :return: (StageTimer) the time spent on each stage.
+        """
+        timer = StageTimer(os.path.basename(os.path.normpath(srcs_dir)))
+        with timer.stage('discover'):
+            with open(os.path.join(srcs_dir, 'metadata.yaml'), 'r') as f:
+                src_metadata = yaml.safe_load(f)
+
+            # Only the length and format of the mix are needed, not its audio
+            mix_info = sf.info(os.path.join(srcs_dir, 'mix.wav'))
+            n_frames, sr, n_channels = mix_info.frames, mix_info.samplerate, mix_info.channels
+
+            src_files = sorted(f for f in os.listdir(os.path.join(srcs_dir, 'stems'))
+                               if os.path.splitext(f)[1] == '.wav')
+            assignments = self.assign(src_metadata, [os.path.splitext(f)[0] for f in src_files])
+
+        block_size = min(self.block_size, max(n_frames, 1))
+        src_block = np.empty((block_size, n_channels), dtype=np.float32)
+        submix_blocks = np.empty((len(self.output_keys), block_size, n_channels), dtype=np.float32)
+
+        with ExitStack() as stack:
+            srcs = [stack.enter_context(sf.SoundFile(os.path.join(srcs_dir, 'stems', f)))
+                    for f in src_files]
+            submixes = []
+            for key in self.output_keys:
+                src_path = self.output_path(srcs_dir, key)
+                os.makedirs(os.path.dirname(src_path), exist_ok=True)
+                # Each file is closed before `atomic_output` renames it, since exits run in reverse
+                temp_path = stack.enter_context(atomic_output(src_path))
+                submixes.append(stack.enter_context(
+                    sf.SoundFile(temp_path, 'w', sr, n_channels, mix_info.subtype)))
+
+            # Use the file's metadata and the submix recipes to gather all the sources
+            # together, one block at a time. Submix sources with no sources are all 0's.
             # The files should already be normalized in the mix,
             # so no need to remix/renormalize them here.
-            src_path = os.path.join(submix_dir, '{}.wav'.format(src_name))
-            submix = np.sum(src_data, axis=0)
-            sf.write(src_path, submix, sr)
+            for start in range(0, n_frames, block_size):
+                n = min(block_size, n_frames - start)
+                submix_blocks[:, :n] = 0
+                for src, rows in zip(srcs, assignments):
+                    with timer.stage('decode'):
+                        src.read(n, dtype='float32', always_2d=True, fill_value=0,
+                                 out=src_block[:n])
+                    with timer.stage('process'):
+                        for row in rows:
+                            submix_blocks[row, :n] += src_block[:n]
+                with timer.stage('write'):
+                    for submix, block in zip(submixes, submix_blocks):
+                        submix.write(block[:n])
+
+        src_paths = [os.path.join(srcs_dir, 'stems', f) for f in src_files]
+        timer.count(files=len(self.output_keys),
+                    bytes_in=sum(os.path.getsize(p) for p in src_paths),
+                    bytes_out=sum(os.path.getsize(self.output_path(srcs_dir, k))
+                                  for k in self.output_keys),
+                    audio_seconds=len(src_files) * n_frames / sr)
+        return timer
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-submix-definition-file', '-s', type=str, required=True,
-                        help='Path to yaml file to define a submix.')
+    parser.add_argument('-submix-definition-file', '-s', type=str, required=True, nargs='+',
+                        help='Path(s) to yaml file(s) to define a submix. Every definition is '
+                             'made in a single pass over the data.')
     parser.add_argument('-input-dir', '-i', type=str, required=False,
                         help='Base directory to apply a submix to the whole dataset.')
-    parser.add_argument('-src-dir', '-s', type=str, required=False,
+    parser.add_argument('-src-dir', '-d', type=str, required=False,
                         help='Directory of a single track to create a submix for.')
     parser.add_argument('-num-threads', '-t', type=int, default=1,
                         help='Number of threads to spwan to do the submixing.')
+    parser.add_argument('-block-size', '-b', type=int, default=2 ** 16,
+                        help='Number of frames to read, mix, and write at a time.')
+    parser.add_argument('-trace', type=str, default=None,
+                        help='Path of a JSON-lines file to write the time spent on each track to.')
+    parser.add_argument('-no-progress', action='store_true',
+                        help='Do not show the progress line.')
 
     args = parser.parse_args()
-    if args.root_dir is None and args.src_dir is None:
-        raise ValueError('Must provide one of (root_dir, src_dir).')
-    elif args.root_dir is not None and args.src_dir is not None:
-        raise ValueError('Must provide only one of (root_dir, src_dir).')
+    if args.input_dir is None and args.src_dir is None:
+        raise ValueError('Must provide one of (input_dir, src_dir).')
+    elif args.input_dir is not None and args.src_dir is not None:
+        raise ValueError('Must provide only one of (input_dir, src_dir).')
 
-    elif args.root_dir:
-        sm = Submixes(args.input_dir, args.submix_definition)
-        sm.do_all_submixes(args.num_threads)
+    elif args.input_dir:
+        sm = Submixes(args.input_dir, args.submix_definition_file, args.block_size)
+        sm.do_all_submixes(args.num_threads, args.trace, not args.no_progress)
 
     elif args.src_dir:
-        sm = Submixes(None, args.submix_definition)
+        sm = Submixes(None, args.submix_definition_file, args.block_size)
         sm.do_submix(args.src_dir)
 
     else:
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Submixes computed on the fly, without writing anything to disk. Given a submix
+# definition file (the same format as for `submixes.py`), excerpts of submix sources
+# are made on demand by summing only the needed excerpts of the needed stems.
+# Which stems go into which submix source is worked out for every track up front,
+# and recently made excerpts are cached.
+# See the README about how to use.
+
+import os
+import sys
+
+import numpy as np
+
+# Allow importing this file from within this directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cache import LRUCache  # noqa: E402
+from loader.slakh_dataset import SlakhDataset  # noqa: E402
+from submixes.submixes import SubmixDefinition  # noqa: E402
+
+
+class VirtualSubmixes(object):
+    """
+    Lazy view of the submixes that `Submixes` would write for one definition file.
+
+    >>> band = VirtualSubmixes('/path/to/slakh2100', 'example_submixes/band.yaml')
+    >>> band.submix_names
+    ['piano', 'guitar', 'bass', 'drums', 'residuals']
+    >>> excerpt = band.get_excerpt('Track00001', ['bass', 'drums'], offset=44100, length=5 * 44100)
+    >>> excerpt.shape
+    (2, 220500)
+    """
+
+    def __init__(self, base_dir, submix_file, cache_bytes=2 ** 28, dataset=None):
+        """
+        :param base_dir: (str) base directory of Slakh. Ignored if `dataset` is given.
+        :param submix_file: (str) path to a submix definition file.
+        :param cache_bytes: (int) memory budget, in bytes, for recently made excerpts.
+        :param dataset: (SlakhDataset) optional, already built index of the dataset to use.
+        """
+        self.definition = SubmixDefinition(submix_file)
+        self.dataset = dataset if dataset is not None else SlakhDataset(base_dir, cache_bytes=0)
+        self.cache = LRUCache(cache_bytes)
+
+        # Which stems make up each submix source, for every track.
+        self.assignments = {}
+        for track_id in self.dataset.track_ids:
+            track_assignments = {name: [] for name in self.submix_names}
+            for stem_id in self.dataset.stem_ids(track_id):
+                stem = self.dataset.stem_metadata(track_id, stem_id)
+                track_assignments[self.definition.submix_for(stem)].append(stem_id)
+            self.assignments[track_id] = track_assignments
+
+    @property
+    def submix_names(self):
+        """
+        File-ready names of the submix sources, including residuals.
+        """
+        return self.definition.output_names
+
+    def stems_for(self, track_id, submix_name):
+        """
+        :return: (list) ids of the stems that are summed to make a submix source of a track.
+        """
+        return self.assignments[track_id][submix_name]
+
+    def _make(self, track_id, submix_name, offset, length):
+        # Read through the dataset, so stems that end early are zero-padded and packed
+        # tracks are read from their packed files
+        stems = self.dataset.get_excerpt(track_id, self.stems_for(track_id, submix_name),
+                                         offset, length)
+        submix = stems.sum(axis=0, dtype=np.float32)
+        if stems.dtype.kind == 'i':
+            submix /= np.iinfo(stems.dtype).max + 1.  # Like soundfile's scaling of integers
+        return submix
+
+    def get_excerpt(self, track_id, submix_names=None, offset=0, length=None):
+        """
+        Gets an excerpt of some (or all) of the submix sources of a track.
+        :param track_id: (str) e.g., 'Track00001'.
+        :param submix_names: (list) names of the submix sources to get, e.g., ['bass'].
+            If `None`, gets all of them, in the order of `submix_names`.
+        :param offset: (int) first frame of the excerpt.
+        :param length: (int) number of frames in the excerpt. If `None`, goes to the end of the mix.
+        :return: (np.ndarray) float32 array of shape (len(submix_names), length).
+        """
+        if submix_names is None:
+            submix_names = self.submix_names
+        if length is None:
+            length = max(0, self.dataset.track_length(track_id)[0] - offset)
+
+        excerpt = np.empty((len(submix_names), length), dtype=np.float32)
+        for i, name in enumerate(submix_names):
+            key = (track_id, name, offset, length)
+            excerpt[i] = self.cache.get_or_load(
+                key, lambda: self._make(track_id, name, offset, length))
+        return excerpt
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from loudness.bs1770 import LoudnessMeter, integrated_loudness
+
+
+def _sine(sr, seconds, freq=997., amplitude=1.):
+    t = np.arange(int(sr * seconds)) / sr
+    return amplitude * np.sin(2 * np.pi * freq * t)
+
+
+def _stems(sr):
+    rng = np.random.RandomState(0)
+    n = int(sr * 1.3)
+    return np.stack([
+        _sine(sr, 1.3, amplitude=0.5),
+        rng.normal(0, 0.1, n),
+        np.concatenate([rng.normal(0, 0.3, n // 2), np.zeros(n - n // 2)]),  # loud, then silent
+        np.zeros(n),
+    ])
+
+
+@pytest.mark.parametrize('sr', [44100, 48000, 16000])
+@pytest.mark.parametrize('block_size', [3, 1234, 4410, 10 ** 6])
+def test_streamed_matches_whole_signal(sr, block_size):
+    stems = _stems(sr)
+    meter = LoudnessMeter(sr)
+    for i in range(0, stems.shape[-1], block_size):
+        meter.push(stems[:, i:i + block_size])
+
+    expected = integrated_loudness(stems, sr)
+    streamed = meter.loudness()
+    assert np.isneginf(expected[3]) and np.isneginf(streamed[3])
+    np.testing.assert_allclose(streamed[:3], expected[:3], rtol=0, atol=1e-9)
+
+
+def test_streamed_multichannel_matches_whole_signal():
+    sr = 44100
+    stereo = _stems(sr)[:2][None]  # one signal with two channels
+    meter = LoudnessMeter(sr, multichannel=True)
+    for i in range(0, stereo.shape[-1], 3000):
+        meter.push(stereo[..., i:i + 3000])
+    np.testing.assert_allclose(meter.loudness(), integrated_loudness(stereo, sr, multichannel=True),
+                               rtol=0, atol=1e-9)
+
+
+def test_full_scale_sine():
+    # BS.1770: a 0 dBFS 997 Hz sine in one channel reads -3.01 LKFS
+    assert integrated_loudness(_sine(48000, 5.), 48000) == pytest.approx(-3.01, abs=0.01)
+
+
+def test_silence_is_gated_out():
+    sr = 44100
+    loud = _sine(sr, 20., amplitude=0.25)
+    with_silence = np.concatenate([loud, np.zeros(20 * sr)])
+    # Without gating this would be 3 dB quieter. Only the few blocks that straddle the
+    # end of the sine pass the gates and count toward the loudness.
+    assert integrated_loudness(with_silence, sr) == pytest.approx(integrated_loudness(loud, sr),
+                                                                  abs=0.05)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import numpy as np
+
+from common.cache import LRUCache
+
+
+def _array(n_bytes):
+    return np.zeros(n_bytes, dtype=np.uint8)
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(300)
+    for key in 'abc':
+        cache.put(key, _array(100))
+    cache.get('a')
+    cache.put('d', _array(100))
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.n_bytes == 300
+
+    # Too big to cache, and does not evict anything
+    cache.put('e', _array(301))
+    assert 'e' not in cache and len(cache) == 3
+
+
+def test_get_or_load():
+    cache = LRUCache(1000)
+    calls = []
+    load = lambda: calls.append(1) or _array(10)
+    assert cache.get_or_load('a', load) is cache.get_or_load('a', load)
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_concurrent_loads_of_a_key_load_once():
+    cache = LRUCache(1000)
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return _array(10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('a', load)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 8 and all(r is results[0] for r in results)
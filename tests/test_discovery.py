@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+from common.discovery import find_tracks, scan_tracks, track_number
+
+
+def _age(base_dir):
+    """
+    Sets the mtime of every directory listed to the past, so the listing can be cached.
+    """
+    for path in [base_dir] + [os.path.join(base_dir, s) for s in os.listdir(base_dir)]:
+        os.utime(path, (1e9, 1e9))
+
+
+@pytest.fixture
+def slakh(tmp_path):
+    base_dir = tmp_path / 'slakh'
+    for path in ['train/Track00001', 'train/Track00002', 'validation/Track01501',
+                 'test/Track01876', 'Track00003', 'train/not_a_track']:
+        (base_dir / path).mkdir(parents=True)
+    (base_dir / 'train' / 'Track00001' / 'metadata.yaml').write_text('')
+    (base_dir / 'README').write_text('')
+    _age(str(base_dir))
+    return str(base_dir), str(tmp_path / 'cache')
+
+
+def test_track_number():
+    assert track_number('Track00042') == 42
+    assert track_number('Track') is None
+
+
+def test_scan_tracks(slakh):
+    base_dir, cache_dir = slakh
+    tracks = scan_tracks(base_dir, cache_dir=cache_dir)
+    assert [t.relative_path for t in tracks] == [
+        'train/Track00001', 'train/Track00002', 'Track00003', 'validation/Track01501',
+        'test/Track01876']
+    assert tracks[2].split is None
+    assert tracks[0].path == os.path.join(base_dir, 'train', 'Track00001')
+
+
+def test_find_tracks(slakh):
+    base_dir, cache_dir = slakh
+    ids = lambda **kwargs: [t.track_id for t in find_tracks(base_dir, cache_dir=cache_dir,
+                                                            **kwargs)]
+    assert ids(start=2, end='Track01501') == ['Track00002', 'Track00003', 'Track01501']
+    assert ids(splits='train') == ['Track00001', 'Track00002']
+    assert ids(splits=[None, 'test']) == ['Track00003', 'Track01876']
+    assert ids(track_ids=['Track00002', 'Track09999']) == ['Track00002']
+    assert ids(require_file='metadata.yaml') == ['Track00001']
+
+
+def test_cache_follows_changes(slakh):
+    base_dir, cache_dir = slakh
+    assert len(scan_tracks(base_dir, cache_dir=cache_dir)) == 5
+    cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+
+    # Nothing changed, so the listing comes from the cache
+    with open(cache_path) as f:
+        cache = json.load(f)
+    cache['tracks'] = cache['tracks'][:1]
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+    assert len(scan_tracks(base_dir, cache_dir=cache_dir)) == 1
+    assert len(scan_tracks(base_dir, use_cache=False, cache_dir=cache_dir)) == 5
+
+    # Adding or moving a track changes the mtime of a directory that was listed
+    os.mkdir(os.path.join(base_dir, 'test', 'Track01877'))
+    assert len(scan_tracks(base_dir, cache_dir=cache_dir)) == 6
+    os.rename(os.path.join(base_dir, 'train', 'Track00002'),
+              os.path.join(base_dir, 'test', 'Track00002'))
+    assert [t.relative_path for t in scan_tracks(base_dir, cache_dir=cache_dir)][1] == \
+        'test/Track00002'
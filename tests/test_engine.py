@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from resampling.engine import StreamingResampler, output_length, resample
+
+
+def _stream(x, input_sr, target_sr, block_size):
+    streamer = StreamingResampler(input_sr, target_sr)
+    blocks = [streamer.push(x[..., i:i + block_size]) for i in range(0, x.shape[-1], block_size)]
+    blocks.append(streamer.flush())
+    return np.concatenate(blocks, axis=-1)
+
+
+@pytest.mark.parametrize('input_sr, target_sr', [(44100, 16000), (44100, 22050), (16000, 44100),
+                                                 (48000, 44100)])
+@pytest.mark.parametrize('block_size', [1, 37, 1000, 4096, 100000])
+def test_streaming_matches_whole_signal(input_sr, target_sr, block_size):
+    rng = np.random.RandomState(0)
+    x = rng.uniform(-1, 1, size=(2, 3, 9001)).astype(np.float32)
+
+    expected = resample(x, input_sr, target_sr)
+    streamed = _stream(x, input_sr, target_sr, block_size)
+    assert streamed.shape == expected.shape == (2, 3, output_length(9001, input_sr, target_sr))
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_streaming_short_and_empty_input():
+    x = np.linspace(-1, 1, 5, dtype=np.float32)
+    np.testing.assert_array_equal(_stream(x, 44100, 16000, 2), resample(x, 44100, 16000))
+
+    streamer = StreamingResampler(44100, 16000)
+    assert streamer.push(np.zeros(0, dtype=np.float32)).shape == (0,)
+    assert streamer.flush().shape == (0,)
@@ -0,0 +1,73 @@
+import shutil
+
+import mido
+import numpy as np
+import pytest
+
+from splits.find_duplicates import find_duplicates, make_splits, note_shingles
+from splits.resplit_slakh import orig_split
+
+
+def _write_midi(path, pitches, tempo=500000, ticks_per_beat=480):
+    midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage('set_tempo', tempo=tempo, time=0))
+    for pitch in pitches:
+        track.append(mido.Message('note_on', note=pitch, velocity=80, time=0))
+        track.append(mido.Message('note_off', note=pitch, velocity=0, time=ticks_per_beat // 2))
+    midi.tracks.append(track)
+    midi.save(str(path))
+
+
+@pytest.fixture
+def slakh(tmp_path, monkeypatch):
+    monkeypatch.setenv('SLAKH_UTILS_CACHE_DIR', str(tmp_path / 'cache'))
+    base_dir = tmp_path / 'slakh'
+    rng = np.random.RandomState(0)
+    melody = list(rng.randint(40, 80, size=64))
+    pitches = {
+        'Track00001': melody,
+        'Track00002': melody,  # same notes, different tempo and resolution
+        'Track01501': melody,  # exact copy
+        'Track00003': [60, 62],  # too short to fingerprint
+        'Track00004': [60, 62],
+        'Track00005': list(rng.randint(40, 80, size=64)),
+    }
+    for track_id in pitches:
+        (base_dir / orig_split(track_id) / track_id).mkdir(parents=True)
+    for track_id in ['Track00001', 'Track00003', 'Track00004', 'Track00005']:
+        _write_midi(base_dir / orig_split(track_id) / track_id / 'all_src.mid', pitches[track_id])
+    _write_midi(base_dir / 'train' / 'Track00002' / 'all_src.mid', melody, tempo=400000,
+                ticks_per_beat=960)
+    shutil.copy(base_dir / 'train' / 'Track00001' / 'all_src.mid',
+                base_dir / 'validation' / 'Track01501' / 'all_src.mid')
+    return base_dir
+
+
+def test_short_files_have_no_shingles():
+    notes = {'start_tick': np.array([0, 480]), 'pitch': np.array([60, 62]),
+             'is_drum': np.array([False, False]), 'ticks_per_beat': 480}
+    assert len(note_shingles(notes)) == 0
+
+
+def test_find_duplicates(slakh):
+    duplicates, splits = find_duplicates(str(slakh))
+    assert duplicates['Track00001']['midi_duplicates'] == ['Track00002', 'Track01501']
+    assert duplicates['Track01501']['midi_duplicates'] == ['Track00001', 'Track00002']
+    assert duplicates['Track00005']['midi_duplicates'] == []
+    # Identical short files are still found by md5
+    assert duplicates['Track00003']['midi_duplicates'] == ['Track00004']
+    assert splits['Track01501'] == 'validation'
+
+    split2, redux = make_splits(duplicates, splits)
+    assert split2['Track01501'] == {'action': 'move', 'source_split': 'validation',
+                                    'destination_split': 'train'}
+    assert redux['Track00001'] == {'action': None}
+    assert redux['Track00002']['action'] == 'omit'
+    assert redux['Track01501']['action'] == 'omit'
+
+
+def test_make_splits_rejects_flat_layout():
+    duplicates = {'Track00001': {'midi_md5': '0', 'midi_duplicates': []}}
+    with pytest.raises(ValueError):
+        make_splits(duplicates, {'Track00001': None})
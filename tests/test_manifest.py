@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from common.manifest import TrackManifest, atomic_output, remove_partial_outputs
+
+
+@pytest.fixture
+def track(tmp_path):
+    src = tmp_path / 'in' / 'S00.flac'
+    src.parent.mkdir()
+    src.write_bytes(b'source')
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    out = out_dir / 'S00.wav'
+    out.write_bytes(b'output')
+    return str(src), str(out_dir), str(out)
+
+
+def test_is_current_follows_source_and_params(track):
+    src, out_dir, out = track
+    manifest = TrackManifest(out_dir, {'sr': 16000})
+    assert not manifest.is_current(src, out)
+    manifest.record(src, out)
+    assert manifest.is_current(src, out)
+
+    # Reloaded from disk, and with different parameters
+    assert TrackManifest(out_dir, {'sr': 16000}).is_current(src, out)
+    assert not TrackManifest(out_dir, {'sr': 22050}).is_current(src, out)
+
+    # Same contents with a new mtime (e.g., a copy) is still current
+    os.utime(src, ns=(0, 0))
+    assert manifest.is_current(src, out)
+
+    with open(src, 'wb') as f:
+        f.write(b'changed')
+    assert not manifest.is_current(src, out)
+
+
+def test_truncated_output_is_not_current(track):
+    src, out_dir, out = track
+    manifest = TrackManifest(out_dir, {})
+    manifest.record(src, out)
+    with open(out, 'wb') as f:
+        f.write(b'out')
+    assert not manifest.is_current(src, out)
+
+
+def test_atomic_output(tmp_path):
+    path = str(tmp_path / 'mix.wav')
+    with atomic_output(path) as temp_path:
+        assert temp_path.endswith('.wav')
+        with open(temp_path, 'w') as f:
+            f.write('done')
+    with open(path) as f:
+        assert f.read() == 'done'
+
+    with pytest.raises(RuntimeError):
+        with atomic_output(path) as temp_path:
+            with open(temp_path, 'w') as f:
+                f.write('partial')
+            raise RuntimeError
+    with open(path) as f:
+        assert f.read() == 'done'
+    assert os.listdir(str(tmp_path)) == ['mix.wav']
+
+
+def test_remove_partial_outputs(tmp_path):
+    (tmp_path / 'mix.wav').write_bytes(b'')
+    (tmp_path / '.mix.partial-1-2.wav').write_bytes(b'')
+    remove_partial_outputs(str(tmp_path))
+    assert os.listdir(str(tmp_path)) == ['mix.wav']
+    remove_partial_outputs(str(tmp_path / 'missing'))
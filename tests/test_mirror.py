@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from common.manifest import atomic_output
+from common.mirror import mirror_file, mirror_track_extras
+
+
+@pytest.fixture
+def track(tmp_path):
+    track_dir = tmp_path / 'in' / 'Track00001'
+    (track_dir / 'MIDI').mkdir(parents=True)
+    (track_dir / 'metadata.yaml').write_text('normalized: false\n')
+    (track_dir / 'all_src.mid').write_bytes(b'MThd')
+    (track_dir / 'MIDI' / 'S00.mid').write_bytes(b'MThd')
+    return track_dir
+
+
+def _set_mtime(path, mtime):
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'symlink', 'copy'])
+def test_mirror_track_extras(track, tmp_path, mode):
+    out_dir = tmp_path / 'out' / 'Track00001'
+    mirror_track_extras(str(track), str(out_dir), mode)
+    for name in ['metadata.yaml', 'all_src.mid', os.path.join('MIDI', 'S00.mid')]:
+        assert (out_dir / name).read_bytes() == (track / name).read_bytes()
+    # A second run has nothing to do
+    assert mirror_file(str(track / 'metadata.yaml'), str(out_dir / 'metadata.yaml'), mode) is None
+
+
+def test_rewritten_mirror_is_kept(track, tmp_path):
+    src = track / 'metadata.yaml'
+    dst = tmp_path / 'out' / 'metadata.yaml'
+    dst.parent.mkdir()
+    _set_mtime(src, 1_000_000_000_000_000_000)
+    assert mirror_file(str(src), str(dst), 'hardlink') == 'hardlink'
+
+    # Rewritten like `loudness/renormalize.py` does, which breaks the hardlink
+    with atomic_output(str(dst)) as temp_path:
+        with open(temp_path, 'w') as f:
+            f.write('normalized: true\n')
+    _set_mtime(dst, 1_000_000_001_000_000_000)
+    assert mirror_file(str(src), str(dst), 'hardlink') is None
+    assert dst.read_text() == 'normalized: true\n'
+
+    # The source changed after the rewrite, so it is mirrored again
+    _set_mtime(src, 1_000_000_002_000_000_000)
+    assert mirror_file(str(src), str(dst), 'hardlink') == 'hardlink'
+    assert dst.read_text() == 'normalized: false\n'
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import soundfile as sf
+
+from conversion.packed import PackedTrack, pack_track
+
+
+SR = 8000
+
+
+@pytest.fixture
+def track(tmp_path):
+    track_dir = tmp_path / 'Track00001'
+    (track_dir / 'stems').mkdir(parents=True)
+    rng = np.random.RandomState(0)
+    lengths = {'mix': 1000, 'S00': 1000, 'S01': 600}  # S01 ends early
+    for name, n in lengths.items():
+        path = track_dir / (f'{name}.wav' if name == 'mix' else f'stems/{name}.wav')
+        sf.write(str(path), rng.uniform(-0.9, 0.9, n), SR, subtype='PCM_16')
+    return str(track_dir)
+
+
+def _soundfile(track_dir, name, n_frames=1000):
+    path = f'{track_dir}/mix.wav' if name == 'mix' else f'{track_dir}/stems/{name}.wav'
+    audio, _ = sf.read(path, dtype='float32')
+    return np.pad(audio, (0, n_frames - len(audio)))
+
+
+def test_int16_round_trip(track, tmp_path):
+    out_path = str(tmp_path / 'audio.slakhpack')
+    # A small block size, so the stems are packed in several blocks
+    assert pack_track(track, out_path, block_size=256) == ['mix', 'S00', 'S01']
+
+    packed = PackedTrack(out_path)
+    assert (packed.sr, len(packed)) == (SR, 1000)
+    expected = np.stack([_soundfile(track, name) for name in packed.sources])
+    np.testing.assert_array_equal(packed.read(), expected)
+    np.testing.assert_array_equal(packed.read(300, 500, ['S01', 'mix']), expected[[2, 0], 300:800])
+
+    # Past the end of the track is zero-padded
+    excerpt = packed.read(900, 200)
+    np.testing.assert_array_equal(excerpt[:, :100], expected[:, 900:])
+    assert not excerpt[:, 100:].any()
+    assert packed.read(1200).shape == (3, 0)
+
+    int16, _ = sf.read(f'{track}/stems/S00.wav', dtype='int16')
+    np.testing.assert_array_equal(packed.excerpt(sources=['S00'])[0], int16)
+
+
+def test_float16_round_trip(track, tmp_path):
+    out_path = str(tmp_path / 'audio.slakhpack')
+    pack_track(track, out_path, dtype='float16')
+    packed = PackedTrack(out_path)
+    np.testing.assert_allclose(packed.read(sources=['S00'])[0], _soundfile(track, 'S00'),
+                               atol=1e-3)
+
+
+def test_excerpt_outside_of_track(track, tmp_path):
+    out_path = str(tmp_path / 'audio.slakhpack')
+    pack_track(track, out_path)
+    with pytest.raises(ValueError):
+        PackedTrack(out_path).excerpt(900, 200)
+    with pytest.raises(ValueError):
+        PackedTrack(out_path).read(-1, 10)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.make_synthetic import make_track
+from common.midi_notes import read_notes
+from pianoroll.pianoroll import N_PITCHES, PianoRoll, compute_piano_roll, quantize_notes
+
+
+SR = 8000
+HOP = 64
+
+
+@pytest.fixture(scope='module')
+def track(tmp_path_factory):
+    track_dir = str(tmp_path_factory.mktemp('slakh') / 'Track00001')
+    make_track(track_dir, n_stems=4, seconds=3., sr=SR, seed=3)
+    out_path = os.path.join(track_dir, 'pianoroll.npz')
+    n_frames = compute_piano_roll(track_dir, out_path, SR, HOP)
+    return track_dir, PianoRoll(out_path), n_frames
+
+
+def _naive_roll(track_dir, stem_id, n_frames, onsets=False, velocity=False):
+    """
+    Renders the whole piano roll of a stem straight from its MIDI file, one note at a time.
+    """
+    notes = read_notes(os.path.join(track_dir, 'MIDI', stem_id + '.mid'))
+    onset, offset = quantize_notes(notes, SR, HOP)
+    roll = np.zeros((N_PITCHES, n_frames), dtype=np.uint8 if velocity else bool)
+    for i in np.lexsort((notes['pitch'], onset)):
+        end = onset[i] + 1 if onsets else offset[i]
+        roll[notes['pitch'][i], onset[i]:end] = notes['velocity'][i] if velocity else True
+    return roll
+
+
+@pytest.mark.parametrize('onsets', [False, True])
+@pytest.mark.parametrize('velocity', [False, True])
+def test_roll_matches_naive_render(track, onsets, velocity):
+    track_dir, roll, n_frames = track
+    assert len(roll) == n_frames
+    assert roll.stem_ids == ['S00', 'S01', 'S02', 'S03']
+    # Notes can end after the audio does, so render past it
+    n_total = n_frames + 100
+    full = np.stack([_naive_roll(track_dir, s, n_total, onsets, velocity) for s in roll.stem_ids])
+    assert full[:, :, :n_frames].any()
+
+    np.testing.assert_array_equal(roll.roll(onsets=onsets, velocity=velocity),
+                                  full[:, :, :n_frames])
+    for start, length in [(0, 1), (17, 50), (n_frames - 10, 30), (n_frames + 50, 10)]:
+        np.testing.assert_array_equal(
+            roll.roll(start, length, ['S02', 'S00'], onsets, velocity),
+            full[[2, 0], :, start:start + length])
+
+
+def test_notes_of_window(track):
+    _, roll, n_frames = track
+    all_notes = roll.notes('S01')
+    for start, end in [(0, n_frames), (30, 31), (100, 160)]:
+        notes = roll.notes('S01', start, end)
+        expected = (all_notes['onset'] < end) & (all_notes['offset'] > start)
+        np.testing.assert_array_equal(notes['onset'], all_notes['onset'][expected])
+        np.testing.assert_array_equal(notes['pitch'], all_notes['pitch'][expected])
+
+
+def test_frame_range(track):
+    _, roll, _ = track
+    assert roll.frame_range(0, HOP) == (0, 1)
+    assert roll.frame_range(HOP - 1, 2) == (0, 2)
+    # At twice the sample rate, an excerpt covers half as many frames
+    assert roll.frame_range(4 * HOP, 4 * HOP, 2 * SR) == (2, 2)
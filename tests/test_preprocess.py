@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from benchmarks.make_synthetic import make_track
+from pipeline.preprocess import preprocess_track
+from submixes.submixes import Submixes
+
+
+SR = 8000
+SUBMIX_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'submixes', 'example_submixes', 'band.yaml')
+
+
+@pytest.fixture
+def track(tmp_path):
+    in_track_dir = str(tmp_path / 'in' / 'Track00001')
+    make_track(in_track_dir, n_stems=3, seconds=1., sr=SR)
+    return in_track_dir, str(tmp_path / 'out' / 'Track00001')
+
+
+def _read(path):
+    return sf.read(path, dtype='float32')[0]
+
+
+def test_outputs_match_inputs(track):
+    in_track_dir, out_track_dir = track
+    submixes = Submixes(None, [SUBMIX_FILE])
+    n_written = preprocess_track(in_track_dir, out_track_dir, submixes=submixes, block_size=1000)
+    assert n_written == 4 + len(submixes.output_keys)
+
+    stems = {s: _read(os.path.join(in_track_dir, 'stems', s + '.wav'))
+             for s in ['S00', 'S01', 'S02']}
+    for name, audio in stems.items():
+        out_path = os.path.join(out_track_dir, 'stems', name + '.wav')
+        np.testing.assert_array_equal(_read(out_path), audio)
+    np.testing.assert_array_equal(_read(os.path.join(out_track_dir, 'mix.wav')),
+                                  _read(os.path.join(in_track_dir, 'mix.wav')))
+
+    # Every stem goes into one submix source, so the submix sources add up to the stems
+    submix_sum = sum(_read(submixes.output_path(out_track_dir, key))
+                     for key in submixes.output_keys)
+    np.testing.assert_allclose(submix_sum, sum(stems.values()), atol=1e-3)
+    assert os.path.isfile(os.path.join(out_track_dir, 'metadata.yaml'))
+
+
+def test_up_to_date_outputs_are_skipped(track):
+    in_track_dir, out_track_dir = track
+    assert preprocess_track(in_track_dir, out_track_dir) == 4
+    assert preprocess_track(in_track_dir, out_track_dir) == 0
+
+    # Other parameters make every output out of date
+    assert preprocess_track(in_track_dir, out_track_dir, target_sr=SR // 2) == 4
+    assert sf.info(os.path.join(out_track_dir, 'mix.wav')).samplerate == SR // 2
+    assert preprocess_track(in_track_dir, out_track_dir, target_sr=SR // 2) == 0
+
+    # So does a changed source, or a missing output
+    stem_path = os.path.join(in_track_dir, 'stems', 'S01.wav')
+    os.utime(stem_path, ns=(0, 0))
+    assert preprocess_track(in_track_dir, out_track_dir, target_sr=SR // 2) == 4
+    os.remove(os.path.join(out_track_dir, 'stems', 'S02.wav'))
+    assert preprocess_track(in_track_dir, out_track_dir, target_sr=SR // 2) == 4
+    assert preprocess_track(in_track_dir, out_track_dir, target_sr=SR // 2) == 0
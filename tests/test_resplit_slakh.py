@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from splits.resplit_slakh import (JOURNAL_NAME, _current_locations, apply_splits, orig_split,
+                                  reset, target_splits)
+
+
+TRACK_IDS = ['Track00001', 'Track00002', 'Track01500', 'Track01501', 'Track01875', 'Track01876',
+             'Track02000', 'Track02100']
+SPLIT_DATA = {
+    'Track00001': {'action': 'move', 'source_split': 'train', 'destination_split': 'test'},
+    'Track00002': {'action': 'omit', 'source_split': 'train'},
+    'Track01501': {'action': 'move', 'source_split': 'validation', 'destination_split': 'train'},
+    'Track01876': {'action': None},
+    'Track02000': {'action': 'omit', 'source_split': 'test'},
+}
+
+
+@pytest.fixture
+def slakh(tmp_path, monkeypatch):
+    """
+    A Slakh2100-orig layout of empty tracks, each with a file that must survive every move.
+    """
+    monkeypatch.setenv('SLAKH_UTILS_CACHE_DIR', str(tmp_path / 'cache'))
+    base_dir = tmp_path / 'slakh'
+    for track_id in TRACK_IDS:
+        track_dir = base_dir / orig_split(track_id) / track_id
+        track_dir.mkdir(parents=True)
+        (track_dir / 'metadata.yaml').write_text(track_id)
+    split_file = tmp_path / 'splits.json'
+    split_file.write_text(json.dumps(SPLIT_DATA))
+    return str(base_dir), str(split_file)
+
+
+def _layout(base_dir):
+    locations = _current_locations(base_dir)
+    for track_id, split in locations.items():
+        with open(os.path.join(base_dir, split, track_id, 'metadata.yaml')) as f:
+            assert f.read() == track_id
+    return locations
+
+
+def test_apply_and_reset_round_trip(slakh):
+    base_dir, split_file = slakh
+    orig = {t: orig_split(t) for t in TRACK_IDS}
+    assert _layout(base_dir) == orig
+
+    assert apply_splits(base_dir, split_file) == 4
+    assert _layout(base_dir) == target_splits(TRACK_IDS, split_file)
+    assert _layout(base_dir)['Track00002'] == 'omitted'
+
+    # Applying the same configuration again does nothing
+    assert apply_splits(base_dir, split_file) == 0
+    assert _layout(base_dir) == target_splits(TRACK_IDS, split_file)
+
+    assert reset(base_dir) == 4
+    assert _layout(base_dir) == orig
+    assert reset(base_dir) == 0
+    assert not os.path.exists(os.path.join(base_dir, JOURNAL_NAME))
+
+
+def _interrupt(base_dir, split_file, n_done):
+    """
+    Leaves `base_dir` as if applying `split_file` stopped after `n_done` moves.
+    """
+    targets = target_splits(TRACK_IDS, split_file)
+    moves = [(t, orig_split(t), targets[t]) for t in TRACK_IDS if targets[t] != orig_split(t)]
+    with open(os.path.join(base_dir, JOURNAL_NAME), 'w') as f:
+        json.dump({'split_file': split_file, 'moves': moves}, f)
+    for track_id, source, dest in moves[:n_done]:
+        os.makedirs(os.path.join(base_dir, dest), exist_ok=True)
+        os.rename(os.path.join(base_dir, source, track_id), os.path.join(base_dir, dest, track_id))
+
+
+@pytest.mark.parametrize('n_done', [0, 2, 4])
+def test_interrupted_run_is_finished(slakh, n_done):
+    base_dir, split_file = slakh
+    _interrupt(base_dir, split_file, n_done)
+
+    # The journal's moves are finished first, so nothing is left to plan afterwards
+    assert apply_splits(base_dir, split_file) == 0
+    assert _layout(base_dir) == target_splits(TRACK_IDS, split_file)
+    assert not os.path.exists(os.path.join(base_dir, JOURNAL_NAME))
+
+
+def test_reset_after_interrupted_run(slakh):
+    base_dir, split_file = slakh
+    _interrupt(base_dir, split_file, 1)
+
+    assert reset(base_dir) == 4
+    assert _layout(base_dir) == {t: orig_split(t) for t in TRACK_IDS}
+    assert not os.path.exists(os.path.join(base_dir, JOURNAL_NAME))
+
+
+def test_track_in_both_splits_is_not_moved(slakh):
+    base_dir, split_file = slakh
+    _interrupt(base_dir, split_file, 0)
+    # Track00001 moves from train to test, but is already in both
+    shutil.copytree(os.path.join(base_dir, 'train', 'Track00001'),
+                    os.path.join(base_dir, 'test', 'Track00001'))
+
+    with pytest.raises(FileExistsError):
+        apply_splits(base_dir, split_file)
+    assert not os.path.exists(os.path.join(base_dir, 'test', 'Track00001', 'Track00001'))
+    assert os.path.isdir(os.path.join(base_dir, 'train', 'Track00001'))